@@ -5,9 +5,21 @@
 
 import math
 import os, sys, re
+from array import array
+from bisect import bisect_left
+from itertools import izip
 
 FLY, EXTRUDE, RETRACT, RESTORE, META, DRAW = (  "Fly", "Extrude", "Retract",  
                                                 "Restore", "Meta", "Draw")
+# ColumnarGcodeModel stores styles as indexes into this list
+STYLES = [None, FLY, EXTRUDE, RETRACT, RESTORE, META, DRAW]
+
+# Marks a missing value in ColumnarGcodeModel's columns
+NAN = float('nan')
+
+# Comments in parens, and word/value pairs like 'X-12.5'
+PAREN_COMMENT_RE = re.compile( r"\(.*\)")
+GCODE_WORD_RE = re.compile( r'([a-zA-Z])([-+]?\d*(?:\.\d+)?)')
 
 # TODO: Needed Gcodes:  
 # G2,3  ( Arc)
@@ -15,18 +27,32 @@ FLY, EXTRUDE, RETRACT, RESTORE, META, DRAW = (  "Fly", "Extrude", "Retract",
 # G300  ( Custom: set laser power)
 class GcodeParser:
     
-    def __init__(self):
-        self.model = GcodeModel(self)
+    def __init__(self, columnar=False, fast=False):
+        # columnar=True builds a ColumnarGcodeModel, which is much smaller 
+        # and faster to build for big jobs
+        if columnar:
+            self.model = ColumnarGcodeModel(self)
+        else:
+            self.model = GcodeModel(self)
+        # fast=True parses with parseLineFast() instead of parseLine()
+        self.fast = fast
+        # code -> handler, e.g. 'G1' -> self.parse_G1
+        self.handlers = dict( (name[len("parse_"):], getattr(self, name)) 
+                              for name in dir(self) if name.startswith("parse_"))
+        # When self.line is None, the current line's text is 
+        # self.lineFormat % (the segment's coords); see GcodeBuilder
+        self.lineFormat = None
         
     def parseString( self, gcodeString):
         # TODO: We should clear out self.model before adding to it here
         self.lineNb = 0
+        parseLine = self.parseLineFast if self.fast else self.parseLine
         for line in gcodeString.split( "\n"):
             self.lineNb += 1
             # remove trailing linefeed
             self.line = line.rstrip()
             # parse a line
-            self.parseLine()
+            parseLine()
         self.model.postProcess()
         return self.model
                     
@@ -35,6 +61,40 @@ class GcodeParser:
         with open( path,'r') as f:
             gcodeString = f.read()
         return self.parseString( gcodeString)
+    
+    def parseIter(self, lines, keep=False):
+        # Parse lines one at a time from any iterable of strings (an open 
+        # file, say), yielding each Segment as soon as its line is parsed.
+        # Segments come out with style, layerIdx, distance and extrudate set
+        # as postProcess() would set them.  Unless keep is True, the model 
+        # forgets each segment once it's been yielded, so memory stays flat
+        # however long the input is.  With keep=True the model is 
+        # post-processed at the end and can be used as usual.
+        self.lineNb = 0
+        parseLine = self.parseLineFast if self.fast else self.parseLine
+        model = self.model
+        classifier = SegmentClassifier(model)
+        done = 0
+        for line in lines:
+            self.lineNb += 1
+            self.line = line.rstrip()
+            parseLine()
+            if len(model) > done:
+                for seg in model.segments[done:]:
+                    classifier.classify(seg)
+                    yield seg
+                if keep:
+                    done = len(model)
+                else:
+                    model.clearSegments()
+        if keep:
+            model.postProcess()
+    
+    def iterFile(self, path, keep=False):
+        # parseIter() over the lines of the file at path
+        with open( path,'r') as f:
+            for seg in self.parseIter( f, keep):
+                yield seg
         
     def parseLine(self):
         # Remove comments in parens.  This will handle nested
@@ -62,13 +122,42 @@ class GcodeParser:
                 getattr(self, "parse_"+code)(args)
             else:
                 self.warn("Unknown code '%s'"%code)
+    
+    def parseLineFast(self):
+        # Same as parseLine(), but only runs the regexes it needs to, and 
+        # tokenizes the code and its args in a single pass.  The handler 
+        # gets its args as a ready-made dict rather than a string.
+        line = self.line
+        if '(' in line:
+            line = self.line = PAREN_COMMENT_RE.sub( "", line)
+        if ';' in line:
+            line = line.split(';', 1)[0]
+        
+        words = GCODE_WORD_RE.findall( line)
+        if not words:
+            return
+        letter, number = words[0]
+        code = letter + number
+        handler = self.handlers.get( code)
+        if handler is None:
+            self.warn("Unknown code '%s'"%code)
+            return
+        
+        args = {}
+        for letter, coord in words[1:]:
+            try:
+                args[letter] = float(coord)
+            except ValueError:
+                self.warn("Bad value for '%s': '%s'"%(letter, coord))
+        handler(args)
         
     def parseArgs(self, args):
+        # args may already have been tokenized by parseLineFast()
+        if isinstance(args, dict):
+            return args
         dic = {}
         if args:
-            gcode_re = r'([a-zA-Z])([-+]?\d*(?:\.\d+)?)'
-        
-            bits = re.findall( gcode_re, args)
+            bits = GCODE_WORD_RE.findall( args)
             for letter, coord in bits:
                 try:
                     dic[letter] = float(coord)
@@ -173,14 +262,18 @@ class GcodeModel:
             "E":0.0}
         # if true, args for move (G1) are given relatively (default: absolute)
         self.isRelative = False
-        # the segments
+        # the segments, in line order, and their line numbers
         self.segments = []
+        self.lineNbs = array('l')
         self.layers = None
         self.distance = None
         self.extrudate = None
         self.bbox = None
         self.setLaserPower(0)
     
+    def __len__(self):
+        return len(self.segments)
+    
     def do_G0( self, args):
         return self.do_G1( args, gcode="G0")
     
@@ -195,6 +288,10 @@ class GcodeModel:
                     coords[axis] += args[axis]
                 else:
                     coords[axis] = args[axis]
+            elif axis == 'S':
+                # Laser power on the move itself (GRBL laser mode), 
+                # e.g. 'G1 X10 S255'; it stays set for the moves after it
+                self.setLaserPower(args['S'])
             else:
                 self.warn("Unknown axis '%s'"%axis)
         # build segment
@@ -205,13 +302,10 @@ class GcodeModel:
             "F": coords["F"],   # no feedrate offset
             "E": self.offset["E"] + coords["E"]
         }
+        if 'S' in args:
+            absolute['S'] = args['S']
         
-        seg = Segment(
-            gcode,
-            absolute,
-            self.parser.lineNb,
-            self.parser.line)
-        self.addSegment(seg)
+        self.addMove(gcode, absolute)
         # update model coords
         self.relative = coords
         
@@ -246,11 +340,7 @@ class GcodeModel:
         self.setLaserPower( args.get( 'S', 0))
         coords = dict(self.relative)
         coords.update( {'S': self.laserPower})
-        seg = Segment(  'M300', 
-                        coords, 
-                        self.parser.lineNb,
-                        self.parser.line)
-        self.addSegment( seg)
+        self.addMove( 'M300', coords)
     
     def setLaserPower( self, power):
         self.laserPower = power
@@ -263,9 +353,27 @@ class GcodeModel:
     def setRelative(self, isRelative):
         self.isRelative = isRelative
         
+    def addMove(self, gcode, coords):
+        # Record a segment for the line currently being parsed
+        line = self.parser.line
+        if line is None:
+            line = self.parser.lineFormat % coords
+        seg = Segment(
+            gcode,
+            coords,
+            self.parser.lineNb,
+            line)
+        self.addSegment(seg)
+    
     def addSegment(self, segment):
         self.segments.append(segment)
+        self.lineNbs.append(segment.lineNb)
         #print segment
+    
+    def clearSegments(self):
+        # Forget all segments parsed so far, but not the current position
+        del self.segments[:]
+        del self.lineNbs[:]
         
     def warn(self, msg):
         self.parser.warn(msg)
@@ -299,6 +407,10 @@ class GcodeModel:
             newZ, oldZ = seg.coords['Z'], coords['Z']
             newE, oldE = seg.coords['E'], coords['E']
             
+            # A move that sets its own power burns at that power
+            if seg.gcode != 'M300' and 'S' in seg.coords:
+                self.setLaserPower( seg.coords['S'])
+            
             # Record change in laser state
             if seg.gcode == 'M300':
                 style = META
@@ -447,16 +559,437 @@ class GcodeModel:
         self.calcMetrics()
 
     def allSegments( self):
-        allSegs = set(self.segments)
-        for l in self.layers:
-            allSegs = allSegs.union( set( l.segments))
-            
-        allSegs = list( allSegs)
-        allSegs.sort( key=lambda x: x.lineNb)
-        return allSegs
+        # Segments are added in line order, and every layer's segments are 
+        # among them, so there's nothing to merge or sort.  Don't modify 
+        # the list returned.
+        return self.segments
+    
+    def segmentIndex( self, lineNb):
+        # Index in allSegments() of the first segment on or after line lineNb
+        return bisect_left( self.lineNbs, lineNb)
+    
+    def iterSegments( self, start=0):
+        # Iterate over allSegments() from index start, without copying
+        segs = self.allSegments()
+        for i in xrange( start, len( segs)):
+            yield segs[i]
+    
+    def previewPoints( self, start=0, stop=None):
+        # Yield (style, X, Y, S) for every segment from index start up to 
+        # stop, in line order, for drawing.  S is None for segments that 
+        # don't set laser power.
+        for seg in self.allSegments()[start:stop]:
+            yield seg.style, seg.coords['X'], seg.coords['Y'], seg.coords.get('S')
     
     def __str__(self):
         return "<GcodeModel: len(segments)=%d, len(layers)=%d, distance=%f, extrudate=%f, bbox=%s>"%(len(self.segments), len(self.layers), self.distance, self.extrudate, self.bbox)
+
+class ColumnarGcodeModel(GcodeModel):
+    # A GcodeModel that stores its segments as columns: one typed array per
+    # coordinate and per segment attribute, rather than a Segment object 
+    # and coords dict per line.  A 500k-line raster job takes a fraction of
+    # the memory and time to build this way.
+    #
+    # The Segment-based API (segments, allSegments(), Layer.segments) still
+    # works, but builds Segment objects on the fly as they're accessed.
+    # They're copies: changing one doesn't change the model.
+    AXES = ("X", "Y", "Z", "F", "E", "S")
+    
+    def __init__(self, parser):
+        GcodeModel.__init__(self, parser)
+        # One array per column, all indexed by segment number.  Missing 
+        # values (e.g. S on a G1) are stored as NaN.
+        self.columns = dict((axis, array('d')) for axis in self.AXES)
+        self.columnAppends = [(axis, self.columns[axis].append) for axis in self.AXES]
+        self.gcodeIdx = array('B')      # index into self.gcodeNames
+        self.styleIdx = array('B')      # index into STYLES
+        self.lineNbs = array('l')
+        self.layerIdxs = array('l')
+        self.distances = array('d')
+        self.extrudates = array('d')
+        # Line text, or None for lines whose text is made on demand from
+        # lineFormats[lineFormatIdx[i]]; see lineText()
+        self.lines = []
+        self.lineFormatIdx = array('B')
+        self.lineFormats = [None]
+        self.lineFormatIndexes = {None: 0}
+        self.gcodeNames = []
+        self.gcodeIndexes = {}
+        self.segments = SegmentList(self)
+    
+    def __len__(self):
+        return len(self.lineNbs)
+    
+    def gcodeIndex(self, gcode):
+        # Index of gcode (e.g. 'G1') in self.gcodeNames, adding it if need be
+        idx = self.gcodeIndexes.get(gcode)
+        if idx is None:
+            idx = self.gcodeIndexes[gcode] = len(self.gcodeNames)
+            self.gcodeNames.append(gcode)
+        return idx
+    
+    def lineFormatIndex(self, lineFormat):
+        # Index of lineFormat in self.lineFormats, adding it if need be
+        idx = self.lineFormatIndexes.get(lineFormat)
+        if idx is None:
+            idx = self.lineFormatIndexes[lineFormat] = len(self.lineFormats)
+            self.lineFormats.append(lineFormat)
+        return idx
+    
+    def addMove(self, gcode, coords):
+        self.gcodeIdx.append(self.gcodeIndex(gcode))
+        
+        get = coords.get
+        for axis, append in self.columnAppends:
+            append(get(axis, NAN))
+        self.lineNbs.append(self.parser.lineNb)
+        line = self.parser.line
+        self.lines.append(line)
+        if line is None:
+            self.lineFormatIdx.append(self.lineFormatIndex(self.parser.lineFormat))
+        else:
+            self.lineFormatIdx.append(0)
+        self.styleIdx.append(0)
+        self.layerIdxs.append(0)
+        self.distances.append(0.0)
+        self.extrudates.append(0.0)
+        
+    def clearSegments(self):
+        for column in self.columns.itervalues():
+            del column[:]
+        for column in (self.gcodeIdx, self.styleIdx, self.lineNbs, self.layerIdxs,
+                       self.distances, self.extrudates, self.lines, self.lineFormatIdx):
+            del column[:]
+    
+    def extendColumns(self, count, gcodeIdx, lineFormatIdx, columns):
+        # Append count segments at once, on the lines following the 
+        # parser's current line.  gcodeIdx and lineFormatIdx give each 
+        # segment's gcodeIndex() and lineFormatIndex(); the line text is 
+        # always made on demand.  columns maps axis to one value per segment;
+        # missing axes are NaN.  Values must be what do_G1()/do_M300() would
+        # have recorded, and may be lists or arrays (array.array or numpy,
+        # of the same C type as the column).
+        def extend(column, values):
+            if hasattr(values, 'tostring'):
+                column.fromstring(values.tostring())
+            else:
+                column.extend(values)
+        
+        extend(self.gcodeIdx, gcodeIdx)
+        extend(self.lineFormatIdx, lineFormatIdx)
+        for axis in self.AXES:
+            values = columns.get(axis)
+            if values is None:
+                self.columns[axis].extend(array('d', [NAN]) * count)
+            else:
+                extend(self.columns[axis], values)
+        
+        firstLineNb = self.parser.lineNb + 1
+        self.lineNbs.extend(xrange(firstLineNb, firstLineNb + count))
+        self.lines.extend([None] * count)
+        self.styleIdx.extend(array('B', [0]) * count)
+        self.layerIdxs.extend(array('l', [0]) * count)
+        self.distances.extend(array('d', [0.0]) * count)
+        self.extrudates.extend(array('d', [0.0]) * count)
+        self.parser.lineNb += count
+        
+        # Carry the final position on to the lines that follow
+        if count:
+            for axis in self.relative:
+                val = self.columns[axis][-1]
+                if val == val:
+                    self.relative[axis] = val - self.offset.get(axis, 0.0)
+            S = self.columns["S"]
+            for i in xrange(len(S) - 1, len(S) - count - 1, -1):
+                if S[i] == S[i]:
+                    self.setLaserPower(S[i])
+                    break
+    
+    def addSegment(self, segment):
+        # Copy an existing Segment into the columns
+        self.addMove(segment.gcode, segment.coords)
+        self.lineNbs[-1] = segment.lineNb
+        self.lines[-1] = segment.line
+        self.lineFormatIdx[-1] = 0
+    
+    def lineText(self, i):
+        # Text of segment i's line
+        line = self.lines[i]
+        if line is None:
+            line = self.lineFormats[self.lineFormatIdx[i]] % self.coords(i)
+        return line
+    
+    def coords(self, i):
+        # coords dict for segment i, as a Segment would have it
+        coords = {}
+        for axis, column in self.columns.iteritems():
+            val = column[i]
+            if val == val: # not NaN
+                coords[axis] = val
+        return coords
+        
+    def segment(self, i):
+        # Build a Segment for segment number i
+        coords = self.coords(i)
+        line = self.lines[i]
+        if line is None:
+            line = self.lineFormats[self.lineFormatIdx[i]] % coords
+        seg = Segment(self.gcodeNames[self.gcodeIdx[i]], coords,
+                      self.lineNbs[i], line)
+        seg.style = STYLES[self.styleIdx[i]]
+        seg.layerIdx = self.layerIdxs[i]
+        seg.distance = self.distances[i]
+        seg.extrudate = self.extrudates[i]
+        return seg
+    
+    def classifySegments(self):
+        # Same rules as GcodeModel.classifySegments(), applied to the columns
+        X, Y, Z = self.columns["X"], self.columns["Y"], self.columns["Z"]
+        F, E, S = self.columns["F"], self.columns["E"], self.columns["S"]
+        m300 = self.gcodeIndexes.get('M300', -1)
+        gcodeIdx = self.gcodeIdx
+        styleIdx = self.styleIdx
+        layerIdxs = self.layerIdxs
+        FLY_, META_, DRAW_ = STYLES.index(FLY), STYLES.index(META), STYLES.index(DRAW)
+        RETRACT_, RESTORE_, EXTRUDE_ = (STYLES.index(RETRACT), STYLES.index(RESTORE), 
+                                        STYLES.index(EXTRUDE))
+        
+        oldX = oldY = oldZ = oldE = 0.0
+        currentLayerIdx = 0
+        currentLayerZ = 0
+        
+        for i in xrange(len(X)):
+            newX, newY, newZ, newE = X[i], Y[i], Z[i], E[i]
+            moved = (oldX != newX or oldY != newY)
+            style = FLY_
+            power = S[i]
+            
+            # A move that sets its own power burns at that power
+            if power == power and gcodeIdx[i] != m300:
+                self.setLaserPower(power)
+            
+            if gcodeIdx[i] == m300:
+                style = META_
+                self.setLaserPower(power if power == power else 0)
+            elif not moved and oldE != newE:
+                if newE < oldE: style = RETRACT_
+                if newE > oldE: style = RESTORE_
+            elif moved and newE > oldE:
+                style = EXTRUDE_
+            elif moved and self.laserIsOn():
+                style = DRAW_
+            elif newE > oldE and newZ != currentLayerZ:
+                currentLayerZ = newZ
+                currentLayerIdx += 1
+            elif moved or F[i]:
+                pass
+            else:
+                # Shouldn't reach this
+                print "Failed to classify segment: "
+                print self.segment(i)
+            
+            styleIdx[i] = style
+            layerIdxs[i] = currentLayerIdx
+            oldX, oldY, oldZ, oldE = newX, newY, newZ, newE
+    
+    def splitLayers(self):
+        # Layers are runs of consecutive segments with the same layerIdx
+        self.layers = []
+        layerIdxs = self.layerIdxs
+        startCoords = {"X":0.0, "Y":0.0, "Z":0.0, "F":0.0, "E":0.0}
+        start = 0
+        for i in xrange(1, len(layerIdxs) + 1):
+            if i == len(layerIdxs) or layerIdxs[i] != layerIdxs[start]:
+                layer = ColumnarLayer(self, start, i, startCoords)
+                self.layers.append(layer)
+                startCoords = self.coords(i - 1)
+                start = i
+        self.topLayer = len(self.layers)-1
+    
+    def calcMetrics(self):
+        X, Y, Z, E = (self.columns[axis] for axis in ("X", "Y", "Z", "E"))
+        distances = self.distances
+        extrudates = self.extrudates
+        sqrt = math.sqrt
+        
+        self.distance = 0
+        self.extrudate = 0
+        self.bbox = None
+        
+        for layer in self.layers:
+            x, y, z, e = (layer.start[axis] for axis in ("X", "Y", "Z", "E"))
+            if self.bbox is None:
+                self.bbox = BBox(layer.start)
+            bbox = self.bbox
+            xmin, xmax = min(bbox.xmin, x), max(bbox.xmax, x)
+            ymin, ymax = min(bbox.ymin, y), max(bbox.ymax, y)
+            zmin, zmax = min(bbox.zmin, z), max(bbox.zmax, z)
+            
+            layerDistance = 0.0
+            layerExtrudate = 0.0
+            for i in xrange(layer.startIdx, layer.endIdx):
+                nx, ny, nz, ne = X[i], Y[i], Z[i], E[i]
+                d = sqrt((nx-x)**2 + (ny-y)**2 + (nz-z)**2)
+                distances[i] = d
+                extrudates[i] = ne - e
+                layerDistance += d
+                layerExtrudate += ne - e
+                x, y, z, e = nx, ny, nz, ne
+                if x < xmin: xmin = x
+                elif x > xmax: xmax = x
+                if y < ymin: ymin = y
+                elif y > ymax: ymax = y
+                if z < zmin: zmin = z
+                elif z > zmax: zmax = z
+            
+            bbox.xmin, bbox.xmax = xmin, xmax
+            bbox.ymin, bbox.ymax = ymin, ymax
+            bbox.zmin, bbox.zmax = zmin, zmax
+            layer.distance = layerDistance
+            layer.extrudate = layerExtrudate
+            self.distance += layerDistance
+            self.extrudate += layerExtrudate
+    
+    def allSegments( self):
+        # Segments are stored in line order already
+        return self.segments
+    
+    def iterSegments( self, start=0):
+        return iter(SegmentList(self, start))
+    
+    def previewPoints( self, start=0, stop=None):
+        if start or stop is not None:
+            styles = (STYLES[i] for i in self.styleIdx[start:stop])
+            powers = (s if s == s else None for s in self.columns["S"][start:stop])
+            return izip(styles, self.columns["X"][start:stop], self.columns["Y"][start:stop], powers)
+        styles = (STYLES[i] for i in self.styleIdx)
+        powers = (s if s == s else None for s in self.columns["S"])
+        return izip(styles, self.columns["X"], self.columns["Y"], powers)
+    
+class SegmentList(object):
+    # Read-only, list-like view of a range of a ColumnarGcodeModel's 
+    # segments.  Segment objects are built as they're accessed.  With no 
+    # stop, the view always extends to the model's last segment.
+    def __init__(self, model, start=0, stop=None):
+        self.model = model
+        self.start = start
+        self.stop = stop
+        
+    def __len__(self):
+        stop = len(self.model) if self.stop is None else self.stop
+        return stop - self.start
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            return SegmentList(self.model, self.start + start, self.start + max(start, stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("segment index out of range")
+        return self.model.segment(self.start + key)
+    
+    def __iter__(self):
+        segment = self.model.segment
+        for i in xrange(self.start, self.start + len(self)):
+            yield segment(i)
+    
+class GcodeBuilder(object):
+    # Builds a model straight from code that generates gcode, without 
+    # writing out the whole job as text and parsing it back.  Lines can be
+    # added as text, which is parsed as usual, or as moves, whose text is 
+    # only made (as lineFormat % the segment's coords) if it's asked for.
+    # Line numbers are the same as if the lines had been joined up and 
+    # parsed with GcodeParser.parseString().
+    def __init__(self, columnar=True, fast=True):
+        self.parser = GcodeParser(columnar=columnar, fast=fast)
+        self.model = self.parser.model
+        self.parser.lineNb = 0
+        self.parser.line = None
+        self.parseLine = self.parser.parseLineFast if fast else self.parser.parseLine
+        
+    def addLine(self, line):
+        # Parse one line of gcode text
+        self.parser.lineNb += 1
+        self.parser.line = line.rstrip()
+        self.parseLine()
+        
+    def addText(self, text):
+        # Parse several lines of gcode text
+        for line in text.split("\n"):
+            self.addLine(line)
+            
+    def addMove(self, gcode, args, lineFormat):
+        # One line with a G0, G1 or M300 code.  args is a dict like 
+        # GcodeParser.parseArgs() returns, e.g. {'X': 1.5}, and lineFormat 
+        # a format like 'G1 X%(X)s' that gives the line's text when applied
+        # to the segment's coords.
+        self.parser.lineNb += 1
+        self.parser.line = None
+        self.parser.lineFormat = lineFormat
+        self.parser.handlers[gcode](args)
+    
+    def finish(self):
+        # Post-process and return the model
+        self.model.postProcess()
+        return self.model
+    
+class SegmentClassifier(object):
+    # Classifies segments one at a time, in order, by the same rules as 
+    # GcodeModel.classifySegments(), and sets their distance and extrudate 
+    # as calcMetrics() would.  Laser state is kept on model.
+    def __init__(self, model):
+        self.model = model
+        self.coords = {
+            "X":0.0,
+            "Y":0.0,
+            "Z":0.0,
+            "F":0.0,
+            "E":0.0}
+        self.layerIdx = 0
+        self.layerZ = 0
+        
+    def classify(self, seg):
+        coords = seg.coords
+        newX, oldX = coords['X'], self.coords['X']
+        newY, oldY = coords['Y'], self.coords['Y']
+        newZ, oldZ = coords['Z'], self.coords['Z']
+        newE, oldE = coords['E'], self.coords['E']
+        moved = (oldX != newX or oldY != newY)
+        style = FLY
+        
+        # A move that sets its own power burns at that power
+        if seg.gcode != 'M300' and 'S' in coords:
+            self.model.setLaserPower( coords['S'])
+        
+        if seg.gcode == 'M300':
+            style = META
+            self.model.setLaserPower( coords.get('S',0))
+        elif not moved and oldE != newE:
+            if newE < oldE: style = RETRACT
+            if newE > oldE: style = RESTORE
+        elif moved and newE > oldE:
+            style = EXTRUDE
+        elif moved and self.model.laserIsOn():
+            style = DRAW
+        elif newE > oldE and newZ != self.layerZ:
+            self.layerZ = newZ
+            self.layerIdx += 1
+        elif moved or coords['F']:
+            pass
+        else:
+            # Shouldn't reach this
+            print "Failed to classify segment: "
+            print seg
+        
+        seg.style = style
+        seg.layerIdx = self.layerIdx
+        seg.distance = math.sqrt((newX-oldX)**2 + (newY-oldY)**2 + (newZ-oldZ)**2)
+        seg.extrudate = newE - oldE
+        self.coords = coords
+        return seg
     
 class Segment:
     def __init__(self, gcode, coords, lineNb, line):
@@ -485,6 +1018,15 @@ class Layer:
         
     def __str__(self):
         return "<Layer: Z=%f, len(segments)=%d, distance=%f, extrudate=%f>"%(self.Z, len(self.segments), self.distance, self.extrudate)
+
+class ColumnarLayer(Layer):
+    # A layer of a ColumnarGcodeModel: segments startIdx up to endIdx
+    def __init__(self, model, startIdx, endIdx, start):
+        Layer.__init__(self, start["Z"])
+        self.start = start
+        self.startIdx = startIdx
+        self.endIdx = endIdx
+        self.segments = SegmentList(model, startIdx, endIdx)
         
         
 if __name__ == '__main__':
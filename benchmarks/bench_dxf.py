@@ -0,0 +1,140 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# DXF parsing benchmark.
+#
+# Writes a multi-megabyte DXF file like a CAD program would export (big
+# HEADER, TABLES and OBJECTS sections, a BLOCKS section, and an ENTITIES
+# section of lines, circles and arcs mixed with text the parser ignores)
+# and times scribbles' DxfParser on it with the classic code-at-a-time
+# parser and the fast one, checking that both make the same entities.
+# Results are printed and written as JSON, tagged with the git revision,
+# so runs from different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_dxf.py [--entities 200000] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, random, argparse, tempfile
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+from scribbles.import_dxf import DxfParser
+from bench_streaming import git_revision
+
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_dxf.json')
+
+def group( code, value):
+    # One group: the code right-justified to 3 characters, as AutoCAD does
+    return "%3d\n%s\n"%(code, value)
+
+def write_dxf( f, num_entities, seed=0):
+    rng = random.Random( seed)
+    coord = lambda: "%.6f"%rng.uniform( 0, 300)
+
+    # Header variables, layers and dictionary objects that DxfParser never
+    # looks at, about as much of them as there are entities
+    f.write( group( 0, 'SECTION') + group( 2, 'HEADER'))
+    for i in range( num_entities // 4):
+        f.write( group( 9, '$VAR%d'%i) + group( 10, coord()) + group( 20, coord()) + group( 70, 0))
+    f.write( group( 0, 'ENDSEC'))
+    f.write( group( 0, 'SECTION') + group( 2, 'TABLES'))
+    for i in range( num_entities // 4):
+        f.write( group( 0, 'LAYER') + group( 5, '%X'%(i + 16)) + group( 2, 'Layer%d'%i)
+                 + group( 70, 0) + group( 62, 7) + group( 6, 'CONTINUOUS'))
+    f.write( group( 0, 'ENDSEC'))
+    f.write( group( 0, 'SECTION') + group( 2, 'BLOCKS'))
+    f.write( group( 0, 'BLOCK') + group( 8, '0') + group( 2, '*Model_Space') + group( 70, 0)
+             + group( 10, 0.0) + group( 20, 0.0) + group( 0, 'ENDBLK') + group( 8, '0'))
+    f.write( group( 0, 'ENDSEC'))
+
+    f.write( group( 0, 'SECTION') + group( 2, 'ENTITIES'))
+    for i in range( num_entities):
+        kind = i % 10
+        if kind < 7:
+            f.write( group( 0, 'LINE') + group( 5, '%X'%i) + group( 100, 'AcDbEntity') + group( 8, '0')
+                     + group( 100, 'AcDbLine') + group( 10, coord()) + group( 20, coord()) + group( 30, 0.0)
+                     + group( 11, coord()) + group( 21, coord()) + group( 31, 0.0))
+        elif kind == 7:
+            f.write( group( 0, 'CIRCLE') + group( 5, '%X'%i) + group( 8, '0')
+                     + group( 10, coord()) + group( 20, coord()) + group( 30, 0.0)
+                     + group( 40, "%.6f"%rng.uniform( 0.5, 10)))
+        elif kind == 8:
+            f.write( group( 0, 'ARC') + group( 5, '%X'%i) + group( 8, '0')
+                     + group( 10, coord()) + group( 20, coord()) + group( 30, 0.0)
+                     + group( 40, "%.6f"%rng.uniform( 0.5, 10))
+                     + group( 50, "%.3f"%rng.uniform( 0, 360)) + group( 51, "%.3f"%rng.uniform( 0, 360)))
+        else:
+            f.write( group( 0, 'TEXT') + group( 5, '%X'%i) + group( 8, '0')
+                     + group( 10, coord()) + group( 20, coord()) + group( 40, 2.5) + group( 1, 'Label %d'%i))
+    f.write( group( 0, 'ENDSEC'))
+
+    f.write( group( 0, 'SECTION') + group( 2, 'OBJECTS'))
+    for i in range( num_entities // 4):
+        f.write( group( 0, 'DICTIONARY') + group( 5, '%X'%(i + 16)) + group( 330, 0)
+                 + group( 100, 'AcDbDictionary') + group( 3, 'ACAD_GROUP%d'%i) + group( 350, 'D'))
+    f.write( group( 0, 'ENDSEC') + group( 0, 'EOF'))
+
+def entity_records( entity_list):
+    # Something comparable for each entity: its class and attributes
+    return [(entity.__class__.__name__, sorted( vars( entity).items())) for entity in entity_list]
+
+def main():
+    parser = argparse.ArgumentParser( description="DXF parsing benchmark")
+    parser.add_argument( '--entities', type=int, default=200000,
+                help="Number of entities in the generated file")
+    parser.add_argument( '--repeat', type=int, default=3,
+                help="Parse this many times per mode and keep the fastest")
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    fd, dxf_path = tempfile.mkstemp( suffix='.dxf')
+    with os.fdopen( fd, 'w') as f:
+        write_dxf( f, options.entities)
+    size = os.path.getsize( dxf_path)
+    print "Generated %d entities (%.1f MB)"%(options.entities, size / 1e6)
+
+    results = []
+    reference = None
+    try:
+        for name, fast in [('classic', False), ('fast', True)]:
+            best = None
+            for i in range( options.repeat):
+                with open( dxf_path, 'r') as f:
+                    start = time.time()
+                    dxf_parser = DxfParser( f, fast=fast)
+                    dxf_parser.parse()
+                    elapsed = time.time() - start
+                best = elapsed if best is None else min( best, elapsed)
+
+            # Both parsers must make the same entities
+            records = entity_records( dxf_parser.entities)
+            if reference is None:
+                reference = records
+            res = { 'mode': name,
+                    'bytes': size,
+                    'entities': len( dxf_parser.entities),
+                    'parse_time_s': round( best, 3),
+                    'mb_per_s': round( size / 1e6 / best, 2),
+                    'matches_classic': records == reference}
+            results.append( res)
+            print ("%(mode)-8s %(parse_time_s)8.2fs  %(mb_per_s)8.2f MB/s  %(entities)8d entities  "
+                   "matches classic: %(matches_classic)s"%res)
+            del dxf_parser, records
+    finally:
+        os.remove( dxf_path)
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'entities': options.entities, 'repeat': options.repeat},
+               'results': results}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# DXF path ordering benchmark.
+#
+# Scatters short lines (and a few circles) at random over a bed, in the
+# order a DXF file might list them, and times scribbles.ordering's
+# nearest-neighbour tour with and without 2-opt, reporting the travel
+# between entities before and after.  Results are printed and written as
+# JSON, tagged with the git revision, so runs from different versions can
+# be compared.
+#
+# Usage:
+#   python benchmarks/bench_dxf_order.py [--entities 1000,10000,50000] [--window 20] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, random, argparse
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+from scribbles import entities, ordering
+from bench_streaming import git_revision
+
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_dxf_order.json')
+
+def random_entities( count, bed_mm=300.0, seed=0):
+    # Lines up to 10 mm long, with every 20th entity a circle
+    rng = random.Random( seed)
+    result = []
+    for i in range( count):
+        x, y = rng.uniform( 0, bed_mm), rng.uniform( 0, bed_mm)
+        if i % 20 == 19:
+            entity = entities.Circle()
+            entity.center = (x, y)
+            entity.radius = rng.uniform( 0.5, 5)
+        else:
+            entity = entities.Line()
+            entity.start = (x, y)
+            entity.end = (x + rng.uniform( -5, 5), y + rng.uniform( -5, 5))
+        result.append( entity)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser( description="DXF path ordering benchmark")
+    parser.add_argument( '--entities', default='1000,10000,50000',
+                help="Comma-separated entity counts to time")
+    parser.add_argument( '--window', type=int, default=ordering.DEFAULT_TWO_OPT_WINDOW,
+                help="2-opt window for the refined run")
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    results = []
+    for count in [int( c) for c in options.entities.split( ',')]:
+        entity_list = random_entities( count)
+        travel_before = ordering.travel_distance( entity_list)
+        for name, window in [('nearest', 0), ('2-opt', options.window)]:
+            start = time.time()
+            ordered = ordering.order_entities( entity_list, two_opt_window=window)
+            elapsed = time.time() - start
+            travel_after = ordering.travel_distance( ordered)
+            res = { 'entities': count,
+                    'method': name,
+                    'time_s': round( elapsed, 3),
+                    'travel_before_mm': round( travel_before, 1),
+                    'travel_after_mm': round( travel_after, 1),
+                    'travel_saved': round( 1 - travel_after / travel_before, 4)}
+            results.append( res)
+            print ("%(entities)7d entities %(method)-8s %(time_s)8.2fs  travel %(travel_before_mm)12.1f mm"
+                   " -> %(travel_after_mm)10.1f mm"%res)
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'entities': options.entities, 'window': options.window},
+               'results': results}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# G-code parsing benchmark.
+#
+# Generates a large raster engraving job in the same format as
+# RishaController.gcode_from_raster() and times GcodeParser on it with the
+# classic and fast line parsers, building both the object-per-segment and
+# columnar models.  Results are printed and written as JSON, tagged with the
+# git revision, so runs from different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_parser.py [--lines 500000] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, random, argparse
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+from YAGV.gcodeParser import GcodeParser
+from bench_streaming import git_revision
+
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_parser.json')
+
+# (name, GcodeParser keyword arguments)
+MODES = [ ('classic',          { 'fast': False, 'columnar': False}),
+          ('fast',             { 'fast': True,  'columnar': False}),
+          ('classic-columnar', { 'fast': False, 'columnar': True}),
+          ('fast-columnar',    { 'fast': True,  'columnar': True})]
+
+def generate_raster_gcode( num_lines, beam_width=0.2, row_width=100.0, seed=0):
+    # Boustrophedon rows of 'M300 S<power>' / 'G1 X<pos>' pairs with random
+    # run lengths and powers, as gcode_from_raster() would write them
+    rng = random.Random( seed)
+    pixels_per_row = int( row_width / beam_width)
+    lines = ['(Set speed)', 'G1 F1500 ', '( Laser off)', 'M300 S0  ',
+             'G90 ; absolute movement ', '(Move to upper left)', 'G1 X0 Y0']
+    y = 0
+    while len( lines) < num_lines:
+        lines.append( 'G1 Y%s '%(beam_width * y))
+        direction_sign = 1 if y % 2 == 0 else -1
+        row_start_loc = 0 if y % 2 == 0 else pixels_per_row * beam_width
+        pixels_done = 0
+        while pixels_done < pixels_per_row:
+            pixels_done = min( pixels_per_row, pixels_done + rng.randint( 1, 12))
+            engrave_power = (255 - rng.randint( 0, 255)) / 255 * 255
+            row_loc = row_start_loc + direction_sign * pixels_done * beam_width
+            lines.append( 'M300 S%s '%engrave_power)
+            lines.append( 'G1 X%s'%row_loc)
+        y += 1
+    lines.append( 'M300 S0')
+    return "\n".join( lines)
+
+def main():
+    parser = argparse.ArgumentParser( description="G-code parsing benchmark")
+    parser.add_argument( '--lines', type=int, default=500000,
+                help="Approximate number of lines in the generated job")
+    parser.add_argument( '--repeat', type=int, default=3,
+                help="Parse this many times per mode and keep the fastest")
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    gcode = generate_raster_gcode( options.lines)
+    num_lines = gcode.count( "\n") + 1
+    print "Generated %d lines (%.1f MB)"%(num_lines, len( gcode) / 1e6)
+
+    results = []
+    reference = None
+    for name, kwargs in MODES:
+        best = None
+        for i in range( options.repeat):
+            start = time.time()
+            model = GcodeParser( **kwargs).parseString( gcode)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min( best, elapsed)
+
+        # Every mode must build the same model
+        points = list( model.previewPoints())
+        if reference is None:
+            reference = points
+        matches = (points == reference)
+        del model, points
+
+        res = { 'mode': name,
+                'lines': num_lines,
+                'parse_time_s': round( best, 3),
+                'lines_per_s': round( num_lines / best, 1),
+                'matches_classic': matches}
+        results.append( res)
+        print "%(mode)-18s %(parse_time_s)8.2fs  %(lines_per_s)10.0f lines/s  matches classic: %(matches_classic)s"%res
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'lines': options.lines, 'repeat': options.repeat},
+               'results': results}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Preview drawing benchmark.
+#
+# Builds the model of a raster job (as bench_raster.py does) and times the
+# work RishaWindow.draw_gcode() does to preview it, without Tk: merging
+# segments into polylines with gcode_preview.preview_polylines(), and
+# drawing the job into an image with gcode_preview.preview_image(), with
+# numpy and without, and the coarse image PreviewThread shows first.  It
+# then builds the job's zoom pyramid and times drawing views from it, from
+# the whole job down to a small part of it.
+# Results are printed and written as JSON, tagged with the git revision,
+# so runs from different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_preview.py [--size-mm 300] [--canvas 800x600] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, argparse
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import raster_gcode
+import gcode_preview
+from YAGV.gcodeParser import GcodeBuilder
+from bench_streaming import git_revision
+from bench_raster import load_image, DEFAULT_IMAGE
+
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_preview.json')
+
+def main():
+    parser = argparse.ArgumentParser( description="Preview drawing benchmark")
+    parser.add_argument( 'image', nargs='?', default=DEFAULT_IMAGE)
+    parser.add_argument( '--size-mm', type=float, default=300.0)
+    parser.add_argument( '--beam-width', type=float, default=0.1)
+    parser.add_argument( '--canvas', default='800x600',
+                help="Canvas size in pixels, WIDTHxHEIGHT")
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    width, height = [int( n) for n in options.canvas.split( 'x')]
+    im = load_image( options.image, options.size_mm, options.beam_width)
+    model = raster_gcode.model_from_raster( im, options.beam_width, 0, 255, GcodeBuilder(),
+                                            engrave_speed=1500)
+    # Fit the whole job on the canvas
+    viewport = gcode_preview.Viewport( width, height, min( width, height) / options.size_mm)
+    print "%s: %d segments, %s canvas"%(os.path.basename( options.image), len( model), options.canvas)
+
+    results = []
+    def timed( name, func):
+        start = time.time()
+        items = func()
+        elapsed = time.time() - start
+        res = { 'step': name, 'time_s': round( elapsed, 3), 'items': items}
+        results.append( res)
+        print "%(step)-22s %(time_s)8.3fs  %(items)9d items"%res
+
+    def polylines( limit=None):
+        count = 0
+        for color, coords in gcode_preview.preview_polylines( model.previewPoints(), viewport):
+            count += 1
+            if count == limit:
+                break
+        return count
+    timed( 'polylines (to limit)', lambda: polylines( gcode_preview.MAX_CANVAS_ITEMS + 1))
+    timed( 'polylines (all)', polylines)
+    if gcode_preview.numpy is not None:
+        timed( 'coarse image (numpy)', lambda: gcode_preview.coarse_preview_image( model, viewport) and 1)
+        timed( 'image (numpy)', lambda: gcode_preview.preview_image( model, viewport) and 1)
+    numpy, gcode_preview.numpy = gcode_preview.numpy, None
+    timed( 'image (python)', lambda: gcode_preview.preview_image( model, viewport) and 1)
+    gcode_preview.numpy = numpy
+
+    if gcode_preview.numpy is not None:
+        pyramids = []
+        timed( 'pyramid (build)', lambda: pyramids.append( gcode_preview.ImagePyramid( model)) or
+                                            len( pyramids[0].levels))
+        # Zoomed out, fitted, and in 4x and 16x on the middle of the job
+        middle = options.size_mm / 2
+        for zoom in [0.25, 1, 4, 16]:
+            scale = viewport.scale * zoom
+            view = gcode_preview.Viewport( width, height, scale,
+                                           (middle - width / scale / 2, middle - height / scale / 2))
+            timed( 'pyramid view (x%g)'%zoom, lambda: pyramids[0].render( view) and 1)
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'image': os.path.basename( options.image),
+                             'size_mm': options.size_mm,
+                             'beam_width': options.beam_width,
+                             'canvas': options.canvas,
+                             'segments': len( model)},
+               'results': results}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Raster-to-gcode benchmark.
+#
+# Scales an example image up to a full engraving job (by default a
+# 300 x 300 mm bed at a 0.1 mm beam, i.e. 3000 x 3000 pixels) and times
+# raster_gcode.gcode_from_raster() with the pure-Python and numpy engines,
+# checking that both produce the same text.  This is done for the plain 
+# serpentine job and for one that trims blank space (trim_blank).  With
+# --job-time, each job's motion time on a simulated GRBL is reported too.
+# With --tones, each tone mode is timed and its command count reported.
+# With --inline-power, jobs give the laser power on the moves themselves
+# ('G1 X.. S..') instead of on separate M300 lines.
+# Results are printed and written as JSON, tagged with the git revision, 
+# so runs from different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_raster.py [--size-mm 300] [--beam-width 0.1] [--job-time] [--tones] [--inline-power] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, argparse
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import PIL
+from PIL import Image
+
+import raster_gcode
+import dummy_serial
+from bench_streaming import git_revision
+
+DEFAULT_IMAGE = os.path.join( REPO_DIR, 'examples', 'RishaLogo.png')
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_raster.json')
+
+def load_image( path, size_mm, beam_width):
+    # Grayscale image stretched to size_mm square, one pixel per beam width
+    pixels = int( round( size_mm / beam_width))
+    im = Image.open( path).convert( "L")
+    return im.resize( (pixels, pixels), resample=PIL.Image.BILINEAR)
+
+def main():
+    parser = argparse.ArgumentParser( description="Raster-to-gcode benchmark")
+    parser.add_argument( 'image', nargs='?', default=DEFAULT_IMAGE)
+    parser.add_argument( '--size-mm', type=float, default=300.0)
+    parser.add_argument( '--beam-width', type=float, default=0.1)
+    parser.add_argument( '--skip-python', action='store_true',
+                help="Only time the numpy engine")
+    parser.add_argument( '--overscan', type=float, default=1.0,
+                help="Run-up and run-out (mm) for the trimmed job")
+    parser.add_argument( '--rapid-gap', type=float, default=5.0,
+                help="Shortest white gap (mm) to rapid across in the trimmed job")
+    parser.add_argument( '--job-time', action='store_true',
+                help="Also work out each job's motion time (slow for big jobs)")
+    parser.add_argument( '--tones', action='store_true',
+                help="Also time each tone mode and count the commands it saves")
+    parser.add_argument( '--tone-levels', type=int, default=4)
+    parser.add_argument( '--inline-power', action='store_true',
+                help="Put the power on the moves ('G1 X.. S..') rather than on M300 lines")
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    im = load_image( options.image, options.size_mm, options.beam_width)
+    w, h = im.size
+    print "%s: %d x %d pixels"%(os.path.basename( options.image), w, h)
+
+    engines = [('numpy', True)]
+    if not options.skip_python:
+        engines.insert( 0, ('python', False))
+    if raster_gcode.numpy is None:
+        print "numpy is not installed; timing the Python engine only"
+        engines = [('python', False)]
+
+    modes = [('serpentine', {}),
+             ('trimmed', { 'trim_blank': True,
+                           'overscan_mm': options.overscan,
+                           'rapid_gap_mm': options.rapid_gap})]
+    results = []
+    for mode, mode_options in modes:
+        reference = None
+        for name, use_numpy in engines:
+            start = time.time()
+            gcode = raster_gcode.gcode_from_raster( im, options.beam_width, 0, 255,
+                                                    engrave_speed=1500, use_numpy=use_numpy,
+                                                    inline_power=options.inline_power,
+                                                    **mode_options)
+            elapsed = time.time() - start
+            if reference is None:
+                reference = gcode
+            num_lines = gcode.count( "\n") + 1
+            res = { 'mode': mode,
+                    'engine': name,
+                    'pixels': w * h,
+                    'lines': num_lines,
+                    'bytes': len( gcode),
+                    'time_s': round( elapsed, 3),
+                    'pixels_per_s': round( w * h / elapsed, 1),
+                    'matches_first': gcode == reference}
+            results.append( res)
+            print ("%(mode)-10s %(engine)-8s %(time_s)8.2fs  %(pixels_per_s)12.0f pixels/s  "
+                   "%(lines)9d lines  %(bytes)10d bytes  matches: %(matches_first)s"%res)
+            del gcode
+
+        if options.job_time:
+            sim = dummy_serial.GrblSimulator( port='bench', clock=dummy_serial.VirtualClock())
+            lines = [line.split( ';')[0].strip() for line in reference.split( "\n")]
+            lines = [line for line in lines if line and not line.startswith( '(')]
+            job_time = sim.ideal_motion_time( lines)
+            for res in results:
+                if res['mode'] == mode:
+                    res['motion_time_s'] = round( job_time, 1)
+            print "%-10s motion time %.1fs"%(mode, job_time)
+        del reference
+
+    tones = []
+    if options.tones:
+        # Counted for the trimmed job, as the controller makes it by default
+        count_options = dict( modes[-1][1], beam_width_mm=options.beam_width,
+                              inline_power=options.inline_power)
+        gray_commands = raster_gcode.raster_command_count( im, **count_options)
+        for mode in raster_gcode.TONE_MODES:
+            start = time.time()
+            toned = raster_gcode.apply_tone( im, mode, levels=options.tone_levels)
+            elapsed = time.time() - start
+            commands = raster_gcode.raster_command_count( toned, **count_options)
+            res = { 'mode': mode,
+                    'levels': options.tone_levels,
+                    'time_s': round( elapsed, 3),
+                    'commands': commands,
+                    'commands_saved': gray_commands - commands}
+            tones.append( res)
+            print ("tone %(mode)-16s %(time_s)8.2fs  %(commands)9d commands  "
+                   "%(commands_saved)9d saved"%res)
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'image': os.path.basename( options.image),
+                             'size_mm': options.size_mm,
+                             'beam_width': options.beam_width,
+                             'overscan': options.overscan,
+                             'rapid_gap': options.rapid_gap,
+                             'inline_power': options.inline_power},
+               'results': results,
+               'tones': tones}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
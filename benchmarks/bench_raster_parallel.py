@@ -0,0 +1,105 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Parallel raster encoding benchmark.
+#
+# Scales an example image up to a full engraving job (as bench_raster.py
+# does), splits it into bands of rows, and times
+# raster_gcode.iter_raster_gcode() encoding them with 1, 2, ... N worker
+# processes, checking that every run produces the same gcode as the
+# single-process one.  Results are printed and written as JSON, tagged with
+# the git revision, so runs from different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_raster_parallel.py [--size-mm 300] [--processes N] [--band-rows 256]
+#                                              [--python] [--trim] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, hashlib, argparse, multiprocessing
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import raster_gcode
+from bench_streaming import git_revision
+from bench_raster import load_image, DEFAULT_IMAGE
+
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_raster_parallel.json')
+
+def split_bands( im, band_rows):
+    # (first row, band) pairs, as raster_gcode.image_bands() would make
+    w, h = im.size
+    return [(y, im.crop( (0, y, w, min( h, y + band_rows)))) for y in range( 0, h, band_rows)]
+
+def main():
+    parser = argparse.ArgumentParser( description="Parallel raster encoding benchmark")
+    parser.add_argument( 'image', nargs='?', default=DEFAULT_IMAGE)
+    parser.add_argument( '--size-mm', type=float, default=300.0)
+    parser.add_argument( '--beam-width', type=float, default=0.1)
+    parser.add_argument( '--band-rows', type=int, default=256)
+    parser.add_argument( '--processes', type=int, default=multiprocessing.cpu_count(),
+                help="Time 1 to this many processes (default: one per core)")
+    parser.add_argument( '--python', action='store_true',
+                help="Use the pure-Python engine rather than numpy")
+    parser.add_argument( '--trim', action='store_true',
+                help="Trim blank space (trim_blank, with 1 mm overscan and 5 mm rapid gaps)")
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    im = load_image( options.image, options.size_mm, options.beam_width)
+    w, h = im.size
+    bands = split_bands( im, options.band_rows)
+    print "%s: %d x %d pixels, %d bands of %d rows, %d cores"%(os.path.basename( options.image),
+                w, h, len( bands), options.band_rows, multiprocessing.cpu_count())
+
+    use_numpy = not options.python and raster_gcode.numpy is not None
+    mode_options = {}
+    if options.trim:
+        mode_options = { 'trim_blank': True, 'overscan_mm': 1.0, 'rapid_gap_mm': 5.0}
+
+    results = []
+    reference = None
+    base_time = None
+    for processes in range( 1, max( 1, options.processes) + 1):
+        start = time.time()
+        digest = hashlib.md5()
+        num_bytes = 0
+        for piece in raster_gcode.iter_raster_gcode( bands, options.beam_width, 0, 255,
+                                    engrave_speed=1500, use_numpy=use_numpy,
+                                    processes=processes, **mode_options):
+            digest.update( piece)
+            num_bytes += len( piece)
+        elapsed = time.time() - start
+        if reference is None:
+            reference = digest.hexdigest()
+            base_time = elapsed
+        res = { 'processes': processes,
+                'time_s': round( elapsed, 3),
+                'pixels_per_s': round( w * h / elapsed, 1),
+                'bytes': num_bytes,
+                'speedup': round( base_time / elapsed, 2),
+                'efficiency': round( base_time / elapsed / processes, 2),
+                'matches_single': digest.hexdigest() == reference}
+        results.append( res)
+        print ("%(processes)3d processes %(time_s)8.2fs  %(pixels_per_s)12.0f pixels/s  "
+               "speedup %(speedup)5.2fx  efficiency %(efficiency)4.2f  matches: %(matches_single)s"%res)
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'image': os.path.basename( options.image),
+                             'size_mm': options.size_mm,
+                             'beam_width': options.beam_width,
+                             'band_rows': options.band_rows,
+                             'engine': 'numpy' if use_numpy else 'python',
+                             'trim_blank': options.trim,
+                             'cores': multiprocessing.cpu_count()},
+               'results': results}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
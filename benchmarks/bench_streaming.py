@@ -0,0 +1,155 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Streaming throughput benchmark.
+#
+# Runs each example job end-to-end through RishaController and
+# GcodeRunnerThread against a simulated GRBL (dummy_serial.GrblSimulator) in
+# virtual time, so a job that would take an hour on the machine finishes in
+# seconds.  Both the character-counting streamer and the older send-and-wait
+# mode are measured.  Results are printed and written as JSON, tagged with
+# the git revision, so runs from different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_streaming.py [--baud 115200] [--output results.json]
+from __future__ import division
+
+import os, sys, time, json, argparse, subprocess
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import dummy_serial
+import risha_controller
+from risha_controller import RishaController, GcodeRunnerThread
+
+EXAMPLES_DIR = os.path.join( REPO_DIR, 'examples')
+DEFAULT_JOBS = ['inset_squares.gcode', 'unicorn-logo.dxf', 'RishaLogo.png']
+RASTER_EXTS = [".jpg", ".jpeg", ".gif", ".png", ".bmp", ".tif"]
+DEFAULT_OUTPUT = os.path.join( REPO_DIR, 'benchmarks', 'results', 'bench_streaming.json')
+
+def git_revision():
+    try:
+        return subprocess.check_output( ['git', 'describe', '--always', '--dirty'],
+                                        cwd=REPO_DIR).strip()
+    except Exception:
+        return 'unknown'
+
+def percentile( sorted_vals, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_vals:
+        return None
+    rank = int( round( pct / 100 * (len( sorted_vals) - 1)))
+    return sorted_vals[rank]
+
+def load_job( path, options):
+    # Build a GcodeModel the same way the UI would
+    controller = RishaController( port_name='bench')
+    controller.set_logging_func( lambda msg: None)
+    if os.path.splitext( path)[1].lower() in RASTER_EXTS:
+        # The UI's defaults (prescale 5, speed from the jog slider) make an
+        # enormous, glacial job; use saner ones here
+        return controller.gcode_from_raster( path, options.beam_width,
+                                min_engrave_power=0, max_engrave_power=255,
+                                engrave_speed=options.engrave_speed,
+                                prescale=options.raster_prescale)
+    controller.set_gcode_from_file( path)
+    return controller.loaded_gcode
+
+def run_job( model, streaming, options):
+    clock = dummy_serial.VirtualClock()
+    sim = dummy_serial.GrblSimulator( port='bench', baudrate=options.baud,
+                                      timeout=0.25, clock=clock,
+                                      default_feed_rate=options.default_feed)
+    controller = RishaController( port_name='bench')
+    controller.set_logging_func( lambda msg: None)
+    controller.serial = sim
+    controller.clock = clock
+
+    # Skip GRBL's startup banner
+    clock.sleep( 0.5)
+    sim.flushInput()
+    sim.reset_statistics()
+
+    runner = GcodeRunnerThread( controller, model, streaming=streaming)
+    runner.record_latencies = True
+    start = clock.time()
+    cpu_start = time.time()
+    # Run on this thread: the virtual clock only moves when we wait on it
+    runner.run()
+    end = sim.wait_until_idle()
+    cpu_time = time.time() - cpu_start
+
+    sent = [runner.sendable_part_of_line( seg.line).strip() for seg in model.allSegments()]
+    sent = [line for line in sent if line]
+    job_time = end - start
+    ideal_time = sim.ideal_motion_time( sent)
+    latencies = sorted( runner.ack_latencies)
+
+    def ms( val):
+        return None if val is None else round( val * 1000, 3)
+
+    return {
+        'mode': 'streaming' if streaming else 'send-wait',
+        'lines': len( sent),
+        'bytes': sim.bytes_received,
+        'job_time_s': round( job_time, 3),
+        'ideal_motion_time_s': round( ideal_time, 3),
+        'efficiency': round( ideal_time / job_time, 4) if job_time else None,
+        'lines_per_s': round( len( sent) / job_time, 2) if job_time else None,
+        'bytes_per_s': round( sim.bytes_received / job_time, 2) if job_time else None,
+        'planner_starvations': sim.planner_starvations,
+        'rx_overflows': sim.rx_overflows,
+        'max_rx_used': sim.max_rx_used,
+        'grbl_errors': len( runner.error_lines),
+        'latency_ms': { 'p50': ms( percentile( latencies, 50)),
+                        'p90': ms( percentile( latencies, 90)),
+                        'p99': ms( percentile( latencies, 99)),
+                        'max': ms( latencies[-1] if latencies else None)},
+        'host_cpu_s': round( cpu_time, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+                description="Streaming throughput benchmark against a simulated GRBL")
+    parser.add_argument( 'jobs', nargs='*',
+                help="Job files to run (default: the files in examples/)")
+    parser.add_argument( '--baud', type=int, default=risha_controller.GRBL_BAUD)
+    parser.add_argument( '--default-feed', type=float, default=1000.0,
+                help="Feed rate (mm/min) for jobs that never set one")
+    parser.add_argument( '--beam-width', type=float, default=0.2)
+    parser.add_argument( '--engrave-speed', type=float, default=1500.0)
+    parser.add_argument( '--raster-prescale', type=float, default=1.0)
+    parser.add_argument( '--output', default=DEFAULT_OUTPUT)
+    options = parser.parse_args()
+
+    jobs = options.jobs or [os.path.join( EXAMPLES_DIR, j) for j in DEFAULT_JOBS]
+    results = []
+    for path in jobs:
+        model = load_job( path, options)
+        for streaming in (True, False):
+            res = run_job( model, streaming, options)
+            res['job'] = os.path.basename( path)
+            results.append( res)
+            print ("%(job)-22s %(mode)-10s %(lines)7d lines  %(lines_per_s)8.1f lines/s  "
+                   "%(bytes_per_s)8.1f B/s  job %(job_time_s)9.1fs  ideal %(ideal_motion_time_s)9.1fs  "
+                   "starved %(planner_starvations)5d  overflows %(rx_overflows)d"%res)
+            print "%22s latency ms: %s"%('', res['latency_ms'])
+
+    report = { 'revision': git_revision(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S'),
+               'settings': { 'baud': options.baud,
+                             'default_feed': options.default_feed,
+                             'beam_width': options.beam_width,
+                             'engrave_speed': options.engrave_speed,
+                             'raster_prescale': options.raster_prescale},
+               'results': results}
+
+    out_dir = os.path.dirname( options.output)
+    if out_dir and not os.path.isdir( out_dir):
+        os.makedirs( out_dir)
+    with open( options.output, 'w') as f:
+        json.dump( report, f, indent=2, sort_keys=True)
+    print "Results written to %s"%options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# A bounded, thread-safe log for the window's console.
+#
+# Writing every message straight into a Tk Text widget costs an insert and
+# a scroll per message, from the UI thread only, and the widget grows
+# without limit through a long job.  Instead, any thread adds messages to
+# a ConsoleLog, which keeps only the last max_lines of them, and the UI
+# thread takes whatever's new a few times a second and shows it in one go.
+# Adding a message only ever waits on the log's own lock, held just long
+# enough to append to or copy the buffer, never on Tk.
+#
+# Messages have the standard logging levels; those below the log's level
+# are dropped as they come.  Per-line job traffic is logged at DEBUG, so
+# it's off by default.
+import threading
+import logging
+from collections import deque
+from itertools import islice
+
+DEBUG, INFO, WARNING, ERROR = logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR
+
+DEFAULT_MAX_LINES = 1000
+
+class ConsoleLog( object):
+    def __init__( self, max_lines=DEFAULT_MAX_LINES, level=INFO):
+        self.lines = deque( maxlen=max_lines)
+        self.level = level
+        self.lock = threading.Lock()
+        # Messages kept so far, and how many of them take_new() has handed out
+        self.added = 0
+        self.taken = 0
+
+    def log( self, msg, level=INFO):
+        # Safe to call from any thread
+        if level < self.level:
+            return
+        with self.lock:
+            self.lines.append( str( msg).rstrip( "\r\n"))
+            self.added += 1
+
+    def take_new( self):
+        # The messages added since the last call, oldest first, and how many
+        # more there were that fell out of the buffer before they were taken
+        with self.lock:
+            new = self.added - self.taken
+            self.taken = self.added
+            kept = min( new, len( self.lines))
+            messages = list( islice( self.lines, len( self.lines) - kept, None))
+        return messages, new - kept
+
+    def all_lines( self):
+        with self.lock:
+            return list( self.lines)
@@ -33,8 +33,12 @@ __license__ = 'Apache License, Version 2.0'
 __revision__  = '$Rev: 178 $'
 __date__      = '$Date: 2014-03-23 17:12:58 +0100 (Sun, 23 Mar 2014) $'
 
+import math
+import re
 import sys
+import threading
 import time
+from collections import deque
 
 DEFAULT_TIMEOUT = 5
 """The default timeot value. Used if not set by the constructor."""
@@ -73,6 +77,17 @@ Might be monkey-patched in the calling test module.
 
 LF = '\n'
 
+GRBL_RX_BUFFER_SIZE = 127
+"""Usable size of GRBL's serial receive buffer, in bytes."""
+
+GRBL_PLANNER_BLOCKS = 16
+"""Number of motion blocks GRBL's planner can queue (15-18, depending on version and build)."""
+
+GRBL_REALTIME_COMMANDS = '?!~\x18'
+"""Characters GRBL acts on immediately instead of placing in its receive buffer."""
+
+GRBL_WELCOME = "\r\nGrbl 1.1f ['$' for help]\r\n"
+
 class Serial():
     """Dummy (mock) serial port for testing purposes.
 
@@ -248,3 +263,635 @@ def _print_out( inputstring ):
     """Print the inputstring. To make it compatible with Python2 and Python3."""
     sys.stdout.write(inputstring + '\n')
 
+
+class RealClock(object):
+    """Wall-clock time, for running a :class:`GrblSimulator` in real time."""
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(object):
+    """A clock that only advances when something sleeps on it.
+
+    A blocking read on a :class:`GrblSimulator` that uses a VirtualClock jumps straight to the
+    moment its answer would arrive, so an hours-long job can be simulated in seconds. Only one
+    thread should use the simulator when running in virtual time.
+
+    Args:
+        * start (float): initial time, in seconds.
+
+    """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class _GcodeState(object):
+    """Modal state needed to turn G-code lines into motion: position, distance mode, feed rate."""
+
+    def __init__(self):
+        self.position = (0.0, 0.0, 0.0)
+        self.absolute = True
+        self.feed = None        # mm/min
+        self.motion = 'G0'
+
+
+class _Block(object):
+    """One planned move."""
+
+    __slots__ = ('start', 'target', 'distance', 'unit', 'nominal_speed',
+                 'start_time', 'end_time', 'entry_speed', 'exit_speed', 'remaining', 'held_at')
+
+    def __init__(self, start, target, nominal_speed):
+        self.start = start
+        self.target = target
+        delta = [t - s for s, t in zip(start, target)]
+        self.distance = math.sqrt(sum(d * d for d in delta))
+        self.unit = tuple(d / self.distance for d in delta)
+        self.nominal_speed = nominal_speed  # mm/s
+        self.start_time = None
+        self.end_time = None
+        self.entry_speed = 0.0
+        self.exit_speed = 0.0
+        self.remaining = None   # seconds left when paused by a feed hold
+        self.held_at = None
+
+
+_WORD_RE = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)')
+_COMMENT_RE = re.compile(r'\([^)]*\)|;.*$')
+
+_GRBL_WORDS = 'FGIJKLMNPRSTXYZ'
+
+_MOVE, _DWELL, _OK, _ERROR, _UNLOCK = ('move', 'dwell', 'ok', 'error', 'unlock')
+
+
+class GrblSimulator(Serial):
+    """Simulated GRBL controller with realistic timing, for testing throughput and flow control.
+
+    Unlike :class:`Serial`, which answers every write immediately, this models:
+
+        * the serial line: each byte takes 10 bits at ``baudrate`` in either direction,
+        * GRBL's 127-byte receive buffer (overflowing bytes are dropped and counted),
+        * the planner queue: a line is only acknowledged with ``ok`` once its move fits in
+          the ``planner_size``-block queue,
+        * motion time: trapezoidal moves using ``acceleration``, feed rate (capped at
+          ``max_rate``) and junction deviation between consecutive blocks. A block's exit
+          speed is chosen from whatever is queued behind it while it runs, so a planner that
+          runs dry forces the machine to stop,
+        * ``G4`` dwells (P in seconds, as GRBL reads it), which wait for the planner to empty,
+          while arcs are approximated as straight moves,
+        * the real-time commands ``?`` (status report), ``!`` (feed hold), ``~`` (cycle
+          start) and Ctrl-X (soft reset).
+
+    Time comes from ``clock``, a :class:`RealClock` by default. Pass a :class:`VirtualClock`
+    to run a job as fast as the host can stream it: blocking reads advance the clock instead
+    of sleeping.
+
+    Statistics are kept in ``bytes_received``, ``lines_processed``, ``rx_overflows``,
+    ``max_rx_used``, ``planner_starvations`` (times motion stopped because the planner ran dry
+    and then had to restart) and ``motion_time`` (seconds spent moving).
+
+    Args:
+        * port, baudrate, timeout: as for :class:`Serial`.
+        * clock: :class:`RealClock` or :class:`VirtualClock`.
+        * rx_buffer_size (int): receive buffer size in bytes.
+        * planner_size (int): number of planner blocks.
+        * acceleration (float): mm/s^2.
+        * max_rate (float): maximum feed rate in mm/min, also used for G0 moves.
+        * junction_deviation (float): mm, as GRBL's $11 setting.
+        * default_feed_rate (float): feed rate in mm/min for G1 moves before any F word.
+          If None, such moves get ``error:22`` (undefined feed rate), as on real hardware.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.clock = kwargs.pop('clock', None) or RealClock()
+        self.rx_buffer_size = kwargs.pop('rx_buffer_size', GRBL_RX_BUFFER_SIZE)
+        self.planner_size = kwargs.pop('planner_size', GRBL_PLANNER_BLOCKS)
+        self.acceleration = float(kwargs.pop('acceleration', 500.0))
+        self.max_rate = float(kwargs.pop('max_rate', 5000.0))
+        self.junction_deviation = float(kwargs.pop('junction_deviation', 0.01))
+        self.default_feed_rate = kwargs.pop('default_feed_rate', None)
+        kwargs.setdefault('port', 'grbl_simulator')
+        Serial.__init__(self, *args, **kwargs)
+
+        self.byte_time = 10.0 / self.baudrate   # 8N1: start + 8 data + stop bits
+        self._lock = threading.RLock()
+        self._incoming = deque()    # [start_time, data, chars_received] per host write
+        self._wire_free_at = 0.0    # when the last host byte finishes arriving
+        self._outgoing = deque()    # (available_time, text) responses on their way back
+        self._out_free_at = 0.0
+        # Times inside the simulator are seconds since it was made. Epoch times (~1.7e9 s) are
+        # too coarse to place individual bytes at high baud rates
+        self._epoch = self.clock.time()
+        self._now = 0.0
+        self._state = _GcodeState()
+        self._machine_position = self._state.position
+        self._planner = deque()
+        self._held = False
+        self._alarm = False
+        self.reset_statistics()
+        self._soft_reset(self._now)
+
+    def reset_statistics(self):
+        """Zero all the statistics counters."""
+        self.bytes_received = 0
+        self.lines_processed = 0
+        self.rx_overflows = 0
+        self.max_rx_used = 0
+        self.planner_starvations = 0
+        self.motion_time = 0.0
+
+    # Host-facing serial port interface
+
+    def write(self, inputdata):
+        """Send data to the simulated GRBL. It arrives over time, one byte per ``byte_time``."""
+        if VERBOSE:
+            _print_out('\nWriting to GrblSimulator. Given:' + repr(inputdata) + '\n')
+        if sys.version_info[0] > 2:
+            if not type(inputdata) == bytes:
+                raise TypeError('The input must be type bytes. Given:' + repr(inputdata))
+            inputstring = str(inputdata, encoding='latin1')
+        else:
+            inputstring = inputdata
+
+        with self._lock:
+            if not self._isOpen:
+                raise IOError('Trying to write to GrblSimulator, but the port is not open.')
+            now = self._update()
+            self._latestWrite = inputstring
+            start = max(now, self._wire_free_at)
+            self._incoming.append([start, inputstring, 0])
+            self._wire_free_at = start + len(inputstring) * self.byte_time
+            return len(inputstring)
+
+    def inWaiting(self):
+        with self._lock:
+            self._update()
+            return len(self.readBuffer)
+
+    def flushInput(self):
+        with self._lock:
+            self._update()
+            self.readBuffer = ''
+
+    def read(self, numberOfBytes=1):
+        """Read up to numberOfBytes, waiting up to ``timeout`` for them to arrive."""
+        with self._lock:
+            self._wait_for(lambda: len(self.readBuffer) >= numberOfBytes)
+            returnstring = self.readBuffer[:numberOfBytes]
+            self.readBuffer = self.readBuffer[numberOfBytes:]
+        return self._to_bytes(returnstring)
+
+    def readline(self, size=None, eol=LF):
+        """Read up to and including eol, or whatever has arrived when ``timeout`` expires."""
+        with self._lock:
+            self._wait_for(lambda: eol in self.readBuffer)
+            end = self.readBuffer.find(eol)
+            end = len(self.readBuffer) if end < 0 else end + len(eol)
+            if size is not None:
+                end = min(end, size)
+            returnstring = self.readBuffer[:end]
+            self.readBuffer = self.readBuffer[end:]
+        return self._to_bytes(returnstring)
+
+    def _to_bytes(self, returnstring):
+        if sys.version_info[0] > 2:
+            return bytes(returnstring, encoding='latin1')
+        return returnstring
+
+    def _wait_for(self, condition):
+        """Advance time until condition() holds or the timeout expires. Call with the lock held."""
+        now = self._update()
+        deadline = None if self.timeout is None else now + self.timeout
+        while not condition():
+            next_time = self._next_output_time()
+            if next_time is None and deadline is None:
+                return  # Nothing will ever arrive
+            target = deadline if next_time is None else next_time
+            if deadline is not None:
+                target = min(target, deadline)
+            if target > now:
+                # Let other threads (e.g. a status poller) write while we wait
+                self._lock.release()
+                try:
+                    self.clock.sleep(target - now)
+                finally:
+                    self._lock.acquire()
+            now = self._update(target)
+            if deadline is not None and now >= deadline and not condition():
+                return
+
+    def _update(self, slept_until=0.0):
+        """Run the simulation up to the clock's current time and collect any output.
+
+        slept_until is a time the caller has just slept until. The simulation gets there even
+        if the clock can't show the difference, as a clock reading epoch seconds can't for
+        the shortest sleeps.
+
+        """
+        now = max(self.clock.time() - self._epoch, self._now, slept_until)
+        self._advance(now)
+        while self._outgoing and self._outgoing[0][0] <= now:
+            self.readBuffer += self._outgoing.popleft()[1]
+        return now
+
+    def _next_output_time(self):
+        """Earliest time at which more output could become available."""
+        times = [self._outgoing[0][0]] if self._outgoing else []
+        event = self._next_event_time()
+        if event is not None:
+            times.append(event)
+        return min(times) if times else None
+
+    # Simulation
+
+    def _advance(self, until):
+        while True:
+            event = self._next_event_time()
+            if event is None or event > until:
+                break
+            self._now = max(self._now, event)
+            self._process_events(self._now)
+        self._receive(until)
+        self._now = until
+
+    def _next_event_time(self):
+        times = []
+        if self._incoming:
+            # The next line ending or real-time character, or the end of this write
+            start, data, pos = self._incoming[0]
+            end = len(data) - 1
+            for i in range(pos, len(data)):
+                c = data[i]
+                if c in '\r\n' or c in GRBL_REALTIME_COMMANDS:
+                    end = i
+                    break
+            times.append(start + (end + 1) * self.byte_time)
+        if self._planner and self._planner[0].end_time is not None:
+            times.append(self._planner[0].end_time)
+        if self._dwell_end is not None:
+            times.append(self._dwell_end)
+        return min(times) if times else None
+
+    def _process_events(self, t):
+        if self._planner and self._planner[0].end_time is not None and self._planner[0].end_time <= t:
+            self._complete_block(self._planner[0].end_time)
+        if self._dwell_end is not None and self._dwell_end <= t:
+            self._dwell_end = None
+        self._receive(t)
+        self._service_parser(t)
+
+    def _receive(self, t):
+        """Move every byte that has finished arriving by time t into the receive buffer."""
+        while self._incoming:
+            chunk = self._incoming[0]
+            start, data, pos = chunk
+            arrived = min(len(data), int((t - start) / self.byte_time + 1e-6))
+            if arrived <= pos:
+                return
+            segment = data[pos:arrived]
+            chunk[2] = arrived
+            self.bytes_received += len(segment)
+            plain = not any(c in segment for c in GRBL_REALTIME_COMMANDS)
+            if plain and len(self._rx) + len(segment) <= self.rx_buffer_size:
+                self._rx += segment
+            else:
+                for i, c in enumerate(segment):
+                    if c in GRBL_REALTIME_COMMANDS:
+                        self._realtime(c, start + (pos + i + 1) * self.byte_time)
+                    elif len(self._rx) < self.rx_buffer_size:
+                        self._rx += c
+                    else:
+                        self.rx_overflows += 1
+            self.max_rx_used = max(self.max_rx_used, len(self._rx))
+            if arrived < len(data):
+                return
+            self._incoming.popleft()
+
+    def _send(self, text, t):
+        start = max(t, self._out_free_at)
+        self._out_free_at = start + len(text) * self.byte_time
+        self._outgoing.append((self._out_free_at, text))
+
+    def _realtime(self, c, t):
+        if c == '?':
+            self._send(self.status_report(t), t)
+        elif c == '!':
+            if not self._held:
+                self._held = True
+                head = self._planner[0] if self._planner else None
+                if head is not None and head.end_time is not None:
+                    head.remaining = head.end_time - t
+                    head.held_at = t
+                    head.end_time = None
+        elif c == '~':
+            if self._held:
+                self._held = False
+                if self._planner:
+                    head = self._planner[0]
+                    if head.remaining is not None:
+                        head.start_time += t - head.held_at
+                        head.end_time = t + head.remaining
+                        head.remaining = head.held_at = None
+                    elif head.end_time is None:
+                        self._start_block(head, t)
+        elif c == '\x18':
+            self._soft_reset(t)
+
+    def _soft_reset(self, t):
+        if self._planner and not self._held:
+            # Position is lost when reset mid-move, so GRBL locks itself until unlocked ($X)
+            self._alarm = True
+        self._machine_position = self.position(t)
+        self._state.position = self._machine_position
+        self._rx = ''
+        self._pending = None
+        self._planner = deque()
+        self._dwell_end = None
+        self._held = False
+        self._starved = False
+        self._planned_position = self._machine_position
+        self._send(GRBL_WELCOME, t)
+        if self._alarm:
+            self._send("ALARM:3\r\n", t)
+
+    def _service_parser(self, t):
+        """Execute lines from the receive buffer for as long as nothing blocks."""
+        while self._dwell_end is None:
+            if self._pending is None:
+                end = -1
+                for eol in '\r\n':
+                    i = self._rx.find(eol)
+                    if i >= 0 and (end < 0 or i < end):
+                        end = i
+                if end < 0:
+                    return
+                line = self._rx[:end]
+                self._rx = self._rx[end + 1:]
+                self._pending = self._parse_line(line, self._state)
+                if self._alarm and self._pending[0] in (_MOVE, _DWELL):
+                    self._pending = (_ERROR, 'error:9')
+
+            kind = self._pending[0]
+            if kind == _MOVE:
+                if len(self._planner) >= self.planner_size:
+                    return
+                self._plan_block(self._pending[1], self._pending[2], t)
+            elif kind == _DWELL:
+                if self._planner:
+                    return
+                self._dwell_end = t + self._pending[1]
+                self._starved = False
+            elif kind == _UNLOCK:
+                self._alarm = False
+
+            if kind == _ERROR:
+                self._send(self._pending[1] + '\r\n', t)
+            else:
+                self._send('ok\r\n', t)
+            self.lines_processed += 1
+            self._pending = None
+
+    def _parse_line(self, line, state):
+        """Turn one line into (_MOVE, target, speed), (_DWELL, seconds), (_OK,) or (_ERROR, msg).
+
+        Updates state as a side effect.
+
+        """
+        line = _COMMENT_RE.sub('', line).strip().upper()
+        if line == '$X':
+            return (_UNLOCK,)
+        if not line or line.startswith('$'):
+            return (_OK,)
+        words = _WORD_RE.findall(line)
+        axes = {}
+        dwell = None
+        for letter, value in words:
+            try:
+                number = float(value)
+            except ValueError:
+                return (_ERROR, 'error:2')
+            if letter not in _GRBL_WORDS:
+                return (_ERROR, 'error:20')
+            if letter == 'G':
+                code = int(number)
+                if code in (0, 1):
+                    state.motion = 'G%d' % code
+                elif code == 4:
+                    dwell = 0.0
+                elif code == 90:
+                    state.absolute = True
+                elif code == 91:
+                    state.absolute = False
+            elif letter in 'XYZ':
+                axes['XYZ'.index(letter)] = number
+            elif letter == 'F':
+                state.feed = number
+            elif letter == 'P' and dwell is not None:
+                dwell = number
+
+        if dwell is not None:
+            return (_DWELL, dwell)
+        if not axes:
+            return (_OK,)
+
+        target = list(state.position)
+        for axis, value in axes.items():
+            target[axis] = value if state.absolute else target[axis] + value
+        target = tuple(target)
+
+        if state.motion == 'G0':
+            rate = self.max_rate
+        else:
+            rate = state.feed or self.default_feed_rate
+            if not rate:
+                return (_ERROR, 'error:22')
+            rate = min(rate, self.max_rate)
+        if target == state.position:
+            return (_OK,)
+        state.position = target
+        return (_MOVE, target, rate / 60.0)
+
+    def _junction_speed(self, block, next_block):
+        """Fastest speed at which the machine can pass from block to next_block (GRBL's method)."""
+        cos_theta = -sum(a * b for a, b in zip(block.unit, next_block.unit))
+        if cos_theta > 0.999999:
+            return 0.0  # Reversal
+        limit = min(block.nominal_speed, next_block.nominal_speed)
+        if cos_theta < -0.999999:
+            return limit  # Straight on
+        sin_theta_d2 = math.sqrt(0.5 * (1.0 - cos_theta))
+        speed = math.sqrt(self.acceleration * self.junction_deviation * sin_theta_d2 /
+                          (1.0 - sin_theta_d2))
+        return min(speed, limit)
+
+    def _move_time(self, distance, entry, exit_, nominal):
+        """Duration of a trapezoidal move from entry to exit speed, cruising at up to nominal."""
+        a = self.acceleration
+        exit_ = min(exit_, math.sqrt(entry * entry + 2 * a * distance))
+        accel_dist = (nominal * nominal - entry * entry) / (2 * a)
+        decel_dist = (nominal * nominal - exit_ * exit_) / (2 * a)
+        if accel_dist + decel_dist <= distance:
+            return ((nominal - entry) / a + (nominal - exit_) / a +
+                    (distance - accel_dist - decel_dist) / nominal)
+        peak = math.sqrt(max(entry * entry, exit_ * exit_,
+                             (2 * a * distance + entry * entry + exit_ * exit_) / 2))
+        return (peak - entry) / a + (peak - exit_) / a
+
+    def _exit_speed(self, block, next_block, is_last):
+        if next_block is None:
+            return 0.0
+        speed = self._junction_speed(block, next_block)
+        if is_last:
+            # The next block must still be able to stop within its own length
+            speed = min(speed, math.sqrt(2 * self.acceleration * next_block.distance))
+        return min(speed, math.sqrt(block.entry_speed ** 2 + 2 * self.acceleration * block.distance))
+
+    def _schedule(self, block, t):
+        next_block = self._planner[1] if len(self._planner) > 1 else None
+        block.exit_speed = self._exit_speed(block, next_block, len(self._planner) == 2)
+        block.end_time = t + self._move_time(block.distance, block.entry_speed,
+                                             block.exit_speed, block.nominal_speed)
+
+    def _plan_block(self, target, speed, t):
+        block = _Block(self._planned_position, target, speed)
+        self._planned_position = target
+        self._planner.append(block)
+        if len(self._planner) == 1:
+            if self._starved:
+                self.planner_starvations += 1
+                self._starved = False
+            if not self._held:
+                self._start_block(block, t)
+        elif len(self._planner) == 2 and self._planner[0].end_time is not None:
+            # The running block was heading for a stop; now it can carry on into this one
+            head = self._planner[0]
+            self._schedule(head, head.start_time)
+            head.end_time = max(head.end_time, t)
+
+    def _start_block(self, block, t):
+        block.start_time = t
+        self._schedule(block, t)
+
+    def _complete_block(self, t):
+        block = self._planner.popleft()
+        self.motion_time += t - block.start_time
+        self._machine_position = block.target
+        if self._planner:
+            head = self._planner[0]
+            head.entry_speed = block.exit_speed
+            if not self._held:
+                self._start_block(head, t)
+        else:
+            self._starved = True
+
+    def is_idle(self):
+        """True once everything sent has been received, executed and finished moving."""
+        with self._lock:
+            self._update()
+            return not (self._incoming or self._rx.strip() or self._pending or
+                        self._planner or self._dwell_end is not None)
+
+    def wait_until_idle(self):
+        """Let the simulated machine finish all queued work. Returns the clock time it became idle."""
+        with self._lock:
+            slept_until = 0.0
+            while True:
+                now = self._update(slept_until)
+                event = self._next_event_time()
+                if event is None or self._held:
+                    return self._epoch + now
+                self._lock.release()
+                try:
+                    self.clock.sleep(max(0.0, event - now))
+                finally:
+                    self._lock.acquire()
+                slept_until = event
+
+    def position(self, t=None):
+        """Machine position (x, y, z) at time t, interpolating through the running move.
+
+        Times are in seconds since the simulator was made.
+
+        """
+        t = self._now if t is None else t
+        if self._planner:
+            head = self._planner[0]
+            if head.start_time is not None:
+                end = head.end_time
+                if end is None:
+                    # Held: frozen where the hold began
+                    t = head.held_at
+                    end = t + head.remaining
+                span = end - head.start_time
+                frac = 1.0 if span <= 0 else min(1.0, max(0.0, (t - head.start_time) / span))
+                return tuple(s + (e - s) * frac for s, e in zip(head.start, head.target))
+            return head.start
+        return self._machine_position
+
+    def status_report(self, t=None):
+        """A GRBL 1.1 style status report, e.g. ``<Run|MPos:1.000,2.000,0.000|FS:500,0>``."""
+        if self._alarm:
+            state = 'Alarm'
+        elif self._held:
+            state = 'Hold:0'
+        elif self._planner or self._dwell_end is not None:
+            state = 'Run'
+        else:
+            state = 'Idle'
+        feed = 0
+        if self._planner and self._planner[0].end_time is not None:
+            feed = self._planner[0].nominal_speed * 60
+        return '<%s|MPos:%.3f,%.3f,%.3f|FS:%d,0>\r\n' % ((state,) + self.position(t) + (feed,))
+
+    def ideal_motion_time(self, gcode_lines):
+        """Time the given lines would take with perfect look-ahead and a planner that never starves.
+
+        Uses the same kinematics as the simulation, so comparing this with the wall time of a
+        streamed job shows how much time flow control cost.
+
+        """
+        state = _GcodeState()
+        position = state.position
+        total = 0.0
+        blocks = []
+        for line in gcode_lines:
+            action = self._parse_line(line, state)
+            if action[0] == _MOVE:
+                blocks.append(_Block(position, action[1], action[2]))
+                position = action[1]
+            elif action[0] == _DWELL:
+                # Dwells wait for the planner to empty, so motion stops on either side
+                total += self._plan_time(blocks) + action[1]
+                blocks = []
+        return total + self._plan_time(blocks)
+
+    def _plan_time(self, blocks):
+        """Total time for a run of blocks that starts and ends at rest, with full look-ahead."""
+        if not blocks:
+            return 0.0
+        a = self.acceleration
+        n = len(blocks)
+        # Highest speed allowed at each junction; index i is the entry to block i
+        limits = [0.0] + [self._junction_speed(blocks[i], blocks[i + 1]) for i in range(n - 1)] + [0.0]
+        # Backward pass: must be able to slow down for everything ahead
+        for i in range(n - 1, -1, -1):
+            limits[i] = min(limits[i], math.sqrt(limits[i + 1] ** 2 + 2 * a * blocks[i].distance))
+        # Forward pass: must be able to reach each speed from the one before
+        for i in range(n):
+            limits[i + 1] = min(limits[i + 1], math.sqrt(limits[i] ** 2 + 2 * a * blocks[i].distance))
+        return sum(self._move_time(b.distance, limits[i], limits[i + 1], b.nominal_speed)
+                   for i, b in enumerate(blocks))
@@ -0,0 +1,562 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Preview drawing: turn a gcode model into things a Tk Canvas draws quickly.
+#
+# Drawing one canvas line per segment makes hundreds of thousands of canvas
+# items for a raster job, which Tk can't cope with.  Instead:
+#
+# preview_polylines() merges consecutive drawing segments of the same
+# colour into polylines, one canvas item each.  Points less than a pixel
+# from the last one kept are dropped, and segments entirely off one side
+# of the viewport are left out.
+#
+# preview_image() draws a whole job into one PIL image, to be shown as a
+# single PhotoImage, for jobs too dense for polylines (rasters, mostly).
+# If numpy is installed, every segment is drawn at once from the model's
+# columns, and each pixel is the average of the burns that cross it;
+# otherwise the polylines are drawn into the image one at a time.
+#
+# For zooming and panning, a pyramid is built once per model, with the
+# job at several levels of detail; each view is then drawn from the level
+# that suits its scale, and only what's inside it is drawn.  A
+# PolylinePyramid keeps the job's polylines, in mm, simplified more at each
+# level.  An ImagePyramid (for dense jobs, with numpy) keeps images of the
+# job, each half the size of the one before, and the segments themselves
+# for views closer than its finest image.
+#
+# PreviewThread does all of this (and loading the model, if asked) off
+# the Tk thread, handing the preview over in pieces as it goes, so the
+# canvas fills in progressively and the window stays responsive.
+#
+# A Viewport says where the preview is: how many canvas pixels to a mm,
+# which point of the job is at the canvas' lower left, and the canvas
+# size.  Gcode has its origin at lower left, the canvas at upper left.
+from __future__ import division
+
+import math
+import threading
+import Queue
+
+from PIL import Image, ImageDraw
+
+from YAGV import gcodeParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# More polylines than this and a job is drawn as an image instead
+MAX_CANVAS_ITEMS = 20000
+
+# Segment styles that burn, and are drawn
+DRAW_STYLES = (gcodeParser.DRAW, gcodeParser.EXTRUDE)
+
+# A coarse image is drawn this many times smaller each way, from no more
+# than this many segments
+COARSE_FACTOR = 4
+COARSE_MAX_SEGMENTS = 100000
+
+# An ImagePyramid's finest image is this many pixels on its long side, and
+# its coarsest no more than PYRAMID_MIN_SIZE.  A PolylinePyramid's levels
+# drop points closer together than the job's size over PYRAMID_MAX_SIZE,
+# then twice that, and so on up to its size over PYRAMID_MIN_SIZE.
+PYRAMID_MAX_SIZE = 2048
+PYRAMID_MIN_SIZE = 64
+
+# Events a PreviewThread puts on its queue
+PREVIEW_MODEL, PREVIEW_PYRAMID, PREVIEW_LINES, PREVIEW_IMAGE, PREVIEW_DONE, PREVIEW_FAILED = (
+                "Model", "Pyramid", "Lines", "Image", "Done", "Failed")
+
+# Polylines per PREVIEW_LINES event.  The first is small, so something
+# shows at once
+FIRST_CHUNK_ITEMS = 200
+CHUNK_ITEMS = 1000
+
+class Viewport( object):
+    def __init__( self, width, height, scale=1.0, origin=(0.0, 0.0)):
+        # width and height in canvas pixels; scale in pixels per mm;
+        # origin is the job point (mm) at the canvas' lower left
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.origin = origin
+
+    def to_canvas( self, x, y):
+        return ((x - self.origin[0]) * self.scale,
+                self.height - (y - self.origin[1]) * self.scale)
+
+    def to_job( self, canvas_x, canvas_y):
+        return (self.origin[0] + canvas_x / self.scale,
+                self.origin[1] + (self.height - canvas_y) / self.scale)
+
+    def box( self):
+        # (xmin, ymin, xmax, ymax) of the job area in view, in mm
+        return (self.origin[0], self.origin[1],
+                self.origin[0] + self.width / self.scale,
+                self.origin[1] + self.height / self.scale)
+
+def power_gray( power):
+    # Full power (255) burns black, no power leaves white
+    return 255 - int( round( min( max( power or 0, 0), 255)))
+
+def power_color( power):
+    gray = power_gray( power)
+    return "#%02x%02x%02x"%(gray, gray, gray)
+
+def preview_polylines( points, viewport=None, min_step=1.0, start=(0.0, 0.0)):
+    # Yields (color, coords) for each polyline in the points from a model's
+    # previewPoints(), coords being the flat [x0, y0, x1, y1, ...] list
+    # Canvas.create_line() takes.  The first segment starts from start, in
+    # mm.  Points closer than min_step pixels (in both X and Y) to the 
+    # last one kept are skipped, but each polyline still ends where its 
+    # last segment does.  With no viewport, coords are in mm, Y up, and 
+    # nothing is left out for being out of view.
+    if viewport is None:
+        scale_x, scale_y, offset_x, offset_y = 1.0, 1.0, 0.0, 0.0
+        left = top = float( '-inf')
+        right = bottom = float( 'inf')
+    else:
+        ox, oy = viewport.origin
+        scale_x, scale_y = viewport.scale, -viewport.scale
+        offset_x, offset_y = -ox * viewport.scale, viewport.height + oy * viewport.scale
+        left = top = 0
+        right, bottom = viewport.width, viewport.height
+
+    color = power_color( 0)
+    coords = None
+    skipped = None
+    last_x, last_y = start[0] * scale_x + offset_x, start[1] * scale_y + offset_y
+    for style, x, y, power in points:
+        if power is not None:
+            new_color = power_color( power)
+            if new_color != color:
+                if coords:
+                    if skipped:
+                        coords.extend( skipped)
+                    yield color, coords
+                coords = skipped = None
+                color = new_color
+        next_x = x * scale_x + offset_x
+        next_y = y * scale_y + offset_y
+
+        if style in DRAW_STYLES:
+            if ((last_x < left and next_x < left) or (last_x > right and next_x > right) or
+                (last_y < top and next_y < top) or (last_y > bottom and next_y > bottom)):
+                # Off the edge of the viewport
+                if coords:
+                    if skipped:
+                        coords.extend( skipped)
+                    yield color, coords
+                coords = skipped = None
+            elif coords is None:
+                coords = [last_x, last_y, next_x, next_y]
+            elif abs( next_x - coords[-2]) < min_step and abs( next_y - coords[-1]) < min_step:
+                skipped = (next_x, next_y)
+            else:
+                coords.append( next_x)
+                coords.append( next_y)
+                skipped = None
+        elif coords:
+            if skipped:
+                coords.extend( skipped)
+            yield color, coords
+            coords = skipped = None
+        last_x, last_y = next_x, next_y
+
+    if coords:
+        if skipped:
+            coords.extend( skipped)
+        yield color, coords
+
+def progress_polylines( gcode_model, start, stop, viewport, max_items=None):
+    # Canvas coords of polylines covering what segments start up to stop 
+    # of gcode_model draw, at any power, and the job point (mm) the last
+    # segment ends at, for marking a running job's progress; or ([], None)
+    # if there are no segments in the range.  Nothing's left out for being
+    # out of view, so the polylines can be panned and zoomed.  If that
+    # would be more than max_items polylines (a raster, say), it's one 
+    # polyline following every segment, moves included, instead.
+    if start >= stop:
+        return [], None
+    points = list( gcode_model.previewPoints( max( start - 1, 0), stop))
+    if not points:
+        return [], None
+    first = (0.0, 0.0)
+    if start:
+        first = points[0][1:3]
+        points = points[1:]
+    # All at one power, so polylines don't break where it changes
+    points = [(style, x, y, None) for style, x, y, power in points]
+    polylines = [coords for color, coords in preview_polylines( points, min_step=0, start=first)]
+    if max_items is not None and len( polylines) > max_items:
+        polylines = [list( first)]
+        for style, x, y, power in points:
+            polylines[0].append( x)
+            polylines[0].append( y)
+    pixel = 1.0 / viewport.scale
+    return ([canvas_coords( simplify_coords( coords, pixel), viewport) for coords in polylines],
+            points[-1][1:3])
+
+def polyline_box( coords):
+    # (xmin, ymin, xmax, ymax) of a flat coords list
+    xs, ys = coords[0::2], coords[1::2]
+    return (min( xs), min( ys), max( xs), max( ys))
+
+def boxes_meet( a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def simplify_coords( coords, min_step):
+    # coords without the points closer than min_step (in both X and Y) to
+    # the last one kept.  The first and last points are always kept.
+    kept = coords[:2]
+    for i in xrange( 2, len( coords) - 2, 2):
+        x, y = coords[i], coords[i + 1]
+        if abs( x - kept[-2]) >= min_step or abs( y - kept[-1]) >= min_step:
+            kept.append( x)
+            kept.append( y)
+    kept.extend( coords[-2:])
+    return kept
+
+def canvas_coords( coords, viewport):
+    # coords in mm, as viewport's canvas coords
+    ox, oy = viewport.origin
+    scale, height = viewport.scale, viewport.height
+    result = [0.0] * len( coords)
+    result[0::2] = [(x - ox) * scale for x in coords[0::2]]
+    result[1::2] = [height - (y - oy) * scale for y in coords[1::2]]
+    return result
+
+def preview_image( gcode_model, viewport, background=(255, 255, 255)):
+    # An RGB image the size of the viewport with gcode_model drawn on
+    # background
+    if numpy is not None:
+        return preview_image_numpy( gcode_model, viewport, background)
+    im = Image.new( "RGB", (int( viewport.width), int( viewport.height)), background)
+    draw = ImageDraw.Draw( im)
+    for color, coords in preview_polylines( gcode_model.previewPoints(), viewport):
+        draw.line( coords, fill=color)
+    return im
+
+def preview_columns( gcode_model):
+    # numpy arrays of X, Y and S for each segment, and whether it draws
+    if hasattr( gcode_model, 'columns'):
+        X = numpy.frombuffer( gcode_model.columns["X"], dtype=numpy.float64)
+        Y = numpy.frombuffer( gcode_model.columns["Y"], dtype=numpy.float64)
+        S = numpy.frombuffer( gcode_model.columns["S"], dtype=numpy.float64)
+        styles = numpy.frombuffer( gcode_model.styleIdx, dtype=numpy.uint8)
+        draw_styles = [gcodeParser.STYLES.index( style) for style in DRAW_STYLES]
+        return X, Y, S, numpy.in1d( styles, draw_styles)
+
+    points = list( gcode_model.previewPoints())
+    X = numpy.array( [x for style, x, y, power in points], dtype=numpy.float64)
+    Y = numpy.array( [y for style, x, y, power in points], dtype=numpy.float64)
+    S = numpy.array( [numpy.nan if power is None else power
+                        for style, x, y, power in points], dtype=numpy.float64)
+    draws = numpy.array( [style in DRAW_STYLES for style, x, y, power in points], dtype=bool)
+    return X, Y, S, draws
+
+def job_segments( gcode_model):
+    # numpy arrays of (x0, y0, x1, y1, power) for each segment that draws,
+    # in mm
+    X, Y, S, draws = preview_columns( gcode_model)
+
+    # The power each segment is made at: the last S given, on it or before it
+    given = ~numpy.isnan( S)
+    last_given = numpy.maximum.accumulate( numpy.where( given, numpy.arange( len( S)), -1))
+    powers = numpy.where( last_given >= 0, S[numpy.maximum( last_given, 0)], 0.0)
+
+    X0 = numpy.concatenate( ([0.0], X[:-1]))
+    Y0 = numpy.concatenate( ([0.0], Y[:-1]))
+    return X0[draws], Y0[draws], X[draws], Y[draws], powers[draws]
+
+def viewport_segments( segments, viewport):
+    # segments from job_segments(), in viewport's canvas pixels, leaving
+    # out those entirely on one side of it
+    X0, Y0, X1, Y1, powers = segments
+    ox, oy = viewport.origin
+    width, height, scale = viewport.width, viewport.height, viewport.scale
+    x0, x1 = (X0 - ox) * scale, (X1 - ox) * scale
+    y0, y1 = height - (Y0 - oy) * scale, height - (Y1 - oy) * scale
+    on_screen = ~(((x0 < 0) & (x1 < 0)) | ((x0 >= width) & (x1 >= width)) |
+                  ((y0 < 0) & (y1 < 0)) | ((y0 >= height) & (y1 >= height)))
+    return x0[on_screen], y0[on_screen], x1[on_screen], y1[on_screen], powers[on_screen]
+
+def preview_segments( gcode_model, viewport):
+    # numpy arrays of (x0, y0, x1, y1, power) for each segment that draws
+    # in the viewport, in canvas pixels
+    return viewport_segments( job_segments( gcode_model), viewport)
+
+def segment_pixels( segments, width, height):
+    # For each pixel of a width x height image, flattened: the total gray
+    # of the points of segments drawn in it, and how many there were
+    x0, y0, x1, y1, powers = segments
+
+    # Points along each segment, no more than a pixel apart
+    samples = (numpy.ceil( numpy.maximum( abs( x1 - x0), abs( y1 - y0))) + 1).astype( numpy.intp)
+    segment = numpy.repeat( numpy.arange( len( samples)), samples)
+    step = numpy.arange( samples.sum()) - numpy.repeat( numpy.cumsum( samples) - samples, samples)
+    t = step / numpy.maximum( samples - 1, 1)[segment]
+    xs = numpy.floor( x0[segment] + (x1 - x0)[segment] * t).astype( numpy.intp)
+    ys = numpy.floor( y0[segment] + (y1 - y0)[segment] * t).astype( numpy.intp)
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    pixel = ys[inside] * width + xs[inside]
+
+    grays = 255 - numpy.clip( numpy.round( powers), 0, 255)
+    counts = numpy.bincount( pixel, minlength=width * height)
+    totals = numpy.bincount( pixel, weights=grays[segment[inside]], minlength=width * height)
+    return totals, counts
+
+def draw_segments( segments, width, height, background=(255, 255, 255)):
+    # An RGB image of segments, as from preview_segments().  Each pixel is
+    # the average gray of the points drawn in it.
+    totals, counts = segment_pixels( segments, width, height)
+    drawn = counts > 0
+    pixels = numpy.empty( (width * height, 3), dtype=numpy.uint8)
+    pixels[:] = background
+    pixels[drawn] = numpy.round( totals[drawn] / counts[drawn])[:, numpy.newaxis]
+    return Image.fromarray( pixels.reshape( height, width, 3), "RGB")
+
+def preview_image_numpy( gcode_model, viewport, background=(255, 255, 255)):
+    return draw_segments( preview_segments( gcode_model, viewport),
+                          int( viewport.width), int( viewport.height), background)
+
+def coarse_preview_image( gcode_model, viewport, background=(255, 255, 255)):
+    # A quick, rough preview_image(): drawn COARSE_FACTOR times smaller
+    # each way, from no more than COARSE_MAX_SEGMENTS of the segments, and
+    # stretched back to size.  Needs numpy.
+    width, height = int( viewport.width), int( viewport.height)
+    coarse = Viewport( max( 1, width // COARSE_FACTOR), max( 1, height // COARSE_FACTOR),
+                       viewport.scale / COARSE_FACTOR, viewport.origin)
+    segments = preview_segments( gcode_model, coarse)
+    stride = len( segments[0]) // COARSE_MAX_SEGMENTS + 1
+    if stride > 1:
+        segments = [column[::stride] for column in segments]
+    im = draw_segments( segments, int( coarse.width), int( coarse.height), background)
+    return im.resize( (width, height), Image.NEAREST)
+
+class PolylinePyramid( object):
+    # A job's polylines (in mm) at several levels of detail.  render()
+    # gives the polylines in a viewport, from the most simplified level
+    # that still has a point every pixel, as (color, coords) in canvas
+    # pixels.
+    kind = PREVIEW_LINES
+
+    def __init__( self, polylines):
+        # polylines are (color, coords) pairs in mm, as from
+        # preview_polylines( points, min_step=0)
+        level = [(color, coords, polyline_box( coords)) for color, coords in polylines]
+        # (min_step in mm, polylines with boxes), finest first
+        self.levels = [(0.0, level)]
+        if not level:
+            return
+        boxes = [box for color, coords, box in level]
+        size = max( max( box[2] for box in boxes) - min( box[0] for box in boxes),
+                    max( box[3] for box in boxes) - min( box[1] for box in boxes))
+        min_step = size / PYRAMID_MAX_SIZE
+        points = sum( len( coords) for color, coords, box in level)
+        while min_step > 0 and min_step <= size / PYRAMID_MIN_SIZE:
+            level = [(color, simplify_coords( coords, min_step), box)
+                        for color, coords, box in level]
+            last_points, points = points, sum( len( coords) for color, coords, box in level)
+            if len( self.levels) > 1 and points * 4 > last_points * 3:
+                # Not much simpler than the last level: this one does instead
+                self.levels[-1] = (min_step, level)
+            else:
+                self.levels.append( (min_step, level))
+            min_step *= 2
+
+    def level( self, viewport):
+        # The most simplified level whose points are a pixel apart or closer
+        pixel = 1.0 / viewport.scale
+        return [level for min_step, level in self.levels if min_step <= pixel][-1]
+
+    def render( self, viewport, background=None):
+        view = viewport.box()
+        return [(color, canvas_coords( coords, viewport))
+                    for color, coords, box in self.level( viewport) if boxes_meet( box, view)]
+
+class ImagePyramid( object):
+    # Images of a job at several levels of detail, for jobs too dense for
+    # polylines; needs numpy.  Each level is a pair of 'L' images:
+    # coverage (how much of each pixel is drawn on, 0-255) and ink (how
+    # dark it is, times coverage).  Both average correctly when shrunk, and
+    # ink over coverage is the average darkness of what's drawn, as
+    # draw_segments() shows it.
+    # render() crops and scales the coarsest level at least as detailed
+    # as the viewport, or, closer in than the finest level, draws the
+    # segments in view.
+    kind = PREVIEW_IMAGE
+
+    def __init__( self, gcode_model):
+        self.segments = job_segments( gcode_model)
+        # (coverage, ink, pixels per mm in X, in Y), finest first
+        self.levels = []
+        X0, Y0, X1, Y1, powers = self.segments
+        if not len( X0):
+            return
+        self.xmin = min( X0.min(), X1.min())
+        ymin = min( Y0.min(), Y1.min())
+        size = max( max( X0.max(), X1.max()) - self.xmin, max( Y0.max(), Y1.max()) - ymin) or 1.0
+        self.scale = PYRAMID_MAX_SIZE / size
+
+        # Level 0: the job's bounding box, a pixel past it each way
+        width = int( math.ceil( (max( X0.max(), X1.max()) - self.xmin) * self.scale)) + 1
+        height = int( math.ceil( (max( Y0.max(), Y1.max()) - ymin) * self.scale)) + 1
+        self.ymax = ymin + height / self.scale
+        viewport = Viewport( width, height, self.scale, (self.xmin, ymin))
+        totals, counts = segment_pixels( viewport_segments( self.segments, viewport), width, height)
+        drawn = counts > 0
+        coverage = numpy.where( drawn, 255, 0).astype( numpy.uint8)
+        ink = numpy.zeros( width * height, dtype=numpy.uint8)
+        ink[drawn] = 255 - numpy.round( totals[drawn] / counts[drawn])
+        coverage = Image.fromarray( coverage.reshape( height, width), "L")
+        ink = Image.fromarray( ink.reshape( height, width), "L")
+        self.levels.append( (coverage, ink, self.scale, self.scale))
+
+        while max( width, height) > PYRAMID_MIN_SIZE:
+            width, height = max( 1, width // 2), max( 1, height // 2)
+            coverage = coverage.resize( (width, height), Image.BOX)
+            ink = ink.resize( (width, height), Image.BOX)
+            self.levels.append( (coverage, ink,
+                                 self.levels[0][2] * width / self.levels[0][0].size[0],
+                                 self.levels[0][3] * height / self.levels[0][0].size[1]))
+
+    def render( self, viewport, background=(255, 255, 255)):
+        width, height = int( viewport.width), int( viewport.height)
+        if not self.levels:
+            return Image.new( "RGB", (width, height), background)
+        if viewport.scale > self.scale:
+            return draw_segments( viewport_segments( self.segments, viewport), width, height,
+                                  background)
+
+        coverage, ink, scale_x, scale_y = [level for level in self.levels
+                                            if level[2] >= viewport.scale][-1]
+        # The view, in the level's pixels, and the part of it on the level
+        xmin, ymin, xmax, ymax = viewport.box()
+        view = ((xmin - self.xmin) * scale_x, (self.ymax - ymax) * scale_y,
+                (xmax - self.xmin) * scale_x, (self.ymax - ymin) * scale_y)
+        part = (max( view[0], 0), max( view[1], 0),
+                min( view[2], coverage.size[0]), min( view[3], coverage.size[1]))
+        pixels = numpy.empty( (height, width, 3), dtype=numpy.uint8)
+        pixels[:] = background
+        # Where that part goes on the canvas
+        left = int( round( (part[0] - view[0]) * viewport.scale / scale_x))
+        top = int( round( (part[1] - view[1]) * viewport.scale / scale_y))
+        right = min( width, int( round( (part[2] - view[0]) * viewport.scale / scale_x)))
+        bottom = min( height, int( round( (part[3] - view[1]) * viewport.scale / scale_y)))
+        if right > left and bottom > top:
+            size = (right - left, bottom - top)
+            alpha = numpy.asarray( coverage.resize( size, Image.BILINEAR, box=part),
+                                   dtype=numpy.float32)
+            dark = numpy.asarray( ink.resize( size, Image.BILINEAR, box=part),
+                                  dtype=numpy.float32)
+            drawn = alpha > 0
+            grays = numpy.clip( numpy.round( 255 - dark[drawn] * 255 / alpha[drawn]), 0, 255)
+            pixels[top:bottom, left:right][drawn] = grays[:, numpy.newaxis]
+        return Image.fromarray( pixels, "RGB")
+
+class ModelPreview( object):
+    # Stands in for an ImagePyramid without numpy: each view is drawn
+    # from the whole model
+    kind = PREVIEW_IMAGE
+
+    def __init__( self, gcode_model):
+        self.gcode_model = gcode_model
+
+    def render( self, viewport, background=(255, 255, 255)):
+        return preview_image( self.gcode_model, viewport, background)
+
+class PreviewThread( threading.Thread):
+    # Works out a preview of gcode_model, or of the model load() returns,
+    # and puts it on self.events in pieces, as (kind, args) pairs:
+    #   (PREVIEW_MODEL, (gcode_model,)) once the model's loaded
+    #   (PREVIEW_PYRAMID, (pyramid,)) once its pyramid is built
+    #   (PREVIEW_LINES, ([(color, coords), ...],)) polylines, in job order
+    #   (PREVIEW_IMAGE, (image,)) for jobs too dense for polylines: a
+    #       coarse image and then a full one, each replacing everything
+    #       shown so far
+    #   (PREVIEW_DONE, ()) or (PREVIEW_FAILED, (message,)) at the end
+    # Given a pyramid from an earlier PreviewThread, only the viewport is
+    # drawn from it, for zooming and panning.  After cancel(), nothing more
+    # is put on the queue.  Loading can't be interrupted, but the thread
+    # stops as soon as it's done.
+    def __init__( self, viewport, gcode_model=None, load=None, background=(255, 255, 255),
+                  pyramid=None):
+        threading.Thread.__init__( self)
+        self.daemon = True
+        self.viewport = viewport
+        self.gcode_model = gcode_model
+        self.load = load
+        self.background = background
+        self.pyramid = pyramid
+        self.events = Queue.Queue()
+        self.cancelled = threading.Event()
+
+    def cancel( self):
+        self.cancelled.set()
+
+    def post( self, kind, *args):
+        if not self.cancelled.is_set():
+            self.events.put( (kind, args))
+
+    def run( self):
+        try:
+            if self.pyramid is None:
+                # An empty model is falsy, but it's still the model to draw
+                gcode_model = self.gcode_model if self.gcode_model is not None else self.load()
+                self.post( PREVIEW_MODEL, gcode_model)
+                self.build( gcode_model)
+            else:
+                self.render()
+        except Exception, e:
+            self.post( PREVIEW_FAILED, str( e))
+            return
+        self.post( PREVIEW_DONE)
+
+    def build( self, gcode_model):
+        # The first few polylines in view go out at once.  The rest are
+        # held until it's clear there aren't too many of them, rather than
+        # drawn and then thrown away for an image.
+        polylines = []
+        sent = 0
+        view = self.viewport.box()
+        for polyline in preview_polylines( gcode_model.previewPoints(), min_step=0):
+            if self.cancelled.is_set():
+                return
+            polylines.append( polyline)
+            if sent < FIRST_CHUNK_ITEMS and boxes_meet( polyline_box( polyline[1]), view):
+                color, coords = polyline
+                self.post( PREVIEW_LINES, [(color, canvas_coords( coords, self.viewport))])
+                sent += 1
+            if len( polylines) > MAX_CANVAS_ITEMS:
+                break
+        else:
+            self.pyramid = PolylinePyramid( polylines)
+            self.post( PREVIEW_PYRAMID, self.pyramid)
+            self.render( skip=sent)
+            return
+        del polylines
+
+        # Too many polylines: the images replace the ones already sent
+        if numpy is not None:
+            self.post( PREVIEW_IMAGE, coarse_preview_image( gcode_model, self.viewport, self.background))
+            if self.cancelled.is_set():
+                return
+            self.pyramid = ImagePyramid( gcode_model)
+        else:
+            self.pyramid = ModelPreview( gcode_model)
+        self.post( PREVIEW_PYRAMID, self.pyramid)
+        self.render()
+
+    def render( self, skip=0):
+        # Draw the viewport from the pyramid, leaving out the first skip
+        # polylines, which have been sent already
+        if self.cancelled.is_set():
+            return
+        rendered = self.pyramid.render( self.viewport, self.background)
+        if self.pyramid.kind == PREVIEW_IMAGE:
+            self.post( PREVIEW_IMAGE, rendered)
+            return
+        for start in range( skip, len( rendered), CHUNK_ITEMS):
+            self.post( PREVIEW_LINES, rendered[start:start + CHUNK_ITEMS])
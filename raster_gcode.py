@@ -0,0 +1,930 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Raster engraving: turn a grayscale image into serpentine gcode.
+#
+# Each image row becomes one pass of the laser, alternating left-to-right
+# and right-to-left.  Runs of identical pixels are burned with a single
+# 'M300 S<power>' / 'G1 X<end of run>' pair.  With inline_power=True, the
+# power is given on the move instead ('G1 X<end of run> S<power>', as in 
+# GRBL's laser mode), and only when it changes, which halves the number of
+# lines to send.
+#
+# If numpy is installed, the whole image is run-length encoded at once and
+# the gcode is assembled in bulk; otherwise a pure-Python encoder is used.
+# Both produce exactly the same text.
+#
+# model_from_raster() builds a gcode model for the same job directly,
+# without writing the text out and parsing it back.
+#
+# With trim_blank=True, white is left alone rather than swept over: each 
+# row starts at its first non-white pixel and ends at its last, blank rows
+# are skipped, and the laser moves between them (and across white gaps of 
+# at least rapid_gap_mm within a row) with rapid G0 moves.  overscan_mm 
+# adds a laser-off run-up before, and run-out after, each stretch of 
+# engraving, so the head is at engraving speed wherever it burns.  Given
+# bed_width_mm, run-ups and run-outs stop at the edges of the bed.  The 
+# coordinates of trimmed rows are rounded to COORD_DECIMALS places.
+#
+# Big images can be done a band of rows at a time: image_bands() scales 
+# the source a band at a time, and iter_raster_gcode() and 
+# model_from_raster_bands() take (first row, band image) pairs, carrying 
+# the serpentine direction and laser power on from one band to the next.
+# Memory use then depends on the band size rather than the image size.
+from __future__ import division
+
+import math
+import collections
+import multiprocessing
+
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def laser_engrave_power( val, min_engrave_power=0, max_engrave_power=255):
+    # val must be in [0,255]
+    # Light values will get a small engrave power, dark ones will get a large power
+    new_val = min_engrave_power + (255-val)/255 * (max_engrave_power - min_engrave_power)
+    return new_val
+
+def run_length_encode( an_arr):
+    # Returns an array of (length, value pairs), with all identical
+    # neighbors incorporated into a single pair
+    # e.g  [ 0, 1, 1, 2, 2, 2, 2]  => [ [1, 0], [2, 1], [4, 2]]
+    if len( an_arr) == 0:
+        return []
+
+    cur_count = 1
+    cur_val = an_arr[0]
+    loc = 1
+    res = [[cur_count, cur_val]]
+
+    while loc < len( an_arr):
+        if an_arr[loc] == cur_val:
+            res[-1][0] += 1  #increment count
+            loc += 1
+        else:
+            cur_val = an_arr[loc]
+            res.append([1,cur_val]) # add new count
+            loc += 1
+
+    return res
+
+def raster_header( engrave_speed, upper_left=( 0,0), inline_power=False):
+    ul_x, ul_y = upper_left
+    old_engrave_power = 0
+    if inline_power:
+        return '''(Set speed)
+G1 F%(engrave_speed)s 
+G90 ; absolute movement 
+(Move to upper left, laser off)
+G1 X%(ul_x)s Y%(ul_y)s S%(old_engrave_power)s'''%vars()
+    return '''(Set speed)
+G1 F%(engrave_speed)s 
+( Laser off)
+M300 S%(old_engrave_power)s  
+G90 ; absolute movement 
+(Move to upper left)
+G1 X%(ul_x)s Y%(ul_y)s'''%vars()
+
+def gcode_from_raster( gray_image, beam_width_mm, min_engrave_power,
+                        max_engrave_power, engrave_speed=1000,
+                        upper_left=( 0,0), use_numpy=None, trim_blank=False,
+                        overscan_mm=0.0, rapid_gap_mm=None, white_level=255,
+                        inline_power=False, bed_width_mm=None):
+    # Return serpentine engraving gcode for gray_image (a PIL image in mode
+    # 'L'), one pixel per beam_width_mm square.  use_numpy=None uses numpy
+    # if it's available.  Pixels of white_level or lighter count as white 
+    # for trim_blank.
+    return "".join( iter_raster_gcode( [(0, gray_image)], beam_width_mm, 
+                        min_engrave_power, max_engrave_power, engrave_speed, 
+                        upper_left, use_numpy, trim_blank, overscan_mm, 
+                        rapid_gap_mm, white_level, inline_power, 
+                        bed_width_mm=bed_width_mm))
+
+def iter_raster_gcode( bands, beam_width_mm, min_engrave_power,
+                        max_engrave_power, engrave_speed=1000,
+                        upper_left=( 0,0), use_numpy=None, trim_blank=False,
+                        overscan_mm=0.0, rapid_gap_mm=None, white_level=255,
+                        inline_power=False, processes=1, bed_width_mm=None):
+    # Yield the text of gcode_from_raster() a piece at a time, for an image
+    # given as bands: (first row, image) pairs, top to bottom, such as 
+    # image_bands() makes.  Only a band or two's gcode is held at once, so
+    # the pieces can be written out as they come.  With processes > 1, the
+    # bands are encoded by a pool of that many worker processes, and their
+    # gcode stitched back together in order.
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    yield raster_header( engrave_speed, upper_left, inline_power)
+
+    options = { 'beam_width_mm': beam_width_mm,
+                'min_engrave_power': min_engrave_power,
+                'max_engrave_power': max_engrave_power,
+                'use_numpy': use_numpy,
+                'trim_blank': trim_blank,
+                'overscan_mm': overscan_mm,
+                'rapid_gap_mm': rapid_gap_mm,
+                'white_level': white_level,
+                'inline_power': inline_power,
+                'bed_width_mm': bed_width_mm}
+    jobs = band_start_states( bands, options)
+    if processes > 1:
+        pieces = pool_band_gcode( jobs, options, processes)
+    else:
+        pieces = (band_gcode( band, first_row, state, **options) 
+                    for first_row, band, state in jobs)
+    for piece in pieces:
+        if piece:
+            yield piece
+
+    # Finish & turn off laser
+    yield "\n" + laser_off_line( inline_power)
+
+def band_gcode( band, first_row, state, beam_width_mm, min_engrave_power, 
+                max_engrave_power, use_numpy, trim_blank, overscan_mm, 
+                rapid_gap_mm, white_level, inline_power, bed_width_mm):
+    # The gcode for one band, starting from state (see band_start_states()),
+    # as a piece of text for iter_raster_gcode()
+    if trim_blank:
+        forward, power = state
+        rows = [line_format % args for gcode, args, line_format in 
+                    trimmed_row_moves( band_row_runs( [(first_row, band)], use_numpy),
+                                beam_width_mm, min_engrave_power, max_engrave_power,
+                                overscan_mm, rapid_gap_mm, white_level, inline_power,
+                                forward, power, bed_width_mm)]
+    elif use_numpy:
+        rows = raster_rows_numpy( band, beam_width_mm, min_engrave_power,
+                                  max_engrave_power, inline_power, first_row, state)
+    else:
+        rows = raster_rows_python( band, beam_width_mm, min_engrave_power,
+                                   max_engrave_power, inline_power, first_row, state)
+    if not rows:
+        return ""
+    return "\n" + "\n".join( rows)
+
+def band_start_states( bands, options):
+    # Yield (first row, band, state) for each of bands, where state is 
+    # what the bands before it leave behind, and all band_gcode() needs to 
+    # carry on from them: the laser power, and for trim_blank, whether the 
+    # next engraved row runs left to right.  Working this out only takes a 
+    # glance at each band, so it's quick next to encoding them.
+    powers = engrave_powers( options['min_engrave_power'], options['max_engrave_power'])
+    # The header turns the laser off
+    if options['trim_blank']:
+        state = (True, 0.0)
+    else:
+        state = 0.0
+    for first_row, band in bands:
+        yield first_row, band, state
+        if options['trim_blank']:
+            state = trimmed_end_state( band, state, powers, options['white_level'],
+                                       options['overscan_mm'], options['use_numpy'])
+        else:
+            state = last_burned_power( band, first_row, powers, state)
+
+def last_burned_power( band, first_row, powers, power):
+    # The power a serpentine band leaves the laser at: that of the last 
+    # pixel of its last row, which is the right end of an even row and the
+    # left end of an odd one (or power, if the band is empty)
+    w, h = band.size
+    if w == 0 or h == 0:
+        return power
+    last_row = first_row + h - 1
+    x = w - 1 if last_row % 2 == 0 else 0
+    return powers[band.getpixel( (x, h - 1))]
+
+def trimmed_end_state( band, state, powers, white_level, overscan_mm, use_numpy=None):
+    # (forward, power) after trimmed_row_moves() has done band, starting 
+    # from state.  Each row with any dark pixels in it turns the direction
+    # around.  The last of them finishes at its last dark pixel, and then
+    # the laser is turned off for the run-out, if there is one.
+    forward, power = state
+    w, h = band.size
+    if w == 0:
+        return state
+    if use_numpy:
+        pixels = numpy.asarray( band, dtype=numpy.uint8).reshape( h, w)
+        dark_rows = numpy.flatnonzero( pixels.min( axis=1) < white_level)
+        num_dark = len( dark_rows)
+        if num_dark:
+            last_row = pixels[dark_rows[-1]]
+    else:
+        pixels = list( band.getdata())
+        rows = [pixels[w*y: w*(y+1)] for y in range( h)]
+        dark_rows = [row for row in rows if min( row) < white_level]
+        num_dark = len( dark_rows)
+        if num_dark:
+            last_row = dark_rows[-1]
+    if not num_dark:
+        return state
+
+    last_forward = forward if num_dark % 2 == 1 else not forward
+    if overscan_mm:
+        power = 0.0
+    else:
+        dark = [val for val in list( last_row) if val < white_level]
+        power = powers[dark[-1] if last_forward else dark[0]]
+    return (not last_forward, power)
+
+def encode_band( job):
+    # Worker for pool_band_gcode(): band_gcode() for a band sent as bytes
+    data, size, first_row, state, options = job
+    band = Image.frombytes( 'L', size, data)
+    return band_gcode( band, first_row, state, **options)
+
+def pool_band_gcode( jobs, options, processes):
+    # Yield band_gcode() for each of jobs, (first row, band, state), in 
+    # order, encoding them in a pool of worker processes.  Only a couple of
+    # bands per process are sent ahead, so memory stays bounded.
+    pool = multiprocessing.Pool( processes)
+    try:
+        pending = collections.deque()
+        for first_row, band, state in jobs:
+            job = (band.tobytes(), band.size, first_row, state, options)
+            pending.append( pool.apply_async( encode_band, (job,)))
+            if len( pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def laser_off_line( inline_power=False):
+    return 'G1 S0' if inline_power else 'M300 S0'
+
+def power_commands( min_engrave_power, max_engrave_power):
+    # 'M300 S<power> ' for each of the 256 possible gray values
+    return ['M300 S%s '%laser_engrave_power( val, min_engrave_power, max_engrave_power)
+                for val in range( 256)]
+
+def engrave_powers( min_engrave_power, max_engrave_power):
+    # Laser power for each of the 256 possible gray values
+    return [laser_engrave_power( val, min_engrave_power, max_engrave_power)
+                for val in range( 256)]
+
+def raster_rows_python( gray_image, beam_width_mm, min_engrave_power, max_engrave_power,
+                        inline_power=False, first_row=0, power=0.0):
+    # Gcode lines for every row of gray_image, one pixel at a time.  If 
+    # gray_image is a band of a bigger image, first_row is the row it 
+    # starts at, and power the power the band before left the laser at.
+    gcode_arr = []
+    power_cmds = power_commands( min_engrave_power, max_engrave_power)
+    powers = engrave_powers( min_engrave_power, max_engrave_power)
+
+    w, h = gray_image.size
+    pixels = list(gray_image.getdata())
+
+    for y in range( h):
+        # Move down one row
+        image_y = first_row + y
+        y_pos = beam_width_mm * image_y
+        gcode_arr.append( 'G1 Y%s '%y_pos)
+
+        row = pixels[ w*y: w*(y+1)]
+        row_rle = run_length_encode( row)
+        if image_y %2 == 0:
+            row_loc = 0
+            direction_sign = 1
+        else:
+            row_rle = row_rle[::-1]
+            row_loc = w * beam_width_mm
+            direction_sign = -1
+
+        row_start_loc = row_loc
+        pixels_done = 0
+        for count, val in row_rle:
+            # NOTE: off by one?  How do we write a single pixel at beginning of a line?
+            # Measure from the start of the row rather than adding up run
+            # lengths, so rounding errors can't accumulate (and come out as
+            # e.g. 'X-5.0e-13', which neither GRBL nor GcodeParser can read)
+            pixels_done += count
+            row_loc = row_start_loc + direction_sign * pixels_done * beam_width_mm
+            if not inline_power:
+                gcode_arr.append( power_cmds[val])
+                gcode_arr.append( 'G1 X%s'%row_loc)
+            elif powers[val] != power:
+                power = powers[val]
+                gcode_arr.append( 'G1 X%s S%s'%(row_loc, power))
+            else:
+                gcode_arr.append( 'G1 X%s'%row_loc)
+
+    return gcode_arr
+
+def raster_runs_numpy( gray_image, beam_width_mm, first_row=0):
+    # Find the runs for the whole image at once.  Returns (run_rows, values,
+    # row_locs): each run's row, gray value and the X coordinate it ends at,
+    # in the order they're burned.  Coordinates are computed with the same 
+    # float operations, in the same order, as raster_rows_python().  Rows
+    # run left to right if first_row plus their row is even.
+    w, h = gray_image.size
+    pixels = numpy.asarray( gray_image, dtype=numpy.uint8).reshape( h, w)
+
+    # A run starts at the first pixel of each row, and wherever a pixel
+    # differs from its left neighbor; it ends just before the next start
+    changes = pixels[:, 1:] != pixels[:, :-1]
+    starts = numpy.ones( (h, w), dtype=bool)
+    starts[:, 1:] = changes
+    ends = numpy.ones( (h, w), dtype=bool)
+    ends[:, :-1] = changes
+    start_idx = numpy.flatnonzero( starts)
+    end_idx = numpy.flatnonzero( ends)
+
+    run_rows = end_idx // w
+    odd = ((run_rows + first_row) % 2).astype( bool)
+    values = pixels.ravel()[end_idx]
+
+    # Even rows run left to right and finish each run at its end pixel; odd
+    # rows run right to left, finishing each run at its start pixel
+    pixels_done = numpy.where( odd, w - start_idx % w, end_idx % w + 1)
+    direction_sign = numpy.where( odd, -1, 1)
+    row_start_loc = numpy.where( odd, w * beam_width_mm, 0.0)
+    row_locs = row_start_loc + (direction_sign * pixels_done) * beam_width_mm
+
+    # Put each odd row's runs in right-to-left order
+    order = numpy.argsort( run_rows * (w + 1) + pixels_done, kind='mergesort')
+    return run_rows[order], values[order], row_locs[order]
+
+def raster_rows_numpy( gray_image, beam_width_mm, min_engrave_power, max_engrave_power,
+                       inline_power=False, first_row=0, power=0.0):
+    # Same as raster_rows_python(), but with the runs from raster_runs_numpy().
+    # Coordinates are converted back to Python floats before formatting, 
+    # so the text is identical.
+    w, h = gray_image.size
+    if w == 0 or h == 0:
+        return ['G1 Y%s '%(beam_width_mm * (first_row + y)) for y in range( h)]
+    run_rows, values, row_locs = raster_runs_numpy( gray_image, beam_width_mm, first_row)
+    locs = numpy.array( map( str, row_locs.tolist()), dtype=object)
+
+    if inline_power:
+        # Per run: 'G1 X<loc>', plus ' S<power>' if the power changes
+        powers = numpy.array( engrave_powers( min_engrave_power, max_engrave_power))
+        changed = power_changes( powers[values], power)
+        power_words = numpy.array( [' S%s'%power for power in 
+                        engrave_powers( min_engrave_power, max_engrave_power)], dtype=object)
+        run_cmds = 'G1 X' + locs + numpy.where( changed, power_words[values], '')
+    else:
+        # Per run: 'M300 S<power> \nG1 X<loc>'
+        power_cmds = numpy.array( [cmd + "\nG1 X" for cmd in
+                        power_commands( min_engrave_power, max_engrave_power)], dtype=object)
+        run_cmds = power_cmds[values] + locs
+    run_cmds = run_cmds.tolist()
+
+    # Each row's runs follow its 'G1 Y' line
+    row_ends = numpy.cumsum( numpy.bincount( run_rows, minlength=h)).tolist()
+    gcode_arr = []
+    row_start = 0
+    for y, row_end in enumerate( row_ends):
+        gcode_arr.append( 'G1 Y%s '%(beam_width_mm * (first_row + y)))
+        gcode_arr.extend( run_cmds[row_start:row_end])
+        row_start = row_end
+    return gcode_arr
+
+def power_changes( run_powers, power=0.0):
+    # Which runs burn at a different power from the run before them (the
+    # first, from power)
+    changed = numpy.empty( len( run_powers), dtype=bool)
+    if len( run_powers):
+        changed[0] = run_powers[0] != power
+        changed[1:] = run_powers[1:] != run_powers[:-1]
+    return changed
+
+# Line formats for model_from_raster().  Applied to a segment's coords, 
+# they give the line gcode_from_raster() writes, as GcodeParser would 
+# record it (without trailing whitespace)
+Y_MOVE_FORMAT = 'G1 Y%(Y)s'
+POWER_FORMAT = 'M300 S%(S)s'
+X_MOVE_FORMAT = 'G1 X%(X)s'
+X_POWER_MOVE_FORMAT = 'G1 X%(X)s S%(S)s'
+
+def model_from_raster( gray_image, beam_width_mm, min_engrave_power,
+                        max_engrave_power, builder, engrave_speed=1000,
+                        upper_left=( 0,0), use_numpy=None, trim_blank=False,
+                        overscan_mm=0.0, rapid_gap_mm=None, white_level=255,
+                        inline_power=False, bed_width_mm=None):
+    # Build the job gcode_from_raster() would write straight into builder, 
+    # a YAGV.gcodeParser.GcodeBuilder, and return the finished model.  Line
+    # text is only made if it's asked for.
+    return model_from_raster_bands( [(0, gray_image)], beam_width_mm, 
+                        min_engrave_power, max_engrave_power, builder, 
+                        engrave_speed, upper_left, use_numpy, trim_blank, 
+                        overscan_mm, rapid_gap_mm, white_level, inline_power,
+                        bed_width_mm)
+
+def model_from_raster_bands( bands, beam_width_mm, min_engrave_power,
+                        max_engrave_power, builder, engrave_speed=1000,
+                        upper_left=( 0,0), use_numpy=None, trim_blank=False,
+                        overscan_mm=0.0, rapid_gap_mm=None, white_level=255,
+                        inline_power=False, bed_width_mm=None):
+    # model_from_raster() for an image given as (first row, image) bands, 
+    # as for iter_raster_gcode()
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    builder.addText( raster_header( engrave_speed, upper_left, inline_power))
+    if trim_blank:
+        for gcode, args, line_format in trimmed_row_moves( band_row_runs( bands, use_numpy),
+                                    beam_width_mm, min_engrave_power, max_engrave_power,
+                                    overscan_mm, rapid_gap_mm, white_level, inline_power,
+                                    bed_width_mm=bed_width_mm):
+            builder.addMove( gcode, args, line_format)
+    elif use_numpy and hasattr( builder.model, 'extendColumns'):
+        for first_row, band in bands:
+            add_raster_columns( band, beam_width_mm, min_engrave_power,
+                                max_engrave_power, builder.model, inline_power, first_row)
+    else:
+        for first_row, band in bands:
+            add_raster_moves( band, beam_width_mm, min_engrave_power,
+                              max_engrave_power, builder, inline_power, first_row)
+    # Finish & turn off laser
+    builder.addLine( laser_off_line( inline_power))
+    return builder.finish()
+
+def add_raster_moves( gray_image, beam_width_mm, min_engrave_power, 
+                      max_engrave_power, builder, inline_power=False, first_row=0):
+    # Add the rows to builder one move at a time, starting at row first_row
+    powers = engrave_powers( min_engrave_power, max_engrave_power)
+    # Carry on from the power the header or the band before left the laser at
+    power = builder.model.laserPower
+
+    w, h = gray_image.size
+    pixels = list(gray_image.getdata())
+
+    for y in range( h):
+        image_y = first_row + y
+        builder.addMove( 'G1', {'Y': beam_width_mm * image_y}, Y_MOVE_FORMAT)
+
+        row_rle = run_length_encode( pixels[ w*y: w*(y+1)])
+        if image_y %2 == 0:
+            row_start_loc = 0
+            direction_sign = 1
+        else:
+            row_rle = row_rle[::-1]
+            row_start_loc = w * beam_width_mm
+            direction_sign = -1
+
+        pixels_done = 0
+        for count, val in row_rle:
+            pixels_done += count
+            row_loc = row_start_loc + direction_sign * pixels_done * beam_width_mm
+            if not inline_power:
+                builder.addMove( 'M300', {'S': powers[val]}, POWER_FORMAT)
+                builder.addMove( 'G1', {'X': row_loc}, X_MOVE_FORMAT)
+            elif powers[val] != power:
+                power = powers[val]
+                builder.addMove( 'G1', {'X': row_loc, 'S': power}, X_POWER_MOVE_FORMAT)
+            else:
+                builder.addMove( 'G1', {'X': row_loc}, X_MOVE_FORMAT)
+
+def add_raster_columns( gray_image, beam_width_mm, min_engrave_power,
+                        max_engrave_power, model, inline_power=False, first_row=0):
+    # Add the rows to a ColumnarGcodeModel in one go.  The columns hold 
+    # exactly what add_raster_moves() would have put there: each row is a 
+    # 'G1 Y' move followed by a 'M300 S' / 'G1 X' pair per run (or with 
+    # inline_power, one 'G1 X' per run, with an S when the power changes), 
+    # with every segment carrying the position and feed rate on from the 
+    # one before.
+    w, h = gray_image.size
+    if w == 0 or h == 0:
+        run_rows = values = row_locs = numpy.zeros( 0, dtype=int)
+    else:
+        run_rows, values, row_locs = raster_runs_numpy( gray_image, beam_width_mm, first_row)
+    num_runs = len( run_rows)
+    per_run = 1 if inline_power else 2
+    count = h + per_run * num_runs
+    powers = numpy.array( engrave_powers( min_engrave_power, max_engrave_power), dtype=float)
+    run_powers = powers[values]
+
+    # Where each row's 'G1 Y' and each run's M300 and 'G1 X' segments go
+    runs_before_row = numpy.cumsum( numpy.bincount( run_rows, minlength=h)) - \
+                        numpy.bincount( run_rows, minlength=h)
+    y_move_pos = numpy.arange( h) + per_run * runs_before_row
+    x_move_pos = run_rows + per_run * (numpy.arange( num_runs) + 1)
+
+    is_power = numpy.zeros( count, dtype=bool)
+    gcode_idx = numpy.empty( count, dtype=numpy.uint8)
+    gcode_idx.fill( model.gcodeIndex( 'G1'))
+    format_idx = numpy.empty( count, dtype=numpy.uint8)
+    format_idx[y_move_pos] = model.lineFormatIndex( Y_MOVE_FORMAT)
+    S = numpy.empty( count)
+    S.fill( float( 'nan'))
+    if inline_power:
+        changed = power_changes( run_powers, model.laserPower)
+        format_idx[x_move_pos] = numpy.where( changed, 
+                                    model.lineFormatIndex( X_POWER_MOVE_FORMAT),
+                                    model.lineFormatIndex( X_MOVE_FORMAT))
+        S[x_move_pos[changed]] = run_powers[changed]
+    else:
+        power_pos = x_move_pos - 1
+        is_power[power_pos] = True
+        gcode_idx[power_pos] = model.gcodeIndex( 'M300')
+        format_idx[power_pos] = model.lineFormatIndex( POWER_FORMAT)
+        format_idx[x_move_pos] = model.lineFormatIndex( X_MOVE_FORMAT)
+        S[power_pos] = run_powers
+
+    # do_G1() records absolute coordinates (offset + relative), and 
+    # do_M300() relative ones
+    def carried( axis):
+        return model.relative[axis] + numpy.where( is_power, 0.0, model.offset.get( axis, 0.0))
+
+    # X changes at each 'G1 X' and is carried on to the segments after it
+    rel_x = numpy.empty( count)
+    rel_x.fill( model.relative["X"])
+    last_x_move = numpy.full( count, -1)
+    last_x_move[x_move_pos] = numpy.arange( num_runs)
+    last_x_move = numpy.maximum.accumulate( last_x_move)
+    moved = last_x_move >= 0
+    rel_x[moved] = row_locs[last_x_move[moved]]
+    X = rel_x + numpy.where( is_power, 0.0, model.offset["X"])
+
+    # Y is set by each row's 'G1 Y'
+    segment_rows = numpy.repeat( numpy.arange( h), 
+                                 1 + per_run * numpy.bincount( run_rows, minlength=h))
+    Y = beam_width_mm * (first_row + segment_rows) + numpy.where( is_power, 0.0, model.offset["Y"])
+
+    F = numpy.empty( count)
+    F.fill( model.relative["F"])
+    columns = { "X": X, "Y": Y, "Z": carried( "Z"), "E": carried( "E"), "F": F, "S": S}
+    model.extendColumns( count, gcode_idx, format_idx, columns)
+
+RAPID_FORMAT = 'G0 X%(X)s'
+# Decimal places trimmed rows' coordinates are given to
+COORD_DECIMALS = 3
+RAPID_TO_ROW_FORMAT = 'G0 X%(X)s Y%(Y)s'
+
+def image_row_runs( gray_image, use_numpy=None):
+    # Yield (y, runs) for each row of gray_image, where runs is a list of 
+    # (first column, length, gray value) for each run of identical pixels,
+    # left to right
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    w, h = gray_image.size
+    if w == 0:
+        return
+
+    if not use_numpy:
+        pixels = list( gray_image.getdata())
+        for y in range( h):
+            runs = []
+            start = 0
+            for count, val in run_length_encode( pixels[ w*y: w*(y+1)]):
+                runs.append( (start, count, val))
+                start += count
+            yield y, runs
+        return
+
+    pixels = numpy.asarray( gray_image, dtype=numpy.uint8).reshape( h, w)
+    starts = numpy.ones( (h, w), dtype=bool)
+    starts[:, 1:] = pixels[:, 1:] != pixels[:, :-1]
+    start_idx = numpy.flatnonzero( starts)
+    values = pixels.ravel()[start_idx]
+    row_ends = numpy.cumsum( numpy.bincount( start_idx // w, minlength=h))
+
+    # Each run ends where the next one starts, or at the end of its row
+    cols = start_idx % w
+    next_cols = numpy.append( cols[1:], w)
+    next_cols[row_ends - 1] = w
+    counts = next_cols - cols
+
+    cols, counts, values = cols.tolist(), counts.tolist(), values.tolist()
+    row_start = 0
+    for y, row_end in enumerate( row_ends.tolist()):
+        yield y, zip( cols[row_start:row_end], counts[row_start:row_end],
+                      values[row_start:row_end])
+        row_start = row_end
+
+class PowerChanges( object):
+    # Gives the lines for a move that burns at a given power: the move is 
+    # preceded by a 'M300 S' line if the power changes, or with 
+    # inline_power, carries an S word instead.  Powers that don't change 
+    # aren't repeated.
+    def __init__( self, inline_power=False, power=0.0):
+        self.inline_power = inline_power
+        self.power = power
+
+    def move( self, gcode, args, line_format, power):
+        if power == self.power:
+            return [(gcode, args, line_format)]
+        self.power = power
+        if self.inline_power:
+            args = dict( args, S=power)
+            return [(gcode, args, line_format + ' S%(S)s')]
+        return [('M300', {'S': power}, POWER_FORMAT), (gcode, args, line_format)]
+
+def band_row_runs( bands, use_numpy=None):
+    # image_row_runs() for each of bands, (first row, image) pairs, with 
+    # rows numbered from the top of the whole image
+    for first_row, band in bands:
+        for y, runs in image_row_runs( band, use_numpy):
+            yield first_row + y, runs
+
+def trimmed_raster_moves( gray_image, beam_width_mm, min_engrave_power,
+                          max_engrave_power, overscan_mm=0.0, rapid_gap_mm=None,
+                          white_level=255, use_numpy=None, inline_power=False,
+                          bed_width_mm=None):
+    # Yield (gcode, args, line format) for each line of a trim_blank job.  
+    # Rows alternate direction among the rows actually engraved.
+    return trimmed_row_moves( image_row_runs( gray_image, use_numpy), beam_width_mm,
+                              min_engrave_power, max_engrave_power, overscan_mm,
+                              rapid_gap_mm, white_level, inline_power, 
+                              bed_width_mm=bed_width_mm)
+
+def trimmed_row_moves( row_runs, beam_width_mm, min_engrave_power,
+                       max_engrave_power, overscan_mm=0.0, rapid_gap_mm=None,
+                       white_level=255, inline_power=False, forward=True, power=0.0,
+                       bed_width_mm=None):
+    # trimmed_raster_moves() for rows given as (y, runs), as from 
+    # image_row_runs() or band_row_runs().  forward and power are the 
+    # direction of the first engraved row and the laser's power before it
+    # (after the header, off).
+    def bed_x( x):
+        # An overscan coordinate: x to COORD_DECIMALS places, which keeps 
+        # float noise like 5.5e-17 out of the text, and no further out than
+        # the bed goes
+        x = max( 0.0, round( x, COORD_DECIMALS))
+        if bed_width_mm is not None:
+            x = min( x, bed_width_mm)
+        return x
+
+    powers = engrave_powers( min_engrave_power, max_engrave_power)
+    # A white gap is only worth a rapid if it's longer than its run-out 
+    # and run-in together
+    min_rapid_gap = None
+    if rapid_gap_mm is not None:
+        min_rapid_gap = max( rapid_gap_mm, 2 * overscan_mm)
+
+    moves = PowerChanges( inline_power, power)
+    for y, runs in row_runs:
+        dark = [i for i, (start, count, val) in enumerate( runs) if val < white_level]
+        if not dark:
+            continue
+        runs = runs[dark[0]:dark[-1] + 1]
+        if not forward:
+            runs = runs[::-1]
+        direction_sign = 1 if forward else -1
+
+        # Where the laser enters and leaves each run
+        edges = []
+        for start, count, val in runs:
+            left = round( start * beam_width_mm, COORD_DECIMALS)
+            right = round( (start + count) * beam_width_mm, COORD_DECIMALS)
+            edges.append( (left, right) if forward else (right, left))
+
+        # Laser off and rapid to the run-up for this row
+        row_entry = edges[0][0]
+        row_y = round( beam_width_mm * y, COORD_DECIMALS)
+        for move in moves.move( 'G0', {'X': bed_x( row_entry - direction_sign * overscan_mm), 
+                                       'Y': row_y}, RAPID_TO_ROW_FORMAT, 0.0):
+            yield move
+        if overscan_mm:
+            yield 'G1', {'X': row_entry}, X_MOVE_FORMAT
+
+        for (start, count, val), (entry, exit) in zip( runs, edges):
+            if val >= white_level:
+                if min_rapid_gap is not None and count * beam_width_mm >= min_rapid_gap:
+                    # Run out, rapid across the gap, and run up again
+                    if overscan_mm:
+                        for move in moves.move( 'G1', {'X': bed_x( entry + direction_sign * overscan_mm)},
+                                                X_MOVE_FORMAT, 0.0):
+                            yield move
+                    for move in moves.move( 'G0', {'X': bed_x( exit - direction_sign * overscan_mm)},
+                                            RAPID_FORMAT, 0.0):
+                        yield move
+                    if overscan_mm:
+                        yield 'G1', {'X': exit}, X_MOVE_FORMAT
+                    continue
+                run_power = 0.0
+            else:
+                run_power = powers[val]
+            for move in moves.move( 'G1', {'X': exit}, X_MOVE_FORMAT, run_power):
+                yield move
+
+        # Run out past the end of the row
+        if overscan_mm:
+            for move in moves.move( 'G1', {'X': bed_x( edges[-1][1] + direction_sign * overscan_mm)},
+                                    X_MOVE_FORMAT, 0.0):
+                yield move
+        forward = not forward
+
+def raster_size( im, beam_width_mm, prescale=1.0):
+    # Size of im in pixels once it's scaled so that each pixel is a beam 
+    # (a square beam_width_mm x beam_width_mm), times prescale
+    dpi = im.info['dpi'][0] # Technically, there could be separate x/y dpis
+
+    w, h = im.size
+    # NOTE: technically, we might want different ratios for X & Y, since 
+    # each pixel is burned one step next to its left and right neighbors 
+    # but hundreds of steps away from its up and down neighbors.  For the 
+    # moment, let's treat both directions as identical though -ETJ 01 May 2014
+    w_inches = w / dpi
+    h_inches = h / dpi
+    new_dpi =  25.4 / beam_width_mm 
+    return int( w_inches * new_dpi * prescale), int( h_inches * new_dpi * prescale)
+
+def image_bands( image_path, beam_width_mm, prescale=1.0, band_rows=256, draft=True):
+    # Yield (first row, band) for the image at image_path, scaled to 
+    # raster_size() and made grayscale, band_rows rows at a time.  Each 
+    # band is converted and resized on its own from the strip of the 
+    # source it covers, so the scaled image is never all in memory.  With
+    # draft, JPEGs are decoded straight to grayscale at the smallest 
+    # scale that still has enough pixels, rather than at full size.  
+    # Bands can be a gray level off resizing the whole image in places, 
+    # since band edges fall between source rows.
+    im = Image.open( image_path)
+    new_w, new_h = raster_size( im, beam_width_mm, prescale)
+    if draft:
+        im.draft( 'L', (new_w, new_h))
+    w, h = im.size
+    scale_y = h / new_h if new_h else 1
+    # Source rows either side of a band that blend into its edge rows
+    margin = int( math.ceil( scale_y)) + 1
+
+    for first_row in range( 0, new_h, band_rows):
+        end_row = min( new_h, first_row + band_rows)
+        top, bottom = first_row * scale_y, end_row * scale_y
+        strip_top = max( 0, int( math.floor( top)) - margin)
+        strip_bottom = min( h, int( math.ceil( bottom)) + margin)
+        strip = im.crop( (0, strip_top, w, strip_bottom)).convert( "L")
+        band = strip.resize( (new_w, end_row - first_row), resample=Image.BILINEAR,
+                             box=(0, top - strip_top, w, bottom - strip_top))
+        yield first_row, band
+
+# Tone modes, applied to the image before it's engraved.  Rather than 
+# a power level for every gray value (so that every bit of resampling 
+# noise starts a new run), these use fewer levels, which makes for far 
+# fewer, longer runs:
+#   gray             leave the image alone
+#   quantize         round to `levels` evenly spaced grays
+#   threshold        black below `threshold`, white otherwise
+#   floyd-steinberg  `levels` grays, Floyd-Steinberg error diffusion
+#   ordered          `levels` grays, ordered (8x8 Bayer) dithering
+TONE_MODES = ['gray', 'quantize', 'threshold', 'floyd-steinberg', 'ordered']
+# Tone modes that can be applied to an image a band at a time.  
+# Floyd-Steinberg pushes error down into the rows below, so it needs the
+# whole image.
+BAND_TONE_MODES = ['gray', 'quantize', 'threshold', 'ordered']
+
+# 8x8 Bayer threshold map, values 0-63
+BAYER_8 = [[ 0, 32,  8, 40,  2, 34, 10, 42],
+           [48, 16, 56, 24, 50, 18, 58, 26],
+           [12, 44,  4, 36, 14, 46,  6, 38],
+           [60, 28, 52, 20, 62, 30, 54, 22],
+           [ 3, 35, 11, 43,  1, 33,  9, 41],
+           [51, 19, 59, 27, 49, 17, 57, 25],
+           [15, 47,  7, 39, 13, 45,  5, 37],
+           [63, 31, 55, 23, 61, 29, 53, 21]]
+
+def tone_levels( levels):
+    # The grays an image is reduced to, darkest first
+    levels = max( 2, min( 256, int( levels)))
+    return [int( round( i * 255 / (levels - 1))) for i in range( levels)]
+
+def nearest_level( val, levels):
+    # Index into tone_levels( levels) of the gray nearest val.  Halves 
+    # round up, here and in the numpy versions.
+    return max( 0, min( levels - 1, int( math.floor( val * (levels - 1) / 255 + 0.5))))
+
+def nearest_levels_numpy( vals, levels):
+    # nearest_level() for an array of values
+    return numpy.clip( numpy.floor( vals * (levels - 1) / 255 + 0.5), 0, levels - 1).astype( int)
+
+def apply_tone( gray_image, mode, levels=2, threshold=128, use_numpy=None, first_row=0):
+    # Return a copy of gray_image with the tone mode applied.  If 
+    # gray_image is a band of a bigger image, first_row is the row it 
+    # starts at (for BAND_TONE_MODES).
+    if mode not in TONE_MODES:
+        raise ValueError( "Unknown tone mode '%s'; choose from %s"%(mode, ", ".join( TONE_MODES)))
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    grays = tone_levels( levels)
+    levels = len( grays)
+
+    if mode == 'gray':
+        return gray_image.copy()
+    if mode == 'quantize':
+        return gray_image.point( [grays[nearest_level( val, levels)] for val in range( 256)])
+    if mode == 'threshold':
+        return gray_image.point( [0 if val < threshold else 255 for val in range( 256)])
+
+    w, h = gray_image.size
+    if mode == 'ordered':
+        if use_numpy:
+            pixels = numpy.asarray( gray_image, dtype=numpy.uint8).reshape( h, w)
+            bayer = numpy.array( BAYER_8, dtype=float)
+            bayer_row = first_row % 8
+            offsets = numpy.tile( bayer, ((h + 7) // 8 + 1, (w + 7) // 8))
+            offsets = offsets[bayer_row:bayer_row + h, :w]
+            out = ordered_dither_numpy( pixels, offsets, grays)
+        else:
+            pixels = list( gray_image.getdata())
+            out = ordered_dither_python( pixels, w, h, grays, first_row)
+    else:
+        if use_numpy:
+            pixels = numpy.asarray( gray_image, dtype=numpy.uint8).reshape( h, w)
+            out = floyd_steinberg_numpy( pixels, grays)
+        else:
+            pixels = list( gray_image.getdata())
+            out = floyd_steinberg_python( pixels, w, h, grays)
+
+    if use_numpy:
+        result = Image.fromarray( out, 'L')
+        result.info.update( gray_image.info)
+    else:
+        result = gray_image.copy()
+        result.putdata( out)
+    return result
+
+def ordered_dither_python( pixels, w, h, grays, first_row=0):
+    levels = len( grays)
+    step = 255 / (levels - 1)
+    out = []
+    for y in range( h):
+        bayer_row = BAYER_8[(first_row + y) % 8]
+        for x in range( w):
+            val = pixels[y * w + x] + ((bayer_row[x % 8] + 0.5) / 64 - 0.5) * step
+            out.append( grays[nearest_level( val, levels)])
+    return out
+
+def ordered_dither_numpy( pixels, offsets, grays):
+    levels = len( grays)
+    step = 255 / (levels - 1)
+    vals = pixels + ((offsets + 0.5) / 64 - 0.5) * step
+    return numpy.array( grays, dtype=numpy.uint8)[nearest_levels_numpy( vals, levels)]
+
+def floyd_steinberg_python( pixels, w, h, grays):
+    # Classic Floyd-Steinberg: left to right, top to bottom, pushing each 
+    # pixel's error on to its unvisited neighbors
+    levels = len( grays)
+    work = [float( val) for val in pixels]
+    out = [0] * (w * h)
+    for y in range( h):
+        for x in range( w):
+            i = y * w + x
+            old = work[i]
+            new = grays[nearest_level( old, levels)]
+            out[i] = new
+            err = old - new
+            if x + 1 < w:
+                work[i + 1] += err * 7 / 16
+            if y + 1 < h:
+                if x > 0:
+                    work[i + w - 1] += err * 3 / 16
+                work[i + w] += err * 5 / 16
+                if x + 1 < w:
+                    work[i + w + 1] += err * 1 / 16
+    return out
+
+def floyd_steinberg_numpy( pixels, grays):
+    # Floyd-Steinberg, vectorized along anti-diagonals.  Pixel (x, y) only
+    # depends on (x-1, y), (x-1, y-1), (x, y-1) and (x+1, y-1), so all the
+    # pixels with the same x + 2*y can be done at once, in order of x + 2*y.
+    # Errors reach each pixel in the same order as in the classic 
+    # row-by-row loop, so the result is identical to 
+    # floyd_steinberg_python().
+    h, w = pixels.shape
+    levels = len( grays)
+    grays = numpy.array( grays, dtype=float)
+    # One column of padding either side and a row below, so the error can
+    # be pushed off the edges without bounds checks
+    work = numpy.zeros( (h + 1, w + 2))
+    work[:h, 1:w + 1] = pixels
+    out = numpy.zeros( (h, w), dtype=numpy.uint8)
+
+    for t in range( w + 2 * (h - 1)):
+        y_min = max( 0, (t - w + 2) // 2)
+        y_max = min( h - 1, t // 2)
+        ys = numpy.arange( y_min, y_max + 1)
+        xs = t - 2 * ys + 1 # in padded columns
+        old = work[ys, xs]
+        new = grays[nearest_levels_numpy( old, levels)]
+        out[ys, xs - 1] = new
+        err = old - new
+        # The row below first: the classic loop finishes a row before it 
+        # pushes anything right along the next one
+        work[ys + 1, xs - 1] += err * 3 / 16
+        work[ys + 1, xs] += err * 5 / 16
+        work[ys + 1, xs + 1] += err * 1 / 16
+        work[ys, xs + 1] += err * 7 / 16
+    return out
+
+def raster_command_count( gray_image, use_numpy=None, inline_power=False, 
+                          trim_blank=False, beam_width_mm=None, overscan_mm=0.0,
+                          rapid_gap_mm=None, white_level=255):
+    # Lines a job for gray_image would have, with the same options as 
+    # gcode_from_raster() (less the header and the closing laser off).  A 
+    # serpentine job has a 'G1 Y' per row and a 'M300 S' / 'G1 X' pair per
+    # run (or with inline_power, just the 'G1 X').  A trim_blank job's 
+    # lines are counted as trimmed_raster_moves() makes them, which needs 
+    # beam_width_mm for the sizes of gaps and overscan.
+    if trim_blank:
+        if beam_width_mm is None:
+            raise ValueError( "raster_command_count() needs beam_width_mm for trim_blank")
+        return sum( 1 for move in trimmed_raster_moves( gray_image, beam_width_mm, 0, 255,
+                                    overscan_mm, rapid_gap_mm, white_level, use_numpy,
+                                    inline_power))
+    w, h = gray_image.size
+    runs = 0
+    for y, row_runs in image_row_runs( gray_image, use_numpy):
+        runs += len( row_runs)
+    return h + (1 if inline_power else 2) * runs
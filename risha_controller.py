@@ -5,17 +5,25 @@ from __future__ import division
 import os, sys, re
 import serial, time
 import threading
+import logging
+import traceback
+import Queue
+from collections import deque
 
 import PIL
 from PIL import Image
 
 # Gcode parsing
 from YAGV import gcodeParser
-from YAGV.gcodeParser import GcodeParser 
+from YAGV.gcodeParser import GcodeParser, GcodeBuilder
+
+# Raster engraving
+import raster_gcode
 
 # DXF Parsing
 from scribbles.import_dxf import DxfParser
 from scribbles.context import GCodeContext
+from scribbles import chaining, ordering
 
 # For testing purposes only -ETJ 26 Apr 2014
 SERIAL_MOCK = False
@@ -23,8 +31,38 @@ if SERIAL_MOCK:
     import dummy_serial
 
 GRBL_BAUD = 9600
+# GRBL's serial receive buffer is 128 bytes, one of which is reserved,
+# so at most 127 characters may be in flight at any time.
+GRBL_RX_BUFFER_SIZE = 127
+
+# GRBL's real-time commands.  GRBL picks these single characters out of
+# the incoming stream as soon as they arrive, so they take effect without
+# waiting behind lines already in its RX buffer or planner.
+GRBL_FEED_HOLD = '!'
+GRBL_CYCLE_START = '~'
+GRBL_STATUS_QUERY = '?'
+GRBL_SOFT_RESET = '\x18' # Ctrl-X
+REALTIME_COMMAND_NAMES = {  GRBL_FEED_HOLD: "feed hold",
+                            GRBL_CYCLE_START: "cycle start",
+                            GRBL_STATUS_QUERY: "status query",
+                            GRBL_SOFT_RESET: "soft reset"}
 DEBUG = True
 
+# Events posted by a running job to RishaController.event_queue.  The UI
+# thread drains them with RishaController.process_events()
+JOB_STARTED, JOB_PROGRESS, JOB_LOG, JOB_FINISHED = ("Started", "Progress",
+                                                    "Log", "Finished")
+# Commands sent from the UI thread to a running GcodeRunnerThread
+PAUSE, RESUME, STOP = ("Pause", "Resume", "Stop")
+
+# Minimum time, in seconds, between JOB_PROGRESS events
+PROGRESS_INTERVAL = 0.1
+
+# How many times a second to ask GRBL for its status while a job runs
+STATUS_POLL_HZ = 5
+# Seconds between checks for GRBL's replies while a job is paused
+PAUSED_READ_INTERVAL = 0.05
+
 CUTTER_MIN_X = 0
 CUTTER_MIN_Y = 0
 
@@ -60,9 +98,130 @@ def find_likely_arduino():
 def print_wrapper( a_str):
     print a_str
 
+def grbl_response_level( res):
+    # The level to log a line from GRBL at: its errors and alarms always 
+    # show, its 'ok's and echoes of what it was sent are only traffic, and
+    # anything else (feedback messages, settings) is worth seeing
+    res = res.strip()
+    if res.startswith( 'error') or res.startswith( 'ALARM'):
+        return logging.ERROR
+    if not res or res == 'ok' or res.startswith( '[echo:'):
+        return logging.DEBUG
+    return logging.INFO
+
+class GrblStatus(object):
+    # A snapshot of one GRBL status report.  These are never modified once
+    # made; the controller just swaps in a new one, so other threads can
+    # read RishaController.machine_status without any locking.
+    def __init__( self, state, mpos, wpos=None, feed=None, wco=None, timestamp=None):
+        self.state = state
+        self.mpos = mpos    # machine position (x, y, z)
+        self.wpos = wpos    # work position (x, y, z), if GRBL reported it
+        self.feed = feed
+        self.wco = wco      # work coordinate offset, if known
+        self.timestamp = timestamp or time.time()
+        
+    def position( self):
+        # Work position if we have it, machine position otherwise
+        return self.wpos or self.mpos
+    
+    def __str__( self):
+        x, y, z = self.position()
+        return "%s  X:%.2f Y:%.2f Z:%.2f"%(self.state, x, y, z)
+
+def parse_grbl_status( report, wco=None):
+    # Parse a GRBL status report into a GrblStatus, or return None if 
+    # report isn't one.  Handles both GRBL 0.9 reports:
+    #   <Run,MPos:10.000,5.000,0.000,WPos:10.000,5.000,0.000>
+    # and GRBL 1.1 reports:
+    #   <Run|MPos:10.000,5.000,0.000|FS:500,0|WCO:0.000,0.000,0.000>
+    # GRBL 1.1 only sends the work coordinate offset (WCO) occasionally, so 
+    # pass in the last one seen to get work positions in between.
+    report = report.strip()
+    if not (report.startswith( '<') and report.endswith( '>')):
+        return None
+    
+    fields = {}
+    body = report[1:-1]
+    if '|' in body:
+        parts = body.split( '|')
+        state = parts[0]
+        for part in parts[1:]:
+            name, _, values = part.partition( ':')
+            fields[name] = values
+    else:
+        # 0.9: everything is comma separated, with 'Name:' on the first value
+        # of each group
+        parts = body.split( ',')
+        state = parts[0]
+        name = None
+        for part in parts[1:]:
+            if ':' in part:
+                name, _, part = part.partition( ':')
+                fields[name] = part
+            elif name:
+                fields[name] += ',' + part
+    
+    def coords( name):
+        try:
+            vals = [float( v) for v in fields[name].split( ',')][:3]
+        except (KeyError, ValueError):
+            return None
+        # Pad out to (x, y, z)
+        return tuple( vals + [0.0] * (3 - len( vals)))
+    
+    mpos = coords( 'MPos')
+    wpos = coords( 'WPos')
+    wco = coords( 'WCO') or wco
+    if mpos is None and wpos is not None:
+        mpos = tuple( w + o for w, o in zip( wpos, wco or (0, 0, 0)))
+    elif wpos is None and mpos is not None and wco is not None:
+        wpos = tuple( m - o for m, o in zip( mpos, wco))
+    if mpos is None:
+        return None
+    
+    feed = None
+    for name in ( 'FS', 'F'):
+        if name in fields:
+            try:
+                feed = float( fields[name].split( ',')[0])
+            except ValueError:
+                pass
+            break
+    
+    return GrblStatus( state, mpos, wpos, feed, wco)
+
+class GrblStatusPoller( threading.Thread):
+    # Sends GRBL a '?' status query poll_hz times a second until stop() is 
+    # called.  '?' is a real-time command, so it doesn't take up room in 
+    # GRBL's RX buffer or delay streamed lines; the replies are read by 
+    # whoever is reading the port (normally the GcodeRunnerThread) and 
+    # handed to RishaController.handle_grbl_message().
+    def __init__( self, controller_obj, poll_hz=STATUS_POLL_HZ):
+        threading.Thread.__init__( self)
+        self.daemon = True
+        self.controller = controller_obj
+        self.interval = 1.0 / poll_hz
+        self.stop_event = threading.Event()
+        
+    def run( self):
+        while not self.stop_event.wait( self.interval):
+            try:
+                self.controller.send_realtime_command( GRBL_STATUS_QUERY)
+            except Exception, e:
+                # Port closed underneath us; nothing left to poll
+                self.controller.log( "Status polling stopped: %s"%e)
+                return
+    
+    def stop( self):
+        self.stop_event.set()
+
 class GcodeRunnerThread( threading.Thread):
-    def __init__(self, controller_obj, gcode_model, start_callback=None, end_callback=None):
+    def __init__(self, controller_obj, gcode_model, start_callback=None, end_callback=None,
+                    streaming=True, rx_buffer_size=GRBL_RX_BUFFER_SIZE):
         threading.Thread.__init__(self)
+        # Don't keep the application alive just because a job is running
+        self.daemon = True
         self.controller = controller_obj
         self.gcode_model = gcode_model
         self.start_callback = start_callback
@@ -71,24 +230,105 @@ class GcodeRunnerThread( threading.Thread):
         self.current_line_num = 0
         self.is_paused = False
         self.is_running = False
+        
+        # Character-counting streaming: rather than waiting for each 'ok'
+        # before sending the next line, keep GRBL's RX buffer as full as
+        # possible so its planner never runs dry.  in_flight holds 
+        # (line_num, byte_count, time_sent) for each line sent but not yet 
+        # acknowledged, oldest first; GRBL answers lines strictly in order.
+        self.streaming = streaming
+        self.rx_buffer_size = rx_buffer_size
+        self.in_flight = deque()
+        self.bytes_in_flight = 0
+        self.acked_line_num = None
+        self.error_lines = []
+        # Set record_latencies to collect the time, in seconds, from each 
+        # line being sent to GRBL acknowledging it
+        self.record_latencies = False
+        self.ack_latencies = []
+        
+        # Pause/resume/stop requests from the UI thread.  They're applied
+        # between lines by handle_commands()
+        self.command_queue = Queue.Queue()
+        # Whether the last request was to pause.  is_paused only changes 
+        # once the worker gets to the request, which may be a while if it's
+        # waiting on GRBL, so toggle_pause() goes by this instead
+        self.pause_requested = False
+        self.request_lock = threading.Lock()
+        self.last_progress_time = 0
+        # Set once did_finish() has reported the job over
+        self.finished = False
 
     def run(self):
-        if self.start_callback:
-            self.start_callback()
-        if not self.is_running:
-            self.is_running = True
-            # FIXME: need a way to identify here whether the run finished 
-            # successfully, was paused, or encountered an error
-            last_line_run = self.run_gcode( start_line=self.current_line_num)
+        # Runs on the worker thread once start() is called.  Anything the UI 
+        # needs to know goes through self.controller.post_event()
+        self.controller.post_event( JOB_STARTED)
+        try:
+            if self.start_callback:
+                self.start_callback()
+            if not self.is_running:
+                self.is_running = True
+                # FIXME: need a way to identify here whether the run finished 
+                # successfully, was paused, or encountered an error
+                last_line_run = self.run_gcode( start_line=self.current_line_num)
+        except Exception, e:
+            # e.g. the port went away, or was never opened
+            self.controller.log( "Job stopped by an error at line %s: %s"%(
+                                    self.current_line_num, e), logging.ERROR)
+            self.controller.log( traceback.format_exc(), logging.DEBUG)
+        finally:
+            # Whatever happened, the UI hears that the job's over, and the 
+            # status poller stops
+            if not self.finished:
+                self.did_finish( completed=False)
         
     def toggle_pause( self):
-        if self.is_running:
-            self.is_paused = not self.is_paused
+        # Returns the command queued (PAUSE or RESUME), or None if not running
+        with self.request_lock:
+            if not self.is_running:
+                return None
+            self.pause_requested = not self.pause_requested
+            command = PAUSE if self.pause_requested else RESUME
+            self.command_queue.put( command)
+        return command
         
     def cancel_run( self):
-        self.is_running = False
-        self.is_paused = False
-        self.current_line_num = None
+        self.command_queue.put( STOP)
+    
+    def handle_commands( self):
+        # Apply any commands queued by the UI thread.  While paused, keep
+        # waiting here until we're resumed or stopped, reading GRBL's 
+        # replies as they come so its '<Hold...>' status reports (and any
+        # acks) still get through.
+        while True:
+            if self.is_paused:
+                while self.controller.grbl_bytes_waiting():
+                    self.read_ack()
+            try:
+                command = self.command_queue.get( block=self.is_paused, 
+                                                  timeout=PAUSED_READ_INTERVAL)
+            except Queue.Empty:
+                if self.is_paused and self.is_running:
+                    continue
+                return
+            
+            if command == PAUSE:
+                self.is_paused = True
+                self.controller.log( "Paused at line %s"%self.current_line_num)
+            elif command == RESUME:
+                self.is_paused = False
+                self.controller.log( "Resuming at line %s"%self.current_line_num)
+            elif command == STOP:
+                self.is_running = False
+                self.is_paused = False
+                self.controller.log( "Stopped at line %s"%self.current_line_num)
+                
+    def report_progress( self, line_num):
+        # Let the UI know how far we've gotten, without flooding its queue
+        now = time.time()
+        if now - self.last_progress_time >= PROGRESS_INTERVAL:
+            self.last_progress_time = now
+            self.controller.post_event( JOB_PROGRESS, line_num)
         
     def sendable_part_of_line( self, gcode_line):
         # remove any comments or other code that shouldn't be sent to the machine
@@ -97,29 +337,40 @@ class GcodeRunnerThread( threading.Thread):
         
         return line
         
-    def did_finish( self):
+    def did_finish( self, completed=True):
+        self.controller.stop_status_polling()
+        # The last line GRBL answered, rather than the last one sent: when 
+        # a job stops, anything still in flight may never have run
+        last_line = self.acked_line_num
+        self.finished = True
         self.is_running = False
         self.current_line_num = None
         if self.end_callback:
             self.end_callback()
+        self.controller.post_event( JOB_FINISHED, last_line, completed, 
+                                    len( self.error_lines))
+        
+    def segments_to_run( self, start_line=0):
+        if not hasattr( self.gcode_model, 'allSegments'):
+            # Segments straight from a parser, e.g. GcodeParser.iterFile(); 
+            # they're sent as they're parsed
+            return (seg for seg in self.gcode_model if seg.lineNb >= start_line)
         
-    def run_gcode( self, start_line=0):
-        segs = self.gcode_model.allSegments()
         # find first point in allSegments with line number >= start_line
-        start_line_index = 0
-        while start_line_index < len( segs):
-            if segs[start_line_index].lineNb < start_line:
-                start_line_index += 1
-            else:
-                break # Found the starting point. Move on
-                
+        start_line_index = self.gcode_model.segmentIndex( start_line)
+        return self.gcode_model.iterSegments( start_line_index)
+        
+    def run_gcode( self, start_line=0):
         # Starting at the designated start line, send everything to 
         # the Arduino
-        for ordinal_line, segment in enumerate( segs[start_line_index:]):
+        line_num = start_line
+        for ordinal_line, segment in enumerate( self.segments_to_run( start_line)):
             line_num = segment.lineNb
             line = segment.line
             
-            if not self.is_running or self.is_paused:
+            self.handle_commands()
+            if not self.is_running:
+                self.did_finish( completed=False)
                 return line_num
             
             self.current_line_num = line_num                
@@ -128,17 +379,84 @@ class GcodeRunnerThread( threading.Thread):
             # If the line is all comment, (and thus we get back nothing from 
             # sendable_part_of_line), then don't send anything
             if line:
-                # TODO: catch any errors returned by hardware and auto-pause the controller            
-                res = self.controller.grbl_send( line)
+                if self.streaming:
+                    self.stream_line( line_num, line)
+                else:
+                    # TODO: catch any errors returned by hardware and auto-pause the controller            
+                    sent_at = self.controller.clock.time()
+                    res = self.controller.grbl_send( line)
+                    self.acked_line_num = line_num
+                    if self.record_latencies:
+                        self.ack_latencies.append( self.controller.clock.time() - sent_at)
+                    self.report_progress( line_num)
             # NOTE: off-by-one error?  Do we want to return *last line completed*
             # or *next line*?
             line_num += 1
+        
+        # Everything has been sent; collect the outstanding acknowledgements
+        # so we don't report the job finished while GRBL is still working
+        if self.streaming:
+            while self.in_flight and self.is_running:
+                self.read_ack()
+                self.handle_commands()
             
         # FIXME: to prevent sync problems, we should only read these instance 
-        # variables, yet here we are writing them.  Anyway, need a way to 
-        # signal a successful completion
-        self.did_finish()
+        # variables, yet here we are writing them.
+        self.did_finish( completed=self.is_running)
         return line_num
+    
+    def stream_line( self, line_num, line):
+        # GRBL counts every character it receives, including the newline
+        line = line.strip() + "\n"
+        line_len = len( line)
+        
+        # Block until GRBL has room for the whole line.  A line longer than
+        # the buffer itself can only be sent once everything else is acked.
+        while (self.in_flight and self.is_running and
+                self.bytes_in_flight + line_len > self.rx_buffer_size):
+            self.read_ack()
+            self.handle_commands()
+        if not self.is_running:
+            return
+        
+        self.controller.grbl_write( line)
+        self.in_flight.append( (line_num, line_len, self.controller.clock.time()))
+        self.bytes_in_flight += line_len
+        
+        # Pick up any acks or status reports that have already arrived, so 
+        # they don't sit unread until the buffer next fills up
+        while self.in_flight and self.controller.grbl_bytes_waiting():
+            self.read_ack()
+        
+    def read_ack( self):
+        # Read one response from GRBL.  If it's an 'ok' or 'error', it 
+        # belongs to the oldest line still in flight, whose bytes GRBL has
+        # now consumed.  Returns the acknowledged line number, or None if 
+        # the read timed out or returned something other than an ack.
+        res = self.controller.grbl_read_line()
+        if not res:
+            return None
+        
+        if res == 'ok' or res.startswith( 'error'):
+            if not self.in_flight:
+                self.controller.log( "Unexpected response from GRBL: %s"%res, logging.WARNING)
+                return None
+            line_num, line_len, sent_at = self.in_flight.popleft()
+            self.bytes_in_flight -= line_len
+            if self.record_latencies:
+                self.ack_latencies.append( self.controller.clock.time() - sent_at)
+            self.acked_line_num = line_num
+            self.report_progress( line_num)
+            if res != 'ok':
+                # TODO: auto-pause the controller on hardware errors
+                self.error_lines.append( (line_num, res))
+                self.controller.log( "GRBL %s on line %d"%(res, line_num), logging.ERROR)
+            return line_num
+        
+        # Anything else (status reports, alarms, feedback messages) is 
+        # handled by the controller
+        self.controller.handle_grbl_message( res)
+        return None
             
         
 class RishaController(object):    
@@ -150,14 +468,80 @@ class RishaController(object):
         self.laser_speed = 0.5 # Time in which to go jog_distance
         self.laser_power = 0.1 # Power from 0 to 1 
         self.beam_width_mm = 0.2
+        # Raster engraving: skip white rather than sweeping over it, with a
+        # laser-off run-up and run-out around each engraved stretch, and 
+        # rapids across white gaps at least this long
+        self.raster_trim_blank = True
+        self.raster_overscan_mm = 1.0
+        self.raster_rapid_gap_mm = 5.0
+        # Tone mode for raster engraving; one of raster_gcode.TONE_MODES.  
+        # Fewer gray levels make for far fewer commands.
+        self.raster_tone_mode = 'gray'
+        self.raster_tone_levels = 8
+        self.raster_threshold = 128
+        # Scale and encode raster images this many rows at a time, so memory
+        # use depends on the band rather than the image size.  0 does the 
+        # whole image at once.
+        self.raster_band_rows = 256
+        # Worker processes to encode raster bands with, when writing raster
+        # gcode to a file.  1 encodes them on this process.
+        self.raster_processes = 1
+        # Join DXF lines that share endpoints (to within this many mm) into
+        # paths, each drawn with one laser on and one laser off.  None 
+        # draws every line on its own.
+        self.dxf_chain_tolerance = chaining.DEFAULT_TOLERANCE
+        # Reorder (and reverse) DXF entities to cut down the travel between
+        # them, rather than drawing them in file order.  2-opt then looks 
+        # this many entities ahead for runs to reverse; 0 skips it.
+        self.dxf_order_paths = True
+        self.dxf_two_opt_window = ordering.DEFAULT_TWO_OPT_WINDOW
+        # Give laser power on the moves themselves ('G1 X10 S255', as in 
+        # GRBL's laser mode) rather than on separate 'M300 S' lines, for 
+        # raster and DXF jobs.  About half as many lines to send, but the
+        # firmware must take S on G1.
+        self.inline_power = False
         self.laser_off = False
         self.cur_x = 0
         self.cur_y = 0
         self.relative_mode = False
         self.logging_func = print_wrapper
+        self.logging_thread_safe = False
+        # Messages below this level (e.g. the per-line traffic with GRBL, 
+        # at DEBUG) aren't logged at all
+        self.log_level = logging.INFO
+        # Anything with time() and sleep(), used for timing the hardware's 
+        # responses.  Benchmarks swap in a simulated clock
+        self.clock = time
+        
+        # Jobs run on a GcodeRunnerThread; it reports back to the UI thread
+        # through event_queue rather than calling into the UI directly
+        self.ui_thread = threading.current_thread()
+        self.event_queue = Queue.Queue()
+        self.job_callbacks = {}
         
         self.gcode_runner_thread = None
         self.loaded_gcode = None
+        # Build gcode models as columns of numbers rather than one object 
+        # per line; much lighter for big raster jobs
+        self.columnar_models = True
+        # Use GcodeParser's fast tokenizer
+        self.fast_parsing = True
+        
+        # Everything written to the serial port goes through this lock, so 
+        # real-time commands can be slipped in between streamed lines but 
+        # never in the middle of one
+        self.serial_write_lock = threading.Lock()
+        # Seconds from a real-time command being requested (e.g. by a button 
+        # press) to its byte being written to the port, for the last hold, 
+        # cycle start or reset, and separately for the last status query
+        self.last_realtime_latency = None
+        self.last_status_query_latency = None
+        
+        # Latest GrblStatus reported by the hardware, if any.  Replaced 
+        # wholesale on each report, so it can be read from any thread
+        self.machine_status = None
+        self.status_poll_hz = STATUS_POLL_HZ
+        self.status_poller = None
         
         # Machine extents, in millimeters.  To be adjusted. 
         self.min_x = min_x
@@ -201,9 +585,9 @@ class RishaController(object):
             
         if SERIAL_MOCK:
             # NOTE: For testing purposes, -ETJ 26 Apr 2014
-            dummy_serial.DEFAULT_RESPONSE = 'ok\n'
+            # Simulated GRBL, with realistic buffer sizes and motion timing
             # dummy_serial.VERBOSE = True
-            ser = dummy_serial.Serial( port=port_name, baudrate=GRBL_BAUD, timeout=0.25)            
+            ser = dummy_serial.GrblSimulator( port=port_name, baudrate=GRBL_BAUD, timeout=0.25)
         else:
             ser = serial.Serial( port_name, GRBL_BAUD, timeout=0.25)
         
@@ -225,45 +609,151 @@ class RishaController(object):
         # Display GRBL startup code
         while ard_ser.inWaiting() > 0:
             res = ard_ser.readline()
-            self.logging_func( res)
+            self.log( res)
 
         ard_ser.flushInput()  # Flush startup text in serial input
 
-    def set_logging_func( self, func):
+    def set_logging_func( self, func, thread_safe=False):
         # func should take a string argument and store or 
         # report it in some form; for our purposes, it'll print messages
-        # from the RishaController to a console pane
+        # from the RishaController to a console pane.  If it's thread_safe
+        # (like ConsoleLog.log), it's called from whichever thread logs, 
+        # with the message's level as a second argument
         self.logging_func = func
+        self.logging_thread_safe = thread_safe
+    
+    def log( self, msg, level=logging.INFO):
+        if level < self.log_level:
+            return
+        if self.logging_thread_safe:
+            self.logging_func( msg, level)
+        # Otherwise logging_func usually writes to a widget, so only call it
+        # from the UI thread.  Messages from a job's worker thread are queued
+        elif threading.current_thread() is self.ui_thread:
+            self.logging_func( msg)
+        else:
+            self.post_event( JOB_LOG, msg)
+    
+    def post_event( self, kind, *args):
+        # Safe to call from any thread
+        self.event_queue.put( (kind, args))
+    
+    def process_events( self):
+        # Call periodically from the UI thread (e.g. via Tk's root.after())
+        # to handle everything running jobs have reported since last time.
+        # Returns the number of events handled.
+        handled = 0
+        while True:
+            try:
+                kind, args = self.event_queue.get_nowait()
+            except Queue.Empty:
+                return handled
+            handled += 1
+            
+            if kind == JOB_LOG:
+                self.logging_func( *args)
+            callback = self.job_callbacks.get( kind)
+            if callback:
+                callback( *args)
     
     def set_loaded_gcode( self, gcode_model):
         self.loaded_gcode = gcode_model
     
     def grbl_send( self, gcode):
-        line_delimiter = "\r\n"
+        # GRBL ends a line at either '\r' or '\n' and answers each one, so 
+        # sending both would produce two responses per line
+        line_delimiter = "\n"
         
         # TODO: check size of gcode so we only send one line at a time.
-        report = "Sending gcode: <%s>"%gcode
-        self.logging_func( report)
+        if self.log_level <= logging.DEBUG:
+            self.log( "Sending gcode: <%s>"%gcode, logging.DEBUG)
         
         # FIXME:  how do we listen for errors?
         if not gcode.endswith( line_delimiter):
             gcode += line_delimiter        
             
-        self.serial.write( gcode);
+        with self.serial_write_lock:
+            self.serial.write( gcode);
         # TODO: we should make sure we get an 'ok' back from any of these,
         # or stop sending
         
         # FIXME: this is just for testing's sake.  There's probably 
-        # a better way to go about waiting for responses:
+        # a better way to go about waiting for responses.
+        # Status reports (from a GrblStatusPoller) can arrive in among the 
+        # replies; they go to handle_grbl_message() rather than the log, and
+        # aren't returned
         res = self.serial.readline()
-        self.logging_func( res)
+        while res.startswith( '<'):
+            self.handle_grbl_message( res)
+            res = self.serial.readline()
+        self.log( res, grbl_response_level( res))
         
         while self.serial.inWaiting() > 0:
-            res = self.serial.readline()
-            self.logging_func( res)
+            line = self.serial.readline()
+            if line.startswith( '<'):
+                self.handle_grbl_message( line)
+                continue
+            res = line
+            self.log( res, grbl_response_level( res))
         
         return res
     
+    def grbl_write( self, gcode):
+        # Write gcode to GRBL without waiting for a response.  Callers are
+        # responsible for tracking how much of GRBL's RX buffer is in use;
+        # see GcodeRunnerThread.stream_line()
+        with self.serial_write_lock:
+            self.serial.write( gcode)
+        return len( gcode)
+    
+    def grbl_bytes_waiting( self):
+        return self.serial.inWaiting()
+    
+    def handle_grbl_message( self, msg):
+        # Deal with anything GRBL sends other than a line's ok/error
+        status = parse_grbl_status( msg, getattr( self.machine_status, 'wco', None))
+        if status:
+            self.machine_status = status
+            self.cur_x, self.cur_y = status.position()[:2]
+        else:
+            self.log( msg, grbl_response_level( msg))
+    
+    def start_status_polling( self, poll_hz=None):
+        self.stop_status_polling()
+        poller = GrblStatusPoller( self, poll_hz or self.status_poll_hz)
+        self.status_poller = poller
+        poller.start()
+    
+    def stop_status_polling( self):
+        if self.status_poller:
+            self.status_poller.stop()
+            self.status_poller = None
+    
+    def send_realtime_command( self, command, requested_at=None):
+        # Write one of GRBL's single-character real-time commands straight 
+        # to the port, bypassing the streaming queue.  requested_at is the
+        # time.time() at which the command was requested; the delay from then 
+        # until the byte is written is logged and returned, in seconds.
+        requested_at = requested_at or time.time()
+        with self.serial_write_lock:
+            self.serial.write( command)
+        latency = time.time() - requested_at
+        
+        # Status queries are sent many times a second; don't log them, or 
+        # let them hide the latency of the commands a user asked for
+        if command == GRBL_STATUS_QUERY:
+            self.last_status_query_latency = latency
+        else:
+            self.last_realtime_latency = latency
+            name = REALTIME_COMMAND_NAMES.get( command, repr( command))
+            self.log( "Sent %s in %.1f ms"%(name, latency * 1000))
+        return latency
+    
+    def grbl_read_line( self):
+        # Read one line from GRBL, stripped of its line ending.  
+        # Returns '' if nothing arrived before the serial timeout
+        return self.serial.readline().strip()
+    
     def set_relative_mode( self, mode):
         self.grbl_send( "G91" if mode else "G90")
         self.relative_mode = mode;
@@ -305,7 +795,7 @@ class RishaController(object):
                     "range: (%.1f, %.1f)-(%.1f, %.1f).  Moving to (%.1f, %.1f) instead."%
                     (req_x, req_y, self.min_x, self.min_y, self.max_x, self.max_y,
                     valid_x, valid_y))
-            self.logging_func( msg)
+            self.log( msg)
             
             if relative:
                 valid_x -= self.cur_x
@@ -347,7 +837,21 @@ class RishaController(object):
         abs_distance = abs_distance or self.jog_distance
         self.jog_relative( abs_distance, 0);
 
+    def gcode_parser( self):
+        # A new GcodeParser, set up the way this controller wants its models
+        return GcodeParser( columnar=self.columnar_models, fast=self.fast_parsing)
+    
+    def gcode_builder( self):
+        # A new GcodeBuilder, for converters that generate gcode themselves
+        return GcodeBuilder( columnar=self.columnar_models, fast=self.fast_parsing)
+        
     def set_gcode_from_file( self, file_path):
+        self.set_loaded_gcode( self.gcode_from_file( file_path))
+        return True
+    
+    def gcode_from_file( self, file_path):
+        # The gcode model for a DXF, gcode or image file, without loading 
+        # it; safe to call from a worker thread
         ext = os.path.splitext( file_path)[1].lower()
         gcode_exts = [".ngc", ".gcode"]
         dxf_exts = [".dxf"]
@@ -359,7 +863,7 @@ class RishaController(object):
             
         # if we've opened a Gcode file, split it on lines
         elif ext in gcode_exts:
-            gcode_model = GcodeParser().parseFile( file_path)
+            gcode_model = self.gcode_parser().parseFile( file_path)
 
         elif ext in raster_exts:
             gcode_model = self.gcode_from_raster( file_path, self.beam_width_mm, 
@@ -372,148 +876,135 @@ class RishaController(object):
             raise ValueError( "Unable to handle file %s"%file_path)
             
         # NOTE: need to detect strange line splits (\n\r, \r\n, etc.)?
-        self.set_loaded_gcode( gcode_model)
-        return True        
+        return gcode_model
     
-    # TODO: remove from class; this is just a function
     def run_length_encode(self,  an_arr):
-        if len( an_arr) == 0: 
-            return []
-            
-        cur_count = 1
-        cur_val = an_arr[0]
-        loc = 1
-        res = [[cur_count, cur_val]]    
-    
-        while loc < len( an_arr):
-            if an_arr[loc] == cur_val:
-                res[-1][0] += 1  #increment count
-                loc += 1
-            else:
-                cur_val = an_arr[loc]
-                res.append([1,cur_val]) # add new count
-                loc += 1
-        
-        return res
-        
+        return raster_gcode.run_length_encode( an_arr)
     
     def gcode_from_raster( self, image_path, beam_width_mm, 
                              min_engrave_power, max_engrave_power,
                             engrave_speed=1000, upper_left=( 0,0),
                             prescale=1.0):
-        # We assume that gray_image has been scaled so that one pixel represents
-        # a square beam_width_mm x beam_width_mm
-        gcode_arr = []
-    
-    
-        gray_image = self.grayscale_raster_from_image( image_path, beam_width_mm, prescale=prescale)
-
-        def laser_engrave_power( val, min_engrave_power=0, max_engrave_power=255, ):
-            # val must be in [0,255]
-            # Light values will get a small engrave power, dark ones will get a large power
-            new_val = min_engrave_power + (255-val)/255 * (max_engrave_power - min_engrave_power)
-            return new_val
-    
-        # TODO: relative motion may be broken in GcodeParser.  Use absolute until that's fixed
-        ul_x, ul_y = upper_left
-        old_engrave_power = 0
-        
-        gcode_arr.append('''(Set speed)
-G1 F%(engrave_speed)s 
-( Laser off)
-M300 S%(old_engrave_power)s  
-G91 ; absolute movement 
-(Move to upper left)
-G1 X%(ul_x)s Y%(ul_y)s'''%vars())
-    
-        w, h = gray_image.size
-        pixels = list(gray_image.getdata())
-        
-        for y in range( h):
-            # Move down one row
-            y_pos = beam_width_mm * y
-            gcode_arr.append( 'G1 Y%(y_pos)s '%vars())             
-            
-            row_start = w *y
-            row = pixels[ w*y: w*(y+1)]    
-            
-            # Returns an array of (length, value pairs), with all identical
-            # neighbors incorporated into a single pair
-            # e.g  [ 0, 1, 1, 2, 2, 2, 2]  => [ [1, 0], [2, 1], [4, 2]]
-            row_rle = self.run_length_encode( row)
-            if y %2 == 0:
-                row_loc = 0
-                direction_sign = 1
-            else:
-                row_rle = row_rle[::-1]
-                row_loc = w
-                direction_sign = -1
-            
-            # print "************************************************************"
-            # import sys,os
-            # classOrFile = self.__class__.__name__ if 'self' in vars() else os.path.basename(__file__)
-            # method = sys._getframe().f_code.co_name
-            # print "%(classOrFile)s:%(method)s"%vars()
-            # print '\trow_rle:  %s'% str(row_rle)
-            # print "************************************************************"
-
-                
-            for count, val in row_rle:
-                engrave_power = laser_engrave_power( val, min_engrave_power, max_engrave_power )
-                # NOTE: off by one?  How do we write a single pixel at beginning of a line?
-                row_loc = row_loc + (direction_sign * count * beam_width_mm )
-                gcode_arr.append( 'M300 S%(engrave_power)s '%vars())
-                gcode_arr.append( 'G1 X%(row_loc)s'%vars())
-                
-            
-        # Finish & turn off laser
-        gcode_arr.append( 'M300 S0')
-        
-        gcode_str =  "\n".join(gcode_arr)
-        # ETJ DEBUG
-        # print "************************************************************"
-        # import sys,os
-        # classOrFile = self.__class__.__name__ if 'self' in vars() else os.path.basename(__file__)
-        # method = sys._getframe().f_code.co_name
-        # print "%(classOrFile)s:%(method)s"%vars()
-        # print '\tw:  %s'% w
-        # print '\th:  %s'% h
-        # print "************************************************************"
-
-        # print gcode_str
-        open( "/Users/jonese/Projects/RishaLaser/RishaController/examples/_test.ngc", "w").write(gcode_str)
-        # END DEBUG 
-        # Generate a Gcode model and return it
-        gcode_model = GcodeParser().parseString( gcode_str)
+        # The image is scaled so that one pixel represents a square 
+        # beam_width_mm x beam_width_mm
+        bands = self.raster_bands( image_path, beam_width_mm, prescale=prescale)
         
+        # TODO: relative motion may be broken in GcodeParser.  Use absolute until that's fixed
+        # Build the Gcode model directly; its lines' text is only made as 
+        # they're sent
+        gcode_model = raster_gcode.model_from_raster_bands( bands, beam_width_mm,
+                                    min_engrave_power, max_engrave_power,
+                                    self.gcode_builder(), engrave_speed=engrave_speed, 
+                                    upper_left=upper_left, 
+                                    trim_blank=self.raster_trim_blank,
+                                    overscan_mm=self.raster_overscan_mm,
+                                    rapid_gap_mm=self.raster_rapid_gap_mm,
+                                    inline_power=self.inline_power,
+                                    bed_width_mm=self.max_x)
         # ETJ DEBUG
-        # small_gcode = "\n".join(gcode_arr[:30])
-        # print small_gcode
-        # gcode_model = GcodeParser().parseString( small_gcode)
+        # open( "examples/_test.ngc", "w").write( raster_gcode.gcode_from_raster( 
+        #       gray_image, beam_width_mm, min_engrave_power, max_engrave_power,
+        #       engrave_speed=engrave_speed, upper_left=upper_left))
         # END DEBUG 
         return gcode_model
     
+    def write_gcode_from_raster( self, image_path, gcode_path, beam_width_mm, 
+                                 min_engrave_power, max_engrave_power,
+                                 engrave_speed=1000, upper_left=( 0,0),
+                                 prescale=1.0):
+        # Write the gcode for a raster job to gcode_path as it's made, a 
+        # band at a time, without building a model; run_gcode_file() can
+        # then send it without loading it either
+        bands = self.raster_bands( image_path, beam_width_mm, prescale=prescale)
+        gcode_file = open( gcode_path, "w")
+        try:
+            for piece in raster_gcode.iter_raster_gcode( bands, beam_width_mm,
+                                    min_engrave_power, max_engrave_power,
+                                    engrave_speed=engrave_speed, 
+                                    upper_left=upper_left, 
+                                    trim_blank=self.raster_trim_blank,
+                                    overscan_mm=self.raster_overscan_mm,
+                                    rapid_gap_mm=self.raster_rapid_gap_mm,
+                                    inline_power=self.inline_power,
+                                    processes=self.raster_processes,
+                                    bed_width_mm=self.max_x):
+                gcode_file.write( piece)
+        finally:
+            gcode_file.close()
+        return gcode_path
+    
+    def raster_bands( self, image_path, beam_width_mm, prescale=1.0):
+        # The image at image_path, scaled and toned for engraving, as 
+        # (first row, image) bands of self.raster_band_rows rows.  It's all
+        # one band if raster_band_rows is 0, or if the tone mode needs the
+        # whole image.
+        if not self.raster_band_rows or self.raster_tone_mode not in raster_gcode.BAND_TONE_MODES:
+            gray_image = self.grayscale_raster_from_image( image_path, beam_width_mm, prescale=prescale)
+            if self.raster_tone_mode != 'gray':
+                gray_image = self.apply_raster_tone( gray_image, beam_width_mm)
+            return [(0, gray_image)]
+        
+        bands = raster_gcode.image_bands( image_path, beam_width_mm, prescale=prescale,
+                                          band_rows=self.raster_band_rows)
+        if self.raster_tone_mode != 'gray':
+            bands = self.apply_raster_tone_to_bands( bands, beam_width_mm)
+        return bands
+    
+    def apply_raster_tone( self, gray_image, beam_width_mm):
+        # Apply self.raster_tone_mode to gray_image, and log how many 
+        # commands that saves
+        toned_image, commands_before, commands_after = self.tone_raster( gray_image, 
+                                                                beam_width_mm)
+        self.log_tone_savings( commands_before, commands_after)
+        return toned_image
+    
+    def apply_raster_tone_to_bands( self, bands, beam_width_mm):
+        # apply_raster_tone() to each of bands in turn, logging the 
+        # savings once they're all done
+        commands_before = commands_after = 0
+        for first_row, band in bands:
+            toned_band, before, after = self.tone_raster( band, beam_width_mm, first_row)
+            commands_before += before
+            commands_after += after
+            yield first_row, toned_band
+        self.log_tone_savings( commands_before, commands_after)
+    
+    def tone_raster( self, gray_image, beam_width_mm, first_row=0):
+        # Returns (toned image, commands before, commands after)
+        commands_before = self.raster_command_count( gray_image, beam_width_mm)
+        toned_image = raster_gcode.apply_tone( gray_image, self.raster_tone_mode,
+                                levels=self.raster_tone_levels, 
+                                threshold=self.raster_threshold,
+                                first_row=first_row)
+        commands_after = self.raster_command_count( toned_image, beam_width_mm)
+        return toned_image, commands_before, commands_after
+    
+    def raster_command_count( self, gray_image, beam_width_mm):
+        # Lines the raster job for gray_image will have, with the same 
+        # trim, overscan and power options the job itself is made with.  
+        # For a band, it's counted as if the band were the whole job, which
+        # can be out by a line or two where bands meet.
+        return raster_gcode.raster_command_count( gray_image, 
+                                    inline_power=self.inline_power,
+                                    trim_blank=self.raster_trim_blank,
+                                    beam_width_mm=beam_width_mm,
+                                    overscan_mm=self.raster_overscan_mm,
+                                    rapid_gap_mm=self.raster_rapid_gap_mm)
+    
+    def log_tone_savings( self, commands_before, commands_after):
+        saved = commands_before - commands_after
+        self.log( "Tone mode %s: %d raster commands instead of %d (%d fewer, %.0f%%)"%(
+                    self.raster_tone_mode, commands_after, commands_before, saved,
+                    100 * saved / commands_before if commands_before else 0))
+    
     def grayscale_raster_from_image( self, image_path, beam_width_mm, prescale=1.0):
         # Open image & convert to grayscale
         im = Image.open( image_path).convert("L")
     
         # Resize the image so we have one single pixel for each space the laser
         # can fill (a square  beam_width_mm x beam_width_mm)
-        
-        dpi = im.info['dpi'][0] # Technically, there could be separate x/y dpis
-        new_dpi = beam_width_mm * 25.4
-    
-        w, h = im.size
-        # NOTE: technically, we might want different ratios for X & Y, since 
-        # each pixel is burned one step next to its left and right neighbors 
-        # but hundreds of steps away from its up and down neighbors.  For the 
-        # moment, let's treat both directions as identical though -ETJ 01 May 2014
-        w_inches = w / dpi
-        h_inches = h / dpi
+        new_w, new_h = raster_gcode.raster_size( im, beam_width_mm, prescale)
         new_dpi =  25.4 / beam_width_mm 
-        
-        new_w = int( w_inches * new_dpi * prescale)
-        new_h = int( h_inches * new_dpi * prescale)
         im_2 =  im.resize( (new_w, new_h), resample=PIL.Image.BILINEAR)
         im_2.info['dpi'] = ( new_dpi, new_dpi)
     
@@ -537,45 +1028,91 @@ G1 X%(ul_x)s Y%(ul_y)s'''%vars())
         stop_delay = 120
         line_width = 0.5
         
-        context = GCodeContext(z_feedrate, z_height, xy_feedrate, start_delay, stop_delay, line_width, dxf_path)
+        context = GCodeContext(z_feedrate, z_height, xy_feedrate, start_delay, stop_delay, line_width, dxf_path,
+                               inline_power=self.inline_power)
         dxf_parser.parse()
-        for entity in dxf_parser.entities:
+        entities = dxf_parser.entities
+        if self.dxf_chain_tolerance is not None:
+            entities = chaining.chain_entities( entities, self.dxf_chain_tolerance)
+            self.log( "Chained %d DXF entities into %d"%(len( dxf_parser.entities), len( entities)))
+        if self.dxf_order_paths:
+            travel_before = ordering.travel_distance( entities)
+            entities = ordering.order_entities( entities, two_opt_window=self.dxf_two_opt_window)
+            self.log( "DXF travel %.1f mm in file order, %.1f mm reordered"%(
+                        travel_before, ordering.travel_distance( entities)))
+        for entity in entities:
             entity.get_gcode(context)
-        all_gcode = context.generate( should_print=False) 
-        
-        gcode_model = GcodeParser().parseString( all_gcode)
+        # Feed the lines straight to the model, rather than joining them 
+        # into one big string and splitting it up again
+        builder = self.gcode_builder()
+        for line in context.lines():
+            builder.addLine( line)
+        gcode_model = builder.finish()
         dxf_file.close()
         
         return gcode_model
                 
         
-    def run_gcode( self, gcode_model=None, start_callback=None, end_callback=None):
+    def run_gcode_file( self, file_path, start_callback=None, end_callback=None,
+                        progress_callback=None):
+        # Run a gcode file without loading it first: lines are parsed on 
+        # the runner thread and sent as they're parsed, so the job starts 
+        # at once and memory stays flat however big the file is
+        segments = self.gcode_parser().iterFile( file_path)
+        return self.run_gcode( segments, start_callback, end_callback, 
+                                progress_callback)
+    
+    def run_gcode( self, gcode_model=None, start_callback=None, end_callback=None,
+                    progress_callback=None):
+        # Start running gcode_model on a background GcodeRunnerThread.  The 
+        # callbacks are invoked on the UI thread from process_events():
+        # start_callback(), progress_callback( line_num), and 
+        # end_callback( last_line, completed, error_count), where last_line
+        # is the last line GRBL acknowledged (None if none).  gcode_model 
+        # may also be an iterator of segments, as from GcodeParser.iterFile()
         gcode_model = gcode_model or self.loaded_gcode
-        t = GcodeRunnerThread( self, gcode_model, start_callback, end_callback)
-        self.gcode_runner_thread = t
-        # TODO: validate that we can run code - we're not already running
-        # something else, the hardware is connected, etc.
+        # TODO: validate that we can run code - the hardware is connected, etc.
+        if self.gcode_runner_thread and self.gcode_runner_thread.is_alive():
+            self.log( "A job is already running; stop it before starting another")
+            return False
         
-        # ETJ DEBUG
-        print "Beginning GcodeRunnerThread"
-        # END DEBUG
-        self.gcode_runner_thread.run()
-        
-        # ETJ DEBUG
-        print "gcode_runner_thread has begun"
-        # END DEBUG
+        self.job_callbacks = { JOB_STARTED: start_callback,
+                               JOB_PROGRESS: progress_callback,
+                               JOB_FINISHED: end_callback}
+        # Start polling first; the runner stops the poller when it finishes
+        if self.status_poll_hz:
+            self.start_status_polling()
+        t = GcodeRunnerThread( self, gcode_model)
+        self.gcode_runner_thread = t
+        self.gcode_runner_thread.start()
+        return True
         
-    def toggle_pause_gcode( self):
-        # ETJ DEBUG
-        print "toggle_pause_gcode() called"
-        # END DEBUG
-        self.gcode_runner_thread.toggle_pause_gcode()
+    def toggle_pause_gcode( self, requested_at=None):
+        # Hold or resume motion right away with a real-time command, and
+        # tell the runner to stop or resume feeding GRBL new lines.
+        requested_at = requested_at or time.time()
+        if not self.gcode_runner_thread:
+            return
+        command = self.gcode_runner_thread.toggle_pause()
+        if command == PAUSE:
+            self.send_realtime_command( GRBL_FEED_HOLD, requested_at)
+        elif command == RESUME:
+            self.send_realtime_command( GRBL_CYCLE_START, requested_at)
     
-    def stop_gcode( self):
-        # ETJ DEBUG
-        print "stop_gcode() called"
-        # END DEBUG
+    def stop_gcode( self, requested_at=None):
+        # Feed hold stops motion immediately; the soft reset then throws away
+        # everything GRBL has buffered, so we don't wait for it to drain.
+        # NOTE: GRBL may still raise an alarm if the reset arrives before the
+        # hold has decelerated, in which case it'll need unlocking ($X)
+        requested_at = requested_at or time.time()
+        # Nothing to stop once a job's over; don't reset an idle machine
+        if not (self.gcode_runner_thread and self.gcode_runner_thread.is_alive()):
+            self.log( "No job is running")
+            return
         self.gcode_runner_thread.cancel_run()
+        if self.serial:
+            self.send_realtime_command( GRBL_FEED_HOLD, requested_at)
+            self.send_realtime_command( GRBL_SOFT_RESET, requested_at)
         
 # ETJ DEBUG
 # TODO: remove this; it's just for convenience when debugging so that
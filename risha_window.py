@@ -1,13 +1,17 @@
 #! /usr/bin/python
 # -*- coding: UTF-8 -*-
-import os, sys, re
+import os, sys, re, time
+import Queue
 from Tkinter import *
 import tkFileDialog
+from PIL import ImageTk
 
 import risha_controller
 from risha_controller import RishaController
 
 from YAGV import gcodeParser
+import gcode_preview
+import console_log
 
 root = None
 
@@ -22,6 +26,40 @@ if DEBUG:
 
 CONNECTED, DISCONNECTED = ("Connected", "Not Connected")
 
+# How often, in milliseconds, the Tk loop checks for events from a running job
+EVENT_POLL_MS = 50
+
+# How often, in milliseconds, the Tk loop picks up preview pieces while a 
+# preview is being drawn, and how long (in seconds) it spends on them at most
+PREVIEW_POLL_MS = 20
+PREVIEW_POLL_BUDGET = 0.03
+
+# Zooming: each mouse wheel click zooms by ZOOM_STEP, between 
+# VIEW_MIN_SCALE and VIEW_MAX_SCALE canvas pixels per mm.  The preview is 
+# redrawn VIEW_REDRAW_MS after zooming, panning or resizing stops
+ZOOM_STEP = 1.25
+VIEW_MIN_SCALE = 0.05
+VIEW_MAX_SCALE = 200.0
+VIEW_REDRAW_MS = 150
+
+# While a job runs, what's been done is marked over the preview in 
+# PROGRESS_COLOR, with a dot of HEAD_RADIUS pixels where the head is.  The 
+# marks are brought up to date at most once every PROGRESS_FRAME_S seconds
+PROGRESS_COLOR = "#E0301E"
+PROGRESS_WIDTH = 2
+HEAD_RADIUS = 4
+PROGRESS_FRAME_S = 0.1
+# More new marks than this at once (rasters, mostly) and the head's whole
+# path is marked instead, as one canvas item, so they don't pile up
+PROGRESS_MAX_ITEMS = 20
+
+# The console keeps the last CONSOLE_MAX_LINES messages at CONSOLE_LEVEL or
+# above, and shows new ones CONSOLE_FLUSH_HZ times a second.  DEBUG shows 
+# every line sent to GRBL and its response
+CONSOLE_MAX_LINES = 1000
+CONSOLE_LEVEL = console_log.INFO
+CONSOLE_FLUSH_HZ = 5
+
 
 def next_color():
     # This cycles a global variable through different colors so we 
@@ -63,8 +101,11 @@ class ReadOnlyText(Text):
 
 class RishaWindow( object):
     def __init__( self, master):
+        self.master = master
         # Create laser controller object
         self.rc = RishaController( connect_immediately=False)
+        self.console_log = console_log.ConsoleLog( CONSOLE_MAX_LINES, CONSOLE_LEVEL)
+        self.rc.log_level = CONSOLE_LEVEL
         
         # Set up UI
         self.declare_instance_widgets()
@@ -78,12 +119,32 @@ class RishaWindow( object):
 
         # Connect controller to actual hardware
         try: 
-            self.rc.set_logging_func( self.append_to_console)
+            self.rc.set_logging_func( self.console_log.log, thread_safe=True)
             # self.rc.connect_hardware()
         except Exception, e:
             print e
             print("Couldn't find hardware to connect to. Connect manually "
                 "using the interface instead")
+        
+        # Jobs run on a worker thread; pick up their progress from here
+        self.poll_controller_events()
+        self.flush_console()
+    
+    def poll_controller_events( self):
+        # Runs on the Tk main loop.  Handles whatever the controller's worker
+        # thread has reported since the last poll, then reschedules itself
+        self.rc.process_events()
+        self.update_machine_position()
+        self.update_progress()
+        self.master.after( EVENT_POLL_MS, self.poll_controller_events)
+    
+    def update_machine_position( self):
+        # machine_status is swapped in whole by the controller, so reading 
+        # it here needs no locking
+        status = self.rc.machine_status
+        if status is not self.displayed_status:
+            self.displayed_status = status
+            self.machine_position_var.set( str( status) if status else "Position unknown")
     
     def declare_instance_widgets( self):
         # Declare all the widgets we'll need to communicate with
@@ -110,11 +171,43 @@ class RishaWindow( object):
         self.laser_power_var = None
         self.laser_power_slider = None
         
+        # Live machine position
+        self.machine_position_var = None
+        self.displayed_status = None
+        
         # Console
         self.console_textfield = None
         
         # Image
         self.image_canvas = None
+        # The PreviewThread drawing on the canvas, and the PhotoImage it 
+        # last sent (Tk doesn't keep a reference to it)
+        self.preview_thread = None
+        self.preview_photo = None
+        self.preview_file_path = None
+        # The model's level-of-detail pyramid, once it's built, and what 
+        # part of the job the canvas shows: pixels per mm, and the job 
+        # point at its lower left.  home_origin is where a new preview starts
+        self.preview_pyramid = None
+        self.view_scale = 1.0
+        self.view_origin = (0.0, 0.0)
+        self.home_origin = (0.0, 0.0)
+        # Set when the view has changed before the pyramid was built, and 
+        # when the redrawn preview is yet to arrive to replace what's on 
+        # the canvas
+        self.view_redraw_pending = False
+        self.preview_stale = False
+        self.view_redraw_id = None
+        self.drag_from = None
+        # Progress of the running job: the model it's running, the last 
+        # line acknowledged, how many of the model's segments are marked 
+        # done, and the head's job position and canvas item
+        self.progress_model = None
+        self.progress_line = None
+        self.progress_done = 0
+        self.progress_drawn_at = 0
+        self.progress_head = None
+        self.progress_head_item = None
         
         # Image controls
         self.load_image_button = None
@@ -170,8 +263,23 @@ class RishaWindow( object):
         # running, start disabled when paused)
         self.load_image_button.configure( command=self.open_readable_file)
         self.start_cut_button.configure( command=self.run_gcode)
-        self.pause_cut_button.configure( command=self.rc.toggle_pause_gcode) 
-        self.stop_cut_button.configure( command=self.rc.stop_gcode)
+        # Note the time of the press, so the controller can report how long
+        # the real-time command took to reach the serial port
+        self.pause_cut_button.configure( 
+                command=lambda: self.rc.toggle_pause_gcode( requested_at=time.time())) 
+        self.stop_cut_button.configure( 
+                command=lambda: self.rc.stop_gcode( requested_at=time.time()))
+        
+        # Zoom with the mouse wheel, pan by dragging, double-click to go
+        # back to where the preview started
+        canvas = self.image_canvas
+        canvas.bind( "<MouseWheel>", lambda e: self.zoom_view( e.x, e.y, e.delta > 0))
+        canvas.bind( "<Button-4>", lambda e: self.zoom_view( e.x, e.y, True))
+        canvas.bind( "<Button-5>", lambda e: self.zoom_view( e.x, e.y, False))
+        canvas.bind( "<ButtonPress-1>", self.start_pan)
+        canvas.bind( "<B1-Motion>", self.pan_view)
+        canvas.bind( "<Double-Button-1>", lambda e: self.reset_view())
+        canvas.bind( "<Configure>", lambda e: self.schedule_view_redraw())
         
     def grid_win( self, master):
         grid = Frame( master, default_options())
@@ -269,6 +377,12 @@ class RishaWindow( object):
         lps_label.grid( column=0, row=4)
         self.laser_power_slider.grid( column=1, row=4)
         
+        # Laser's current location, as last reported by GRBL
+        self.machine_position_var = StringVar( jof)
+        self.machine_position_var.set( "Position unknown")
+        machine_position_label = Label( jof, textvar=self.machine_position_var)
+        machine_position_label.grid( column=0, row=5, columnspan=3)
+        
         return jof
         
     def jog_control_quad( self, master):
@@ -295,14 +409,27 @@ class RishaWindow( object):
         
         return console_textfield
     
-    def append_to_console( self, text):
-        if not text.endswith( "\n"):
-            text += "\n"
-
+    def append_to_console( self, text, level=console_log.INFO):
+        # Shown at the next flush_console()
         if DEBUG:
             print text
-        self.console_textfield.insert( END, text)
-        self.console_textfield.see( END)
+        self.console_log.log( text, level)
+    
+    def flush_console( self):
+        # Runs on the Tk main loop: shows everything logged since the last 
+        # flush with one insert, and trims the console to CONSOLE_MAX_LINES
+        messages, dropped = self.console_log.take_new()
+        if messages or dropped:
+            console = self.console_textfield
+            if dropped:
+                messages.insert( 0, "(%d messages not shown)"%dropped)
+            console.insert( END, "\n".join( messages) + "\n")
+            # The text always ends with a newline, so the last line is empty
+            lines = int( console.index( "end-1c").split( ".")[0]) - 1
+            if lines > CONSOLE_MAX_LINES:
+                console.delete( "1.0", "%d.0"%(lines - CONSOLE_MAX_LINES + 1))
+            console.see( END)
+        self.master.after( 1000 // CONSOLE_FLUSH_HZ, self.flush_console)
         
     # I M A G E   F R A M E
     def make_image_frame( self, master):
@@ -341,7 +468,7 @@ class RishaWindow( object):
         # directory as the next initialdirectory
         # options: defaultextension, filetypes, initialdir, initialfile, multiple, message, parent, title
         # NOTE: Any change in accepted file types will also have to change code
-        # in risha_controller.set_gcode_from_file()
+        # in risha_controller.gcode_from_file()
         if not file_path:
             fts = [("2D DXF files", '.dxf'), 
                     ('2D Gcode files', '.gcode'),
@@ -357,17 +484,13 @@ class RishaWindow( object):
             options = {'initialdir': examples_dir, 
                         'filetypes':fts}
             file_path = tkFileDialog.askopenfilename( **options)
+            if not file_path:
+                return
         
-        res = self.rc.set_gcode_from_file( file_path)
-        
-        if res:
-            # NOTE: need to detect strange line splits (\n\r, \r\n, etc.)?
-            self.append_to_console( "Loaded file: %s"%file_path)
-            self.draw_gcode( self.rc.loaded_gcode)
-        else:
-            # Some error in loading Gcode
-            print "Error loading Gcode from file %(file_path)s "%vars()
-                    
+        # Converting and parsing happen on the preview thread; the file is 
+        # loaded when its model arrives, in handle_preview_event()
+        self.start_preview( load=lambda: self.rc.gcode_from_file( file_path),
+                            file_path=file_path)
 
     
 
@@ -380,58 +503,251 @@ class RishaWindow( object):
                 
     def run_gcode( self):
         # Disable applicable buttons while we're running
-        self.rc.run_gcode( start_callback=self.gcode_starting, end_callback=self.gcode_finished)
+        gcode_model = self.rc.loaded_gcode
+        if self.rc.run_gcode( start_callback=self.gcode_starting, end_callback=self.gcode_finished,
+                              progress_callback=self.gcode_progress):
+            self.clear_progress()
+            # Progress can only be shown for models that know which segments 
+            # each line makes
+            if hasattr( gcode_model, 'segmentIndex'):
+                self.progress_model = gcode_model
     
     def gcode_starting( self):
         self.set_jog_buttons_enabled( False)
     
-    def gcode_finished( self):
+    def gcode_progress( self, line_num):
+        # Picked up by update_progress()
+        self.progress_line = line_num
+    
+    def gcode_finished( self, last_line, completed, error_count):
+        # last_line is the last line GRBL acknowledged, or None
+        if completed:
+            msg = "Job finished"
+        elif last_line is None:
+            msg = "Job stopped before any line ran"
+        else:
+            msg = "Job stopped at line %s"%last_line
+        if error_count:
+            msg += " (%d errors reported by GRBL)"%error_count
+        self.append_to_console( msg)
         self.set_jog_buttons_enabled( True)
+        # Mark the rest of a finished job, and stop following it.  A stopped
+        # job's marks stay where its progress reports left them; the lines
+        # after those may never have run
+        if completed:
+            self.progress_line = last_line
+            self.update_progress( force=True)
+        self.progress_model = None
     
     def clear_canvas( self):
         self.image_canvas.delete('all')
+        # The progress marks went with everything else
+        self.progress_model = None
+        self.progress_done = 0
+        self.progress_head = None
+        self.progress_head_item = None
+    
+    def clear_progress( self):
+        self.image_canvas.delete( "progress", "progress_head")
+        self.progress_model = None
+        self.progress_line = None
+        self.progress_done = 0
+        self.progress_head = None
+        self.progress_head_item = None
+    
+    def update_progress( self, force=False):
+        # Mark the segments done since the last update, and move the head.  
+        # Only the new segments are drawn, so this stays quick however far
+        # into the job it is
+        if not self.progress_model or self.progress_line is None:
+            return
+        now = time.time()
+        if not force and now - self.progress_drawn_at < PROGRESS_FRAME_S:
+            return
+        done = self.progress_model.segmentIndex( self.progress_line + 1)
+        if done <= self.progress_done:
+            return
+        self.progress_drawn_at = now
+        polylines, head = gcode_preview.progress_polylines( self.progress_model, 
+                                self.progress_done, done, self.preview_viewport(), 
+                                PROGRESS_MAX_ITEMS)
+        for coords in polylines:
+            self.image_canvas.create_line( coords, fill=PROGRESS_COLOR, width=PROGRESS_WIDTH, 
+                                           tags="progress")
+        self.progress_done = done
+        if head:
+            self.progress_head = head
+            self.place_progress_head()
+    
+    def place_progress_head( self):
+        if not self.progress_head:
+            return
+        x, y = self.preview_viewport().to_canvas( *self.progress_head)
+        box = (x - HEAD_RADIUS, y - HEAD_RADIUS, x + HEAD_RADIUS, y + HEAD_RADIUS)
+        canvas = self.image_canvas
+        if self.progress_head_item:
+            canvas.coords( self.progress_head_item, box)
+        else:
+            self.progress_head_item = canvas.create_oval( box, fill=PROGRESS_COLOR, outline="", 
+                                                          tags="progress_head")
+        canvas.tag_raise( self.progress_head_item)
+    
+    def raise_progress( self):
+        # Keep the progress marks over newly drawn preview pieces
+        if self.progress_done:
+            self.image_canvas.tag_raise( "progress")
+        if self.progress_head_item:
+            self.image_canvas.tag_raise( self.progress_head_item)
     
     # TODO: add transform to this method, so we can move, scale, & rotate
     # an arbitrary piece of gcode
     def draw_gcode( self, gcode_model, clear_canvas=True, origin_pt=None):
-        origin_x, origin_y = origin_pt if origin_pt else (0, 0)
+        # origin_pt is where on the canvas (from its lower left) the job's 
+        # origin goes
+        self.start_preview( gcode_model, clear_canvas=clear_canvas, origin_pt=origin_pt)
+    
+    def start_preview( self, gcode_model=None, load=None, file_path=None, clear_canvas=True, 
+                        origin_pt=None):
+        # Draw gcode_model, or the model load() makes from file_path, from
+        # a PreviewThread.  Whatever preview was being drawn is abandoned.
+        if self.preview_thread:
+            self.preview_thread.cancel()
+        self.preview_file_path = file_path
+        self.preview_pyramid = None
+        self.view_redraw_pending = False
+        self.preview_stale = False
         if clear_canvas:
             self.clear_canvas()
         
-        cur_color = "#FFF"
-        
-        # Start at origin.  
-        last_x, last_y = origin_x, self.image_canvas.winfo_height() - origin_y
-        # Draw all appropriate segments
-        for i, segment in enumerate(gcode_model.allSegments()):
-            #  ETJ DEBUG
-            # print '%d \tsegment: %s'%(i, segment)
-            #  END DEBUG 
-            
-            # Gcode has an origin at lower left, Canvas
-            # at upper left.  Invert Y values to account for this
-            next_x = segment.coords['X']
-            next_y = self.image_canvas.winfo_height() - segment.coords['Y']
-            
-            if segment.style == gcodeParser.META:
-                # Change laser power as requested.  
-                # This line isn't needed assuming that 
-                # gcode_model.classifySegments() has been run
-                new_power = segment.coords.get('S', 0)
-                # Power burns at power = 255, which we want to draw at #000, 
-                # so invert the color
-                inverted_color = 255-new_power 
-                cur_color = "#%x%x%x"%(inverted_color, inverted_color, inverted_color)
-                gcode_model.setLaserPower( new_power)
-                pass
-                
-            if segment.style in [gcodeParser.DRAW, gcodeParser.EXTRUDE]:
-                self.image_canvas.create_line( last_x, last_y, next_x, next_y, fill=cur_color)
-                
-            elif segment.style == gcodeParser.FLY:
-                pass
-            last_x = next_x
-            last_y = next_y
+        origin_x, origin_y = origin_pt if origin_pt else (0, 0)
+        self.home_origin = (-origin_x, -origin_y)
+        self.view_scale = 1.0
+        self.view_origin = self.home_origin
+        self.preview_thread = gcode_preview.PreviewThread( self.preview_viewport(), gcode_model, 
+                                                load, self.preview_background())
+        self.preview_thread.start()
+        self.poll_preview( self.preview_thread)
+    
+    def preview_viewport( self):
+        canvas = self.image_canvas
+        return gcode_preview.Viewport( canvas.winfo_width(), canvas.winfo_height(),
+                                       self.view_scale, self.view_origin)
+    
+    def preview_background( self):
+        canvas = self.image_canvas
+        return tuple( c // 256 for c in canvas.winfo_rgb( canvas.cget( "bg")))
+    
+    def zoom_view( self, x, y, zoom_in):
+        # Zoom about canvas point (x, y)
+        factor = ZOOM_STEP if zoom_in else 1 / ZOOM_STEP
+        scale = min( max( self.view_scale * factor, VIEW_MIN_SCALE), VIEW_MAX_SCALE)
+        height = self.image_canvas.winfo_height()
+        job_x, job_y = self.preview_viewport().to_job( x, y)
+        self.set_view( scale, (job_x - x / scale, job_y - (height - y) / scale))
+    
+    def start_pan( self, event):
+        self.drag_from = (event.x, event.y)
+    
+    def pan_view( self, event):
+        if not self.drag_from:
+            return
+        dx, dy = event.x - self.drag_from[0], event.y - self.drag_from[1]
+        self.drag_from = (event.x, event.y)
+        self.set_view( self.view_scale, (self.view_origin[0] - dx / self.view_scale, 
+                                         self.view_origin[1] + dy / self.view_scale))
+    
+    def reset_view( self):
+        self.set_view( 1.0, self.home_origin)
+    
+    def set_view( self, scale, origin):
+        # Show the job at scale pixels per mm with origin at the canvas' 
+        # lower left.  What's on the canvas is scaled and moved to match at 
+        # once, and redrawn in detail once the view stops changing
+        if (scale, origin) == (self.view_scale, self.view_origin):
+            return
+        factor = scale / self.view_scale
+        dx = (self.view_origin[0] - origin[0]) * scale
+        dy = (origin[1] - self.view_origin[1]) * scale
+        height = self.image_canvas.winfo_height()
+        self.view_scale, self.view_origin = scale, origin
+        
+        tags = ["preview", "progress"] if self.progress_done else ["preview"]
+        for tag in tags:
+            # Scaling about the lower left keeps job points' distance from 
+            # the old origin in step with the new scale
+            if factor != 1:
+                self.image_canvas.scale( tag, 0, height, factor, factor)
+            self.image_canvas.move( tag, dx, dy)
+        self.place_progress_head()
+        self.schedule_view_redraw()
+    
+    def schedule_view_redraw( self):
+        if self.view_redraw_id:
+            self.master.after_cancel( self.view_redraw_id)
+        self.view_redraw_id = self.master.after( VIEW_REDRAW_MS, self.redraw_view)
+    
+    def redraw_view( self):
+        # Draw the current view from the pyramid, on a new PreviewThread.  
+        # Until the pyramid's built, the loading thread redraws when it is
+        self.view_redraw_id = None
+        if not self.preview_pyramid:
+            self.view_redraw_pending = True
+            return
+        self.view_redraw_pending = False
+        self.preview_stale = True
+        if self.preview_thread:
+            self.preview_thread.cancel()
+        self.preview_thread = gcode_preview.PreviewThread( self.preview_viewport(), 
+                            background=self.preview_background(), pyramid=self.preview_pyramid)
+        self.preview_thread.start()
+        self.poll_preview( self.preview_thread)
+    
+    def poll_preview( self, thread):
+        # Runs on the Tk main loop while thread is the current preview, 
+        # drawing what it's sent for up to PREVIEW_POLL_BUDGET at a time
+        if thread is not self.preview_thread:
+            return
+        deadline = time.time() + PREVIEW_POLL_BUDGET
+        while time.time() < deadline and thread is self.preview_thread:
+            try:
+                kind, args = thread.events.get_nowait()
+            except Queue.Empty:
+                break
+            self.handle_preview_event( kind, *args)
+        if thread.is_alive() or not thread.events.empty():
+            self.master.after( PREVIEW_POLL_MS, self.poll_preview, thread)
+    
+    def handle_preview_event( self, kind, *args):
+        canvas = self.image_canvas
+        if self.preview_stale and kind in (gcode_preview.PREVIEW_LINES, 
+                                gcode_preview.PREVIEW_IMAGE, gcode_preview.PREVIEW_DONE):
+            # The first of a redrawn view replaces the old one
+            canvas.delete( "preview")
+            self.preview_stale = False
+        
+        if kind == gcode_preview.PREVIEW_MODEL:
+            if self.preview_file_path:
+                self.rc.set_loaded_gcode( args[0])
+                self.append_to_console( "Loaded file: %s"%self.preview_file_path)
+        elif kind == gcode_preview.PREVIEW_PYRAMID:
+            self.preview_pyramid = args[0]
+            if self.view_redraw_pending:
+                # The view changed while the model was loading
+                self.redraw_view()
+        elif kind == gcode_preview.PREVIEW_LINES:
+            for color, coords in args[0]:
+                canvas.create_line( coords, fill=color, tags="preview")
+            self.raise_progress()
+        elif kind == gcode_preview.PREVIEW_IMAGE:
+            canvas.delete( "preview")
+            self.preview_photo = ImageTk.PhotoImage( args[0])
+            canvas.create_image( 0, 0, anchor=NW, image=self.preview_photo, tags="preview")
+            self.raise_progress()
+        elif kind == gcode_preview.PREVIEW_FAILED:
+            if self.preview_file_path:
+                self.append_to_console( "Error loading %s: %s"%(self.preview_file_path, args[0]))
+            else:
+                self.append_to_console( "Error drawing preview: %s"%args[0])
     
 def main():
     # FIXME: Change Menu Bar to read "RishaLaser", rather than "Python"
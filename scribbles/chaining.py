@@ -0,0 +1,85 @@
+#
+# Joins DXF entities that share endpoints into continuous paths, so that
+# each path is drawn with one pen-down (laser on) and one pen-up (laser 
+# off), rather than one of each per entity.
+#
+# Only straight lines are chained for now.  GcodeParser doesn't know G2/G3,
+# so an arc in the middle of a path would be skipped, and the laser would 
+# burn a straight line from its start to the rest of the path.
+#
+
+import entities
+
+# Endpoints closer than this (in mm) are taken to be the same point
+DEFAULT_TOLERANCE = 0.01
+
+class EndpointIndex:
+    "Line endpoints, bucketed on a grid of tolerance-sized cells"
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.cells = {}
+
+    def cell(self, point):
+        return (int(point[0] // self.tolerance), int(point[1] // self.tolerance))
+
+    def add(self, point, item):
+        self.cells.setdefault(self.cell(point), []).append((point, item))
+
+    def find(self, point, used):
+        "The first (index, end) within tolerance of point whose index isn't in used"
+        cx, cy = self.cell(point)
+        best = None
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                for (other, item) in self.cells.get((x, y), ()):
+                    if item[0] in used:
+                        continue
+                    if abs(other[0] - point[0]) > self.tolerance or abs(other[1] - point[1]) > self.tolerance:
+                        continue
+                    # Prefer entities earlier in the file, so the result 
+                    # doesn't depend on the order of the cells
+                    if best is None or item < best:
+                        best = item
+        return best
+
+def chain_entities(entity_list, tolerance = DEFAULT_TOLERANCE):
+    """Returns entity_list with the lines that share endpoints joined into 
+    entities.Path objects.  Each path goes where its first line was; lines 
+    with nothing to join to, and other entities, are left as they are."""
+    index = EndpointIndex(tolerance)
+    for i, entity in enumerate(entity_list):
+        if isinstance(entity, entities.Line):
+            index.add(entity.start, (i, 0))
+            index.add(entity.end, (i, 1))
+
+    used = set()
+    def extend(points):
+        # Add lines on to the end of points for as long as there's one to add
+        while True:
+            found = index.find(points[-1], used)
+            if found is None:
+                return
+            (j, end) = found
+            used.add(j)
+            line = entity_list[j]
+            points.append(line.end if end == 0 else line.start)
+
+    chained = []
+    for i, entity in enumerate(entity_list):
+        if not isinstance(entity, entities.Line):
+            chained.append(entity)
+            continue
+        if i in used:
+            continue
+        used.add(i)
+        points = [entity.start, entity.end]
+        extend(points)
+        # ...and on to the start, keeping the first line's direction
+        points.reverse()
+        extend(points)
+        points.reverse()
+        if len(points) == 2:
+            chained.append(entity)
+        else:
+            chained.append(entities.Path(points))
+    return chained
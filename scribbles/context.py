@@ -2,7 +2,7 @@ from math import *
 import sys
 
 class GCodeContext:
-    def __init__(self, z_feedrate, z_height, xy_feedrate, start_delay, stop_delay, line_width, file):
+    def __init__(self, z_feedrate, z_height, xy_feedrate, start_delay, stop_delay, line_width, file, inline_power=False):
         self.z_feedrate = z_feedrate
         self.z_height = z_height
         self.xy_feedrate = xy_feedrate
@@ -10,49 +10,80 @@ class GCodeContext:
         self.stop_delay = stop_delay
         self.line_width = line_width
         self.file = file
+        # With inline_power, there are no 'M300' pen up/down lines or servo 
+        # dwells: the laser power is given on the moves themselves, 
+        # e.g. 'G1 X10.00 Y0.00 F2000.00 S255', and only when it changes
+        self.inline_power = inline_power
     
         self.drawing = False
         self.last = None
         self.codes = []
+        self.power = 0
+        self.next_power = None
 
     def generate(self, should_print=False):
-        gcode_source = ""
-        
-        gcode_source += "(Scribbled version of %s @ %.2f)\n" % (self.file, self.xy_feedrate)
-        # gcode_source += "(", " ".join(sys.argv), ")\n" # CLI options
-        gcode_source += "G21 (metric ftw)\n"
-        gcode_source += "G90 (absolute mode)\n"
-        gcode_source += "G92 X0 Y0 Z0 (zero all axes)\n"
-        # gcode_source += "G92 Z%0.2F F150.00 (go up to printing level)\n" %self.z_height
-        gcode_source += "\n"
-        
-        gcode_source += "\n".join( self.codes)
-        
-        gcode_source += "\n"
-        gcode_source += "(end of print job)\n"
-        gcode_source += "M300 S0 (pen up)\n"
-        gcode_source += "G4 P%d (wait %dms)\n" % (self.stop_delay, self.stop_delay)
-        gcode_source += "M300 S0 (turn off servo)\n"
-        gcode_source += "G1 X0 Y0 F3500.00\n"
-        # gcode_source += "G92 Z15 F150.00 (go up to finished level)\n"
-        # gcode_source += "G92 X0 Y0 Z15 F150.00 (go up to finished level)\n"
-        gcode_source += "M18 (drives off)\n"
+        gcode_source = "\n".join( self.lines())
         
         if should_print:
             print gcode_source
             
         return gcode_source
 
+    def lines(self):
+        # Every line generate() would write, without joining them up
+        header = []
+        header.append("(Scribbled version of %s @ %.2f)" % (self.file, self.xy_feedrate))
+        # header.append("(" + " ".join(sys.argv) + ")") # CLI options
+        header.append("G21 (metric ftw)")
+        header.append("G90 (absolute mode)")
+        header.append("G92 X0 Y0 Z0 (zero all axes)")
+        # header.append("G92 Z%0.2F F150.00 (go up to printing level)" %self.z_height)
+        header.append("")
+        
+        footer = []
+        footer.append("(end of print job)")
+        if self.inline_power:
+            footer.append("G1 X0 Y0 F3500.00 S0")
+        else:
+            footer.append("M300 S0 (pen up)")
+            footer.append("G4 P%d (wait %dms)" % (self.stop_delay, self.stop_delay))
+            footer.append("M300 S0 (turn off servo)")
+            footer.append("G1 X0 Y0 F3500.00")
+        # footer.append("G92 Z15 F150.00 (go up to finished level)")
+        # footer.append("G92 X0 Y0 Z15 F150.00 (go up to finished level)")
+        footer.append("M18 (drives off)")
+        footer.append("")
+        
+        return header + (self.codes or [""]) + footer
+
     def start(self):
-        self.codes.append("M300 S255 (pen down)")
-        self.codes.append("G4 P%d (wait %dms)" % (self.start_delay, self.start_delay))
+        if self.inline_power:
+            self.set_power(255)
+        else:
+            self.codes.append("M300 S255 (pen down)")
+            self.codes.append("G4 P%d (wait %dms)" % (self.start_delay, self.start_delay))
         self.drawing = True
     
     def stop(self):
-        self.codes.append("M300 S0 (pen up)")
-        self.codes.append("G4 P%d (wait %dms)" % (self.stop_delay, self.stop_delay))
+        if self.inline_power:
+            self.set_power(0)
+        else:
+            self.codes.append("M300 S0 (pen up)")
+            self.codes.append("G4 P%d (wait %dms)" % (self.stop_delay, self.stop_delay))
         self.drawing = False
 
+    def set_power(self, power):
+        # inline_power: the next move is made at power
+        self.next_power = None if power == self.power else power
+
+    def power_word(self):
+        # inline_power: ' S<power>' for a move, if the power has changed 
+        # since the last move that gave one
+        if self.next_power is None:
+            return ""
+        self.power, self.next_power = self.next_power, None
+        return " S%d" % self.power
+
     def go_to_point(self, x, y, stop=False):
         if self.last == (x,y):
             return
@@ -60,11 +91,9 @@ class GCodeContext:
                 return
         else:
                 if self.drawing: 
-                    self.codes.append("M300 S0 (pen up)") 
-                    self.codes.append("G4 P%d (wait %dms)" % (self.stop_delay, self.stop_delay))
-                    self.drawing = False
+                    self.stop()
                     
-        self.codes.append("G1 X%.2f Y%.2f F%.2f" % (x,y, self.xy_feedrate))
+        self.codes.append("G1 X%.2f Y%.2f F%.2f" % (x,y, self.xy_feedrate) + self.power_word())
         
         self.last = (x,y)
     
@@ -75,10 +104,8 @@ class GCodeContext:
             return
         else:
             if self.drawing == False:
-                self.codes.append("M300 S255 (pen down)")
-                self.codes.append("G4 P%d (wait %dms)" % (self.start_delay, self.start_delay))
-                self.drawing = True
+                self.start()
                     
-        self.codes.append("G1 X%.2f Y%.2f F%.2f" % (x,y, self.xy_feedrate))
+        self.codes.append("G1 X%.2f Y%.2f F%.2f" % (x,y, self.xy_feedrate) + self.power_word())
 
         self.last = (x,y)
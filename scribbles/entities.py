@@ -14,6 +14,29 @@ class Line(Entity):
 		context.go_to_point(self.start[0],self.start[1])
 		context.draw_to_point(self.end[0],self.end[1])
 		context.codes.append("")
+	def reversed(self):
+		"The same line, drawn from its end to its start"
+		line = Line()
+		line.start = self.end
+		line.end = self.start
+		return line
+
+class Path(Entity):
+	"Connected line segments through a list of points, drawn in one go"
+	def __init__(self, points):
+		self.points = points
+	def __str__(self):
+		return "Path of %d segments from [%.2f, %.2f] to [%.2f, %.2f]" % (len(self.points) - 1, self.points[0][0], self.points[0][1], self.points[-1][0], self.points[-1][1])
+	def get_gcode(self,context):
+		"Emit gcode for drawing path"
+		context.codes.append("(" + str(self) + ")")
+		context.go_to_point(self.points[0][0],self.points[0][1])
+		for point in self.points[1:]:
+			context.draw_to_point(point[0],point[1])
+		context.codes.append("")
+	def reversed(self):
+		"The same path, drawn from its end to its start"
+		return Path(self.points[::-1])
 
 class Circle(Entity):
 	def __str__(self):
@@ -26,7 +49,7 @@ class Circle(Entity):
 		context.codes.append("(" + str(self) + ")")
 		context.go_to_point(start[0],start[1])
 		context.start()
-		context.codes.append(arc_code)
+		context.codes.append(arc_code + context.power_word())
 		context.stop()
 		context.codes.append("")
 
@@ -57,7 +80,7 @@ class Arc(Entity):
 		context.go_to_point(start[0],start[1])
 		context.last = end
 		context.start()
-		context.codes.append(arc_code)
+		context.codes.append(arc_code + context.power_word())
 		context.stop()
 		context.codes.append("")
         
@@ -1,7 +1,15 @@
 import sys
+import re
+import mmap
 import entities
 import context
 from math import radians
+from itertools import compress, count, izip
+
+# '0 SECTION 2 <name>' and '0 ENDSEC'.  SECTION and ENDSEC can't be group
+# codes, so these only match where the '0' is a group code, never a value
+SECTION_RE = re.compile(r'^[ \t]*0[ \t]*\r?\n[ \t]*SECTION[ \t]*\r?\n[ \t]*2[ \t]*\r?\n[ \t]*(\S+)[ \t]*\r?\n', re.M)
+ENDSEC_RE = re.compile(r'^[ \t]*0[ \t]*\r?\n[ \t]*ENDSEC[ \t]*\r?$', re.M)
 
 class RegisterMap:
     def __init__(self):
@@ -16,19 +24,39 @@ class RegisterMap:
                 self.map[code] = [entry, value]
         else:
             self.map[code] = value
+    def __contains__(self,code):
+        return code in self.map
     def __getitem__(self,key):
         return self.map[key]
     
     def get_float(self,code,default = 0.0):
-        if code in self.map:
-            return float(self.map[code])
+        if code in self:
+            return float(self[code])
         return default
     
     def get_angle(self,code,default = 0.0):
         "Returns angle in radians"
-        if code in self.map:
-            return radians(float(self.map[code]))
+        if code in self:
+            return radians(float(self[code]))
         return default
+
+class RecordMap(RegisterMap):
+    """A RegisterMap for one whole record, kept as its lists of codes and 
+    values.  Nothing is converted or stripped until it's looked up, and
+    entities only look up a few of their codes."""
+    def __init__(self,codes,values):
+        self.codes = codes
+        self.values = values
+
+    def __contains__(self,code):
+        return code in self.codes
+    def __getitem__(self,key):
+        if self.codes.count(key) == 1:
+            return self.values[self.codes.index(key)].strip()
+        values = [value.strip() for (code,value) in izip(self.codes,self.values) if code == key]
+        if not values:
+            raise KeyError(key)
+        return values
     
 
 class DXFLine(entities.Line):
@@ -117,8 +145,11 @@ class DxfParser:
         elif data == "ENDSEC":
             self.section = None
     
-    def __init__(self, stream):
+    def __init__(self, stream, fast=True):
         self.stream = stream
+        # fast=True parses with parse_fast() instead of reading a code at
+        # a time with get_next_code()
+        self.fast = fast
         self.entities = []
         self.blocks = []
         self.register_map = RegisterMap()
@@ -151,6 +182,60 @@ class DxfParser:
         return True
 
     def parse(self):
+        if self.fast:
+            self.parse_fast()
+            return
         while self.parse_next_code():
             pass
 
+    def read_all(self):
+        # The whole file, mapped into memory where it can be, so sections 
+        # that are skipped are never read into Python strings
+        try:
+            return mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            return self.stream.read()
+
+    def parse_fast(self):
+        # Finds each section with a regular expression and skips straight 
+        # past the ones not in section_map (HEADER, TABLES, OBJECTS, ...).
+        # The rest are split into lines in one go; group codes are 
+        # converted once per distinct spelling rather than once per line,
+        # and only the records that make entities get a RecordMap
+        data = self.read_all()
+        try:
+            self.parse_sections(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def parse_sections(self,data):
+        pos = 0
+        while True:
+            match = SECTION_RE.search(data, pos)
+            if not match:
+                break
+            end_match = ENDSEC_RE.search(data, match.end())
+            end = end_match.start() if end_match else len(data)
+            pos = end_match.end() if end_match else len(data)
+            name = match.group(1)
+            if name in DxfParser.section_map:
+                self.section = DxfParser.section_map[name](self)
+                self.parse_section(data[match.end():end])
+        self.section = None
+
+    def parse_section(self,text):
+        lines = text.splitlines()
+        codes = lines[0::2]
+        values = lines[1::2]
+        code_values = dict((code, int(code)) for code in set(codes))
+        record_codes = set(code for code in code_values if code_values[code] == 0)
+        record_starts = list(compress(count(), map(record_codes.__contains__, codes)))
+        record_starts.append(len(values))
+        entity_map = GenericSection.entity_map
+        for (start, end) in izip(record_starts, record_starts[1:]):
+            if values[start].strip() not in entity_map:
+                continue
+            self.section.make_entity(RecordMap([code_values[code] for code in codes[start:end]],
+                                               values[start:end]))
+
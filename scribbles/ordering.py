@@ -0,0 +1,212 @@
+#
+# Puts DXF entities in an order that cuts down the travel (laser off moves)
+# between them.  Files list entities in whatever order they were drawn, so
+# drawn as they come the head rapids back and forth across the bed.
+#
+# A greedy nearest-neighbour tour is made first, using a grid of the ends
+# of the entities not yet drawn.  Lines and paths may be drawn either way
+# round, so both their ends are candidates; circles and arcs always go the
+# same way.  A 2-opt pass can then reverse stretches of the tour where that
+# makes it shorter.  It only looks a window of entities ahead, so it stays
+# quick on files with tens of thousands of entities.
+#
+
+from math import hypot, sqrt
+
+import entities
+
+# The head starts here, and the job's footer brings it back here
+ORIGIN = (0.0, 0.0)
+
+# How many entities ahead 2-opt looks (0 skips it), and how many passes
+# over the tour it makes at most
+DEFAULT_TWO_OPT_WINDOW = 20
+DEFAULT_TWO_OPT_PASSES = 3
+
+def endpoints(entity):
+    "(start, end, reversible) for entity, or None if it isn't drawn anywhere"
+    if isinstance(entity, entities.Line):
+        return (entity.start, entity.end, True)
+    if isinstance(entity, entities.Path):
+        return (entity.points[0], entity.points[-1], True)
+    if isinstance(entity, entities.Circle):
+        start = (entity.center[0] - entity.radius, entity.center[1])
+        return (start, start, False)
+    if isinstance(entity, entities.Arc):
+        return (entity.find_point(0), entity.find_point(1), False)
+    if isinstance(entity, entities.PolyLine) and getattr(entity, 'segments', None):
+        return (entity.segments[0], entity.segments[-1], False)
+    return None
+
+def travel_distance(entity_list, origin = ORIGIN):
+    "Length of the moves from origin to each entity in turn, and back again"
+    (x, y) = origin
+    total = 0.0
+    for entity in entity_list:
+        ends = endpoints(entity)
+        if ends is None:
+            continue
+        (start, end, reversible) = ends
+        total += hypot(start[0] - x, start[1] - y)
+        (x, y) = end
+    return total + hypot(origin[0] - x, origin[1] - y)
+
+class EndGrid:
+    "Entity ends not yet drawn, bucketed on a grid of about one per cell"
+    def __init__(self, ends):
+        # ends are (point, (index, reversed)) pairs
+        xs = [point[0] for (point, item) in ends]
+        ys = [point[1] for (point, item) in ends]
+        self.x0 = min(xs)
+        self.y0 = min(ys)
+        width = max(xs) - self.x0
+        height = max(ys) - self.y0
+        self.size = max(sqrt(width * height / len(ends)), max(width, height) / len(ends)) or 1.0
+        self.columns = int(width // self.size)
+        self.rows = int(height // self.size)
+        self.cells = {}
+        self.count = len(ends)
+        for (point, item) in ends:
+            self.cells.setdefault(self.cell(point), []).append((point, item))
+
+    def cell(self, point):
+        return (int((point[0] - self.x0) // self.size), int((point[1] - self.y0) // self.size))
+
+    def remove(self, point, item):
+        key = self.cell(point)
+        cell = self.cells[key]
+        cell.remove((point, item))
+        if not cell:
+            del self.cells[key]
+        self.count -= 1
+
+    def ring(self, cx, cy, r):
+        "The cells r cells away from (cx, cy) that are on the grid"
+        if r == 0:
+            return [(cx, cy)]
+        xs = range(max(cx - r, 0), min(cx + r, self.columns) + 1)
+        ys = range(max(cy - r + 1, 0), min(cy + r - 1, self.rows) + 1)
+        cells = []
+        for y in (cy - r, cy + r):
+            if 0 <= y <= self.rows:
+                cells.extend((x, y) for x in xs)
+        for x in (cx - r, cx + r):
+            if 0 <= x <= self.columns:
+                cells.extend((x, y) for y in ys)
+        return cells
+
+    def nearest(self, point):
+        "The (distance, item) of the end nearest point, or None if there are none left"
+        (cx, cy) = self.cell(point)
+        last_ring = max(cx, self.columns - cx, cy, self.rows - cy)
+        best = None
+        r = 0
+        while r <= last_ring:
+            # Everything in ring r is at least r - 1 cells away
+            if best is not None and best[0] <= (r - 1) * self.size:
+                break
+            for key in self.ring(cx, cy, r):
+                for (other, item) in self.cells.get(key, ()):
+                    candidate = (hypot(other[0] - point[0], other[1] - point[1]), item)
+                    # Ties go to the entity earliest in the file
+                    if best is None or candidate < best:
+                        best = candidate
+            r += 1
+        return best
+
+def nearest_neighbour_tour(ends_list, origin = ORIGIN):
+    "(index, reversed) for each entity with ends, nearest next end first"
+    ends = []
+    for (i, (start, end, reversible)) in ends_list:
+        ends.append((start, (i, False)))
+        if reversible and end != start:
+            ends.append((end, (i, True)))
+    if not ends:
+        return []
+    by_index = {}
+    for (point, item) in ends:
+        by_index.setdefault(item[0], []).append((point, item))
+
+    grid = EndGrid(ends)
+    built = grid.count
+    tour = []
+    position = origin
+    ends_by_entity = dict(ends_list)
+    while grid.count:
+        # Rebuild the grid as it empties, so the search doesn't have to
+        # look through rings of empty cells to find what's left
+        if grid.count * 4 < built:
+            grid = EndGrid([end for item_ends in by_index.values() for end in item_ends])
+            built = grid.count
+        (distance, (i, reverse)) = grid.nearest(position)
+        for (point, item) in by_index.pop(i):
+            grid.remove(point, item)
+        tour.append((i, reverse))
+        (start, end, reversible) = ends_by_entity[i]
+        position = start if reverse else end
+    return tour
+
+def two_opt(tour, ends_by_entity, origin = ORIGIN, window = DEFAULT_TWO_OPT_WINDOW,
+            passes = DEFAULT_TWO_OPT_PASSES):
+    """Improves tour in place by reversing runs of up to window entities,
+    when that shortens the moves into and out of the run.  Runs with an
+    entity that can't be drawn backwards are left alone."""
+    n = len(tour)
+    starts = []
+    finishes = []
+    reversible = []
+    for (i, reverse) in tour:
+        (start, end, can_reverse) = ends_by_entity[i]
+        starts.append(end if reverse else start)
+        finishes.append(start if reverse else end)
+        reversible.append(can_reverse)
+
+    for p in range(passes):
+        improved = False
+        for i in range(n):
+            if not reversible[i]:
+                continue
+            (px, py) = finishes[i - 1] if i else origin
+            (sx, sy) = starts[i]
+            into = hypot(sx - px, sy - py)
+            for j in range(i, min(n, i + window)):
+                if not reversible[j]:
+                    break
+                (nx, ny) = starts[j + 1] if j + 1 < n else origin
+                (fx, fy) = finishes[j]
+                change = (hypot(fx - px, fy - py) + hypot(sx - nx, sy - ny)
+                          - into - hypot(fx - nx, fy - ny))
+                if change < -1e-9:
+                    (starts[i:j + 1], finishes[i:j + 1]) = (finishes[i:j + 1][::-1],
+                                                            starts[i:j + 1][::-1])
+                    tour[i:j + 1] = [(k, not reverse) for (k, reverse) in reversed(tour[i:j + 1])]
+                    (sx, sy) = starts[i]
+                    into = hypot(sx - px, sy - py)
+                    improved = True
+        if not improved:
+            break
+    return tour
+
+def order_entities(entity_list, origin = ORIGIN, two_opt_window = DEFAULT_TWO_OPT_WINDOW,
+                   two_opt_passes = DEFAULT_TWO_OPT_PASSES):
+    """Returns entity_list reordered, with lines and paths reversed where
+    that helps, to shorten the travel between them.  Entities that aren't
+    drawn anywhere go at the end, in the order they came."""
+    ends_list = []
+    others = []
+    for (i, entity) in enumerate(entity_list):
+        ends = endpoints(entity)
+        if ends is None:
+            others.append(entity)
+        else:
+            ends_list.append((i, ends))
+
+    tour = nearest_neighbour_tour(ends_list, origin)
+    if two_opt_window:
+        two_opt(tour, dict(ends_list), origin, two_opt_window, two_opt_passes)
+
+    ordered = []
+    for (i, reverse) in tour:
+        entity = entity_list[i]
+        ordered.append(entity.reversed() if reverse else entity)
+    return ordered + others
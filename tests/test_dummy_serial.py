@@ -0,0 +1,106 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Smoke tests for dummy_serial's GrblSimulator.
+#
+# Usage:
+#   python -m unittest discover tests
+import os, sys, time
+import logging
+import unittest
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import dummy_serial
+import risha_controller
+
+class TestGrblSimulator( unittest.TestCase):
+    def connect_and_move( self, baud, clock=None):
+        # What SERIAL_MOCK does on connect, then one line: the welcome, and
+        # an 'ok' for the line
+        sim = dummy_serial.GrblSimulator( port='mock', baudrate=baud, timeout=2.0, clock=clock)
+        started = time.time()
+        welcome = [sim.readline() for i in range( 2)]
+        sim.write( "G0 X1\n")
+        response = sim.readline()
+        self.assertEqual( welcome, ["\r\n", "Grbl 1.1f ['$' for help]\r\n"])
+        self.assertEqual( response, "ok\r\n")
+        return time.time() - started
+
+    def test_real_clock_9600( self):
+        self.assertLess( self.connect_and_move( 9600), 1.0)
+
+    def test_real_clock_115200( self):
+        self.assertLess( self.connect_and_move( 115200), 1.0)
+
+    def test_virtual_clock_at_epoch_time( self):
+        # A virtual clock reading like the real one does
+        self.connect_and_move( 115200, dummy_serial.VirtualClock( start=time.time()))
+
+    def test_controller_connect( self):
+        # connect_hardware() with SERIAL_MOCK, on the real clock
+        saved = risha_controller.SERIAL_MOCK
+        risha_controller.SERIAL_MOCK = True
+        risha_controller.dummy_serial = dummy_serial
+        try:
+            rc = risha_controller.RishaController( port_name='mock')
+            rc.set_logging_func( lambda msg: None)
+            rc.connect_hardware( 'mock')
+            self.assertEqual( rc.grbl_send( "G0 X1"), "ok\r\n")
+        finally:
+            risha_controller.SERIAL_MOCK = saved
+
+    def test_controller_logs_errors( self):
+        # grbl_send() logs GRBL's 'ok' at DEBUG, which is dropped by default,
+        # and its errors at ERROR
+        saved = risha_controller.SERIAL_MOCK
+        risha_controller.SERIAL_MOCK = True
+        risha_controller.dummy_serial = dummy_serial
+        try:
+            rc = risha_controller.RishaController( port_name='mock')
+            logged = []
+            rc.set_logging_func( lambda msg, level: logged.append( (msg.strip(), level)), 
+                                 thread_safe=True)
+            rc.connect_hardware( 'mock')
+            del logged[:]
+            rc.grbl_send( "G0 X1")
+            rc.grbl_send( "G0 Q1")
+            self.assertEqual( logged, [("error:20", logging.ERROR)])
+            # As a streamed job's replies are, other than ok/error
+            del logged[:]
+            rc.handle_grbl_message( "ALARM:3")
+            self.assertEqual( logged, [("ALARM:3", logging.ERROR)])
+        finally:
+            risha_controller.SERIAL_MOCK = saved
+
+    def test_controller_status_during_send( self):
+        # Status reports read by grbl_send() update machine_status, and 
+        # aren't logged or returned
+        saved = risha_controller.SERIAL_MOCK
+        risha_controller.SERIAL_MOCK = True
+        risha_controller.dummy_serial = dummy_serial
+        try:
+            rc = risha_controller.RishaController( port_name='mock')
+            logged = []
+            rc.set_logging_func( lambda msg, level: logged.append( (msg.strip(), level)), 
+                                 thread_safe=True)
+            rc.connect_hardware( 'mock')
+            del logged[:]
+            rc.start_status_polling()
+            poller = rc.status_poller
+            responses = []
+            try:
+                for i in range( 10):
+                    responses.append( rc.grbl_send( "G1 F600 X%d"%(i % 2)))
+                    time.sleep( 0.1)
+            finally:
+                rc.stop_status_polling()
+                poller.join()
+            self.assertEqual( logged, [])
+            self.assertEqual( set( responses), set( ["ok\r\n"]))
+            self.assertNotEqual( rc.machine_status, None)
+        finally:
+            risha_controller.SERIAL_MOCK = saved
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Tests for gcode_preview's PreviewThread.
+#
+# Usage:
+#   python -m unittest discover tests
+import os, sys
+import unittest
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import gcode_preview
+from YAGV.gcodeParser import GcodeParser
+
+class TestPreviewThread( unittest.TestCase):
+    def preview_events( self, gcode_model=None, load=None):
+        # Everything a PreviewThread posts for gcode_model, run on this thread
+        thread = gcode_preview.PreviewThread( gcode_preview.Viewport( 200, 100), 
+                                              gcode_model, load)
+        thread.run()
+        events = []
+        while not thread.events.empty():
+            events.append( thread.events.get())
+        return events
+
+    def test_empty_model( self):
+        # An empty model is drawn as it is, not loaded
+        model = GcodeParser().parseString( "")
+        self.assertEqual( len( model), 0)
+        kinds = [kind for kind, args in self.preview_events( model)]
+        self.assertNotIn( gcode_preview.PREVIEW_FAILED, kinds)
+        self.assertEqual( kinds[0], gcode_preview.PREVIEW_MODEL)
+        self.assertEqual( kinds[-1], gcode_preview.PREVIEW_DONE)
+
+    def test_loaded_model( self):
+        model = GcodeParser().parseString( "G1 X10 Y10\nG1 X20\n")
+        events = self.preview_events( load=lambda: model)
+        self.assertEqual( events[0], (gcode_preview.PREVIEW_MODEL, (model,)))
+        self.assertEqual( events[-1][0], gcode_preview.PREVIEW_DONE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Tests for GcodeRunnerThread, running jobs against dummy_serial's
+# GrblSimulator on the real clock.
+#
+# Usage:
+#   python -m unittest discover tests
+import os, sys, time
+import unittest
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+import dummy_serial
+import risha_controller
+from YAGV.gcodeParser import GcodeParser
+
+def wait_for( condition, timeout=5.0):
+    # True once condition() is, False if timeout seconds pass first
+    give_up = time.time() + timeout
+    while time.time() < give_up:
+        if condition():
+            return True
+        time.sleep( 0.02)
+    return condition()
+
+class TestGcodeRunner( unittest.TestCase):
+    def setUp( self):
+        self.saved_mock = risha_controller.SERIAL_MOCK
+        risha_controller.SERIAL_MOCK = True
+        risha_controller.dummy_serial = dummy_serial
+        self.rc = risha_controller.RishaController( port_name='mock')
+        self.rc.set_logging_func( lambda msg: None)
+        self.rc.connect_hardware( 'mock')
+        self.finished = []
+
+    def tearDown( self):
+        risha_controller.SERIAL_MOCK = self.saved_mock
+        thread = self.rc.gcode_runner_thread
+        if thread and thread.is_alive():
+            self.rc.stop_gcode()
+            thread.join( 5.0)
+        self.rc.stop_status_polling()
+
+    def run_job( self, gcode):
+        model = GcodeParser().parseString( gcode)
+        self.rc.run_gcode( model, end_callback=lambda *args: self.finished.append( args))
+        return self.rc.gcode_runner_thread
+
+    def test_status_reports_while_paused( self):
+        # Slow moves, so the job is still going when it's paused
+        thread = self.run_job( "G1 F300\n" + "".join( "G1 X%d\n"%(10 * (i % 2 + 1))
+                                                        for i in range( 20)))
+        self.assertTrue( wait_for( lambda: thread.acked_line_num is not None))
+        self.rc.toggle_pause_gcode()
+        self.assertTrue( wait_for( lambda: thread.is_paused))
+        paused_at = time.time()
+        self.assertTrue( wait_for( lambda: self.rc.machine_status and
+                                   self.rc.machine_status.timestamp > paused_at + 0.5 and
+                                   self.rc.machine_status.state.startswith( 'Hold')))
+
+    def test_polls_keep_hold_latency( self):
+        # The status poller's '?'s don't overwrite the feed hold's latency
+        thread = self.run_job( "G1 F300\nG1 X10\nG1 X20\n")
+        self.assertTrue( wait_for( lambda: thread.is_running))
+        self.rc.toggle_pause_gcode( requested_at=time.time() - 1.0)
+        hold_latency = self.rc.last_realtime_latency
+        self.assertGreaterEqual( hold_latency, 1.0)
+        self.assertTrue( wait_for( lambda: self.rc.last_status_query_latency is not None))
+        time.sleep( 0.5)
+        self.assertEqual( self.rc.last_realtime_latency, hold_latency)
+        self.assertLess( self.rc.last_status_query_latency, 1.0)
+
+    def test_stop_reports_acked_line( self):
+        # More lines than GRBL's planner and RX buffer hold, so some are 
+        # still in flight when the job's stopped
+        thread = self.run_job( "G1 F300\n" + "".join( "G1 X%d\n"%(10 * (i % 2 + 1))
+                                                        for i in range( 100)))
+        self.assertTrue( wait_for( lambda: thread.acked_line_num is not None))
+        self.rc.stop_gcode()
+        thread.join( 5.0)
+        self.rc.process_events()
+        last_line, completed, error_count = self.finished[0]
+        self.assertFalse( completed)
+        self.assertEqual( last_line, thread.acked_line_num)
+        self.assertTrue( thread.in_flight)
+        self.assertTrue( all( line_num > last_line for line_num, line_len, sent_at 
+                                                    in thread.in_flight))
+
+    def test_finishes_after_serial_error( self):
+        # A job with no port to write to still reports that it's over, and
+        # stops the status poller
+        self.rc.status_poll_hz = 0
+        self.rc.serial = None
+        thread = self.run_job( "G1 X10\nG1 X20\n")
+        thread.join( 5.0)
+        self.assertFalse( thread.is_alive())
+        self.rc.process_events()
+        self.assertEqual( self.finished, [(None, False, 0)])
+
+    def test_stop_after_finish( self):
+        # Stop once the job's over sends GRBL nothing
+        thread = self.run_job( "G1 X1\n")
+        thread.join( 5.0)
+        self.assertFalse( thread.is_alive())
+        self.rc.stop_gcode()
+        self.assertEqual( self.rc.last_realtime_latency, None)
+
+    def test_toggle_pause_before_worker_applies( self):
+        # Pause and then resume, quicker than the worker (here, not started
+        # at all) takes the requests off its queue
+        thread = risha_controller.GcodeRunnerThread( self.rc, [])
+        thread.is_running = True
+        self.assertEqual( [thread.toggle_pause() for i in range( 3)], 
+                          [risha_controller.PAUSE, risha_controller.RESUME, 
+                           risha_controller.PAUSE])
+        self.assertFalse( thread.is_paused)
+
+if __name__ == '__main__':
+    unittest.main()
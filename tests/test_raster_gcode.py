@@ -0,0 +1,100 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+# Tests for raster_gcode's trim_blank rows: overscan stays on the bed and
+# coordinates come out as plain decimals, in both row directions.
+#
+# Usage:
+#   python -m unittest discover tests
+import os, sys
+import unittest
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, REPO_DIR)
+
+from PIL import Image
+
+import raster_gcode
+
+def dark_image( w, h, dark_pixels):
+    # A white w x h image with a black pixel at each of dark_pixels, (x, y)
+    im = Image.new( 'L', (w, h), 255)
+    for xy in dark_pixels:
+        im.putpixel( xy, 0)
+    return im
+
+class TestTrimmedOverscan( unittest.TestCase):
+    def row_moves( self, im, beam_width_mm, overscan_mm, bed_width_mm=None, rapid_gap_mm=None):
+        # [(gcode, args, text)] for a trim_blank job on im
+        return [(gcode, args, line_format % args) for gcode, args, line_format in
+                    raster_gcode.trimmed_raster_moves( im, beam_width_mm, 0, 255,
+                                    overscan_mm=overscan_mm, rapid_gap_mm=rapid_gap_mm,
+                                    bed_width_mm=bed_width_mm)]
+
+    def xs( self, moves):
+        return [args['X'] for gcode, args, text in moves if 'X' in args]
+
+    def test_run_up_stops_at_left_edge( self):
+        # Row 0 runs left to right, row 1 right to left; both start or end
+        # a pixel from the left of the bed
+        im = dark_image( 10, 2, [(1, 0), (1, 1)])
+        xs = self.xs( self.row_moves( im, 1.0, 5.0))
+        self.assertEqual( min( xs), 0.0)
+        self.assertEqual( xs, [0.0, 1.0, 2.0, 7.0, 7.0, 2.0, 1.0, 0.0])
+
+    def test_run_out_stops_at_bed_width( self):
+        # Row 0 runs out past the right of the bed, row 1 runs up from it
+        im = dark_image( 10, 2, [(8, 0), (8, 1)])
+        xs = self.xs( self.row_moves( im, 1.0, 5.0, bed_width_mm=10.0))
+        self.assertEqual( max( xs), 10.0)
+        self.assertEqual( xs, [3.0, 8.0, 9.0, 10.0, 10.0, 9.0, 8.0, 3.0])
+
+    def test_gap_overscan_on_bed( self):
+        # A white gap wide enough to rapid across, in each direction; its
+        # run-out and run-up stay within [0, bed_width_mm]
+        im = dark_image( 20, 2, [(2, 0), (17, 0), (2, 1), (17, 1)])
+        moves = self.row_moves( im, 1.0, 3.0, bed_width_mm=19.0, rapid_gap_mm=1.0)
+        xs = self.xs( moves)
+        self.assertTrue( all( 0.0 <= x <= 19.0 for x in xs), xs)
+        self.assertEqual( [gcode for gcode, args, text in moves].count( 'G0'), 4)
+
+    def test_no_float_noise( self):
+        # 3 beams of 0.1mm less a 0.3mm overscan is 5.55e-17 in floats
+        im = dark_image( 40, 4, [(3, y) for y in range( 4)] + [(37, y) for y in range( 4)])
+        for gcode, args, text in self.row_moves( im, 0.1, 0.3, bed_width_mm=4.0, rapid_gap_mm=1.0):
+            self.assertNotIn( 'e', text)
+            for val in args.values():
+                self.assertEqual( val, round( val, raster_gcode.COORD_DECIMALS))
+        self.assertIn( 'G0 X0.0 Y0.0', [text for gcode, args, text in
+                                            self.row_moves( im, 0.1, 0.3)])
+
+    def test_model_matches_text( self):
+        # gcode_from_raster() and model_from_raster() agree with a clamped
+        # overscan
+        from YAGV.gcodeParser import GcodeParser, GcodeBuilder
+        im = dark_image( 30, 5, [(1, 0), (28, 1), (5, 2), (20, 2), (0, 4)])
+        options = dict( trim_blank=True, overscan_mm=0.7, rapid_gap_mm=0.5, bed_width_mm=3.0)
+        gcode = raster_gcode.gcode_from_raster( im, 0.1, 0, 255, **options)
+        self.assertNotIn( 'X-', gcode)
+        model = raster_gcode.model_from_raster( im, 0.1, 0, 255, GcodeBuilder(), **options)
+        parsed = GcodeParser().parseString( gcode)
+        self.assertEqual( [seg.coords['X'] for seg in model.segments],
+                          [seg.coords['X'] for seg in parsed.segments])
+
+class TestCommandCount( unittest.TestCase):
+    def test_counts_job_lines( self):
+        # raster_command_count() with a job's options counts the lines that
+        # job has between its header and the closing laser off
+        im = dark_image( 30, 6, [(1, 0), (28, 1), (5, 2), (20, 2), (0, 4), (3, 5)])
+        for inline_power in (False, True):
+            header = raster_gcode.raster_header( 1000, inline_power=inline_power)
+            header_lines = header.count( "\n") + 1
+            for options in [{}, 
+                            dict( trim_blank=True, overscan_mm=0.3, rapid_gap_mm=0.5)]:
+                gcode = raster_gcode.gcode_from_raster( im, 0.1, 0, 255, 
+                                                        inline_power=inline_power, **options)
+                count = raster_gcode.raster_command_count( im, inline_power=inline_power, 
+                                                           beam_width_mm=0.1, **options)
+                self.assertEqual( count, gcode.count( "\n") + 1 - header_lines - 1)
+
+if __name__ == '__main__':
+    unittest.main()